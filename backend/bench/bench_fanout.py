@@ -0,0 +1,180 @@
+"""Broadcast fan-out across several Socket.IO workers sharing a message bus.
+
+Starts N copies of the backend (one process each, on consecutive ports)
+that share SOCKETIO_MESSAGE_QUEUE, connects --clients-per-worker Socket.IO
+clients to every worker, all in one room, and sends chat messages to the
+room through worker 0. Every message has to reach every client, whichever
+worker it is connected to. Run it for 1, 2, 4... workers: with the same
+number of clients per worker, deliveries per second should grow roughly
+linearly with the worker count.
+
+    cd backend
+    python bench/bench_fanout.py --workers 1,2,4 --output fanout.json
+    python bench/bench_fanout.py --bus redis://localhost:6379/0
+
+Clients use the long-polling transport so the bench only needs the packages
+in requirements.txt.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def start_workers(count, base_port, bus_url, database_url):
+    env = dict(os.environ,
+               FLASK_ENV='production',
+               SPOTIFY_CLIENT_ID=os.getenv('SPOTIFY_CLIENT_ID', 'bench'),
+               SPOTIFY_CLIENT_SECRET=os.getenv('SPOTIFY_CLIENT_SECRET', 'bench'),
+               SECRET_KEY=os.getenv('SECRET_KEY', 'bench'),
+               DATABASE_URL=database_url,
+               SOCKETIO_MESSAGE_QUEUE=bus_url,
+               # One sender posts every message; don't let the chat rate limit drop them
+               RATE_LIMITING='false')
+    workers = []
+    for index in range(count):
+        process = subprocess.Popen([sys.executable, 'app.py'], cwd=BACKEND_DIR,
+                                   env=dict(env, PORT=str(base_port + index)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        workers.append(process)
+        # Worker 0 creates the schema; let it finish before the others start
+        wait_ready(base_port + index)
+    wait_settled([base_port + index for index in range(count)])
+    return workers
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/api/spotify/track-cache', timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Worker on port {port} did not start")
+
+
+def wait_settled(ports, timeout=30):
+    """Wait until every sharded worker knows the others and has taken its rooms"""
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            stats = requests.get(f'http://127.0.0.1:{port}/api/shard-stats', timeout=5).json()
+            if not stats['enabled'] or (stats['settled'] and not stats['awaiting_handoff']
+                                        and len(stats['workers']) == len(ports)):
+                break
+            if time.time() > deadline:
+                raise RuntimeError(f"Worker on port {port} did not settle: {stats['workers']}")
+            time.sleep(0.2)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(worker_count, args, bus_url):
+    database_dir = tempfile.mkdtemp(prefix='toptrack-fanout-')
+    workers = start_workers(worker_count, args.base_port, bus_url,
+                            f'sqlite:///{os.path.join(database_dir, "bench.db")}')
+    clients = []
+    lock = threading.Lock()
+    latencies = []
+    try:
+        for index in range(worker_count * args.clients_per_worker):
+            client = socketio.Client(reconnection=False)
+
+            def on_messages(data):
+                received = time.time()
+                with lock:
+                    latencies.extend(received - float(message['message']) for message in data['messages'])
+
+            client.on('receive_messages', on_messages)
+            client.connect(f'http://127.0.0.1:{args.base_port + index % worker_count}', transports=['polling'])
+            client.emit('join_room', {'room_id': 'bench-room', 'user_id': f'listener{index}'})
+            clients.append(client)
+        sender = socketio.Client(reconnection=False)
+        sender.connect(f'http://127.0.0.1:{args.base_port}', transports=['polling'])
+        time.sleep(1)
+
+        start = time.time()
+        for _ in range(args.messages):
+            sender.emit('send_message', {'room_id': 'bench-room', 'user_id': 'sender', 'message': repr(time.time())})
+            time.sleep(args.interval)
+        expected = args.messages * len(clients)
+        deadline = time.time() + args.drain_timeout
+        while time.time() < deadline and len(latencies) < expected:
+            time.sleep(0.1)
+        elapsed = time.time() - start
+        sender.disconnect()
+    finally:
+        for client in clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.wait()
+        shutil.rmtree(database_dir, ignore_errors=True)
+
+    return {
+        'workers': worker_count,
+        'clients': len(clients),
+        'messages': args.messages,
+        'expected_deliveries': expected,
+        'deliveries': len(latencies),
+        'deliveries_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts to run')
+    parser.add_argument('--clients-per-worker', type=int, default=25)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.02, help='seconds between messages')
+    parser.add_argument('--drain-timeout', type=float, default=15)
+    parser.add_argument('--base-port', type=int, default=5100)
+    parser.add_argument('--bus', help='message queue URL (default: a temporary unix:// bus)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    bus_dir = None
+    bus_url = args.bus
+    if not bus_url:
+        bus_dir = tempfile.mkdtemp(prefix='toptrack-bus-')
+        bus_url = f'unix://{bus_dir}'
+    results = []
+    try:
+        for worker_count in [int(count) for count in args.workers.split(',')]:
+            result = run(worker_count, args, bus_url)
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        if bus_dir:
+            shutil.rmtree(bus_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'bus': bus_url.split('://')[0], 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
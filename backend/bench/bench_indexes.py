@@ -0,0 +1,167 @@
+"""Query plans and timings for the hot Song/Vote queries, before and after indexes.
+
+Seeds a database with --songs songs spread over --rooms rooms (plus votes),
+runs the queue read, duplicate check and vote lookup without the hot path
+indexes, creates them and runs the same queries again.
+
+    cd backend
+    python bench/bench_indexes.py --songs 1000000
+    python bench/bench_indexes.py --database-url postgresql://... --output indexes.json
+
+The target database is dropped and recreated, so never point this at real data.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sqlalchemy as sa  # noqa: E402
+
+from extensions import db  # noqa: E402
+from models import Song, Vote  # noqa: E402
+
+
+HOT_INDEXES = [index for table in (Song.__table__, Vote.__table__) for index in table.indexes]
+
+
+def seed(engine, songs, rooms, votes_per_room, batch=20000):
+    now = datetime.utcnow()
+    room_ids = [str(uuid.uuid4()) for _ in range(rooms)]
+    with engine.begin() as conn:
+        conn.execute(db.metadata.tables['room'].insert(),
+                     [{'id': room_id, 'name': 'bench', 'host_id': 'bench', 'is_active': True,
+                       'created_at': now} for room_id in room_ids])
+
+    song_rows = []
+    song_ids = {room_id: [] for room_id in room_ids}
+    inserted = 0
+    while inserted < songs:
+        room_id = room_ids[inserted % rooms]
+        song_id = str(uuid.uuid4())
+        added_at = now - timedelta(seconds=random.randint(0, 30 * 24 * 3600))
+        # Most rows are history: played or long expired
+        is_played = random.random() < 0.9
+        song_ids[room_id].append(song_id)
+        song_rows.append({
+            'id': song_id, 'room_id': room_id, 'title': 'Song', 'artist': 'Artist',
+            'spotify_track_id': f'track{random.randint(0, songs // 4)}',
+            'added_by': 'bench', 'added_at': added_at,
+            'vote_count': random.randint(0, 50), 'is_played': is_played,
+            'expires_at': added_at + timedelta(hours=1) if is_played else now + timedelta(hours=1)
+        })
+        inserted += 1
+        if len(song_rows) >= batch or inserted == songs:
+            with engine.begin() as conn:
+                conn.execute(Song.__table__.insert(), song_rows)
+            song_rows = []
+
+    vote_rows = []
+    for room_id in room_ids:
+        for user in range(min(votes_per_room, len(song_ids[room_id]))):
+            vote_rows.append({'id': str(uuid.uuid4()), 'song_id': song_ids[room_id][user],
+                              'room_id': room_id, 'user_id': f'user{user}', 'voted_at': now})
+    for start in range(0, len(vote_rows), batch):
+        with engine.begin() as conn:
+            conn.execute(Vote.__table__.insert(), vote_rows[start:start + batch])
+    return room_ids
+
+
+def hot_queries(room_id, now):
+    """The statements the app issues on its hot paths, built from the models"""
+    return {
+        'room_queue': sa.select(Song.__table__)
+            .where(Song.room_id == room_id, Song.is_played == False,
+                   (Song.expires_at == None) | (Song.expires_at > now))
+            .order_by(Song.vote_count.desc(), Song.added_at.desc())
+            .limit(10),
+        'duplicate_check': sa.select(Song.id)
+            .where(Song.room_id == room_id, Song.spotify_track_id == 'track1', Song.is_played == False)
+            .limit(1),
+        'vote_lookup': sa.select(Vote.__table__)
+            .where(Vote.room_id == room_id, Vote.user_id == 'user1')
+            .limit(1),
+    }
+
+
+def explain(conn, statement):
+    compiled = statement.compile(conn.engine)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = conn.exec_driver_sql(prefix + str(compiled), params).fetchall()
+    return [' '.join(str(value) for value in row) for row in rows]
+
+
+def measure(engine, room_ids, runs):
+    now = datetime.utcnow()
+    results = {}
+    with engine.connect() as conn:
+        for name, statement in hot_queries(room_ids[0], now).items():
+            results[name] = {'plan': explain(conn, statement)}
+        for name in results:
+            timings = []
+            for run in range(runs):
+                statement = hot_queries(room_ids[run % len(room_ids)], now)[name]
+                start = time.perf_counter()
+                conn.execute(statement).fetchall()
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            results[name]['median_ms'] = round(statistics.median(timings), 3)
+            results[name]['p95_ms'] = round(timings[int(len(timings) * 0.95) - 1], 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='sqlite:////tmp/toptrack-bench-indexes.db')
+    parser.add_argument('--songs', type=int, default=1000000)
+    parser.add_argument('--rooms', type=int, default=2000)
+    parser.add_argument('--votes-per-room', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.database_url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for index in HOT_INDEXES:
+            index.drop(conn)
+
+    start = time.perf_counter()
+    room_ids = seed(engine, args.songs, args.rooms, args.votes_per_room)
+    print(f"Seeded {args.songs} songs in {args.rooms} rooms in {time.perf_counter() - start:.1f}s")
+
+    before = measure(engine, room_ids, args.runs)
+    with engine.begin() as conn:
+        for index in HOT_INDEXES:
+            index.create(conn)
+    if engine.dialect.name == 'sqlite':
+        with engine.begin() as conn:
+            conn.exec_driver_sql('ANALYZE')
+    after = measure(engine, room_ids, args.runs)
+
+    for name in before:
+        print(f"\n== {name}")
+        for label, result in (('before', before[name]), ('after', after[name])):
+            print(f"  {label}: median {result['median_ms']} ms, p95 {result['p95_ms']} ms")
+            for line in result['plan']:
+                print(f"    {line}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'database': engine.dialect.name, 'songs': args.songs, 'rooms': args.rooms,
+                       'before': before, 'after': after}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
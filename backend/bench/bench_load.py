@@ -0,0 +1,436 @@
+"""End-to-end load test: rooms of Socket.IO clients joining, adding, voting and advancing.
+
+Starts --workers copies of the backend (sharing a bus when more than one)
+against a fresh SQLite file, or --database-url, with a local Spotify stub
+(spotify_stub.py) in place of api.spotify.com and accounts.spotify.com.
+Seeds --rooms rooms with an authenticated host each, connects
+--clients-per-room Socket.IO clients to every room, then runs four phases:
+
+    join     every client joins its room
+    add      --adds-per-room tracks per room through /api/spotify/track-info
+             (with --async-add, answered 202 and delivered by song_added)
+    vote     --bursts bursts in which every client votes at the same moment
+    advance  --advances get_next_song requests per room
+
+For each phase it reports p50/p95/p99 latency (join: own user_joined echo,
+add: HTTP response, vote: the voter's song_voted ack, advance: next_song
+back at the requester), broadcast lag (request sent -> event received by
+each room member) and events received per second. Results are printed and,
+with --output, written as JSON together with the commit, so runs from
+different commits can be compared.
+
+    cd backend
+    python bench/bench_load.py --rooms 10 --clients-per-room 20 --output load.json
+    python bench/bench_load.py --workers 2 --database-url postgresql://localhost/toptrack_bench
+
+The target database's tables are created if missing and rows are added to
+it; never point --database-url at real data.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import socketio
+
+import spotify_stub
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+EVENTS = ('user_joined', 'song_added', 'song_voted', 'queue_delta', 'next_song')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2)
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': percentile(latencies, 1.0)
+    }
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+def seed(rooms):
+    """Create the schema and `rooms` rooms whose hosts have a valid token; returns the room IDs"""
+    from datetime import datetime, timedelta
+    from app import create_app
+    from extensions import db
+    from models import Room, SpotifyToken
+    flask_app = create_app()
+    with flask_app.app_context():
+        db.create_all()
+        room_ids = []
+        for index in range(rooms):
+            host_id = f'bench-host-{os.getpid()}-{index}'
+            db.session.add(SpotifyToken(
+                spotify_user_id=host_id, access_token='stub', refresh_token='stub-refresh',
+                expires_at=datetime.utcnow() + timedelta(hours=2)))
+            room = Room(name=f'Bench room {index}', host_id=host_id)
+            db.session.add(room)
+            db.session.flush()
+            room_ids.append(room.id)
+        db.session.commit()
+        return room_ids
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/api/health', timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Worker on port {port} did not start")
+
+
+def wait_settled(ports, timeout=30):
+    """Wait until every sharded worker knows the others and has taken its rooms"""
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            stats = requests.get(f'http://127.0.0.1:{port}/api/shard-stats', timeout=5).json()
+            if not stats['enabled'] or (stats['settled'] and not stats['awaiting_handoff']
+                                        and len(stats['workers']) == len(ports)):
+                break
+            if time.time() > deadline:
+                raise RuntimeError(f"Worker on port {port} did not settle: {stats['workers']}")
+            time.sleep(0.2)
+
+
+class BenchClient:
+    """One Socket.IO client; keeps every event it receives with its arrival time"""
+
+    def __init__(self, url, room_id, user_id):
+        self.room_id = room_id
+        self.user_id = user_id
+        self.received = []  # (time, event, data)
+        self.sio = socketio.Client(reconnection=False)
+        for event in EVENTS:
+            self.sio.on(event, functools.partial(self._record, event))
+        self.sio.connect(url, transports=['polling'])
+
+    def _record(self, event, data):
+        self.received.append((time.time(), event, data))
+
+    def first(self, event, after, match=lambda data: True):
+        for received_at, name, data in list(self.received):
+            if name == event and received_at >= after and match(data):
+                return received_at
+        return None
+
+    def last(self, event):
+        for _, name, data in reversed(list(self.received)):
+            if name == event:
+                return data
+        return None
+
+    def count_between(self, start, end):
+        return sum(1 for received_at, _, _ in list(self.received) if start <= received_at <= end)
+
+
+class LoadTest:
+    def __init__(self, args, ports, room_ids):
+        self.args = args
+        self.ports = ports
+        self.room_ids = room_ids
+        self.rng = random.Random(args.seed)
+        self.clients = {room_id: [] for room_id in room_ids}
+        self.errors = 0
+
+    def url(self, index):
+        return f'http://127.0.0.1:{self.ports[index % len(self.ports)]}'
+
+    def all_clients(self):
+        return [client for clients in self.clients.values() for client in clients]
+
+    def events_per_second(self, start, end):
+        received = sum(client.count_between(start, end) for client in self.all_clients())
+        return round(received / max(end - start, 1e-9), 1)
+
+    def connect(self):
+        index = 0
+        for room_id in self.room_ids:
+            for member in range(self.args.clients_per_room):
+                self.clients[room_id].append(BenchClient(self.url(index), room_id, f'listener-{room_id[:8]}-{member}'))
+                index += 1
+
+    def phase_join(self):
+        sent = {}
+        start = time.time()
+        for client in self.all_clients():
+            sent[client] = time.time()
+            client.sio.emit('join_room', {'room_id': client.room_id, 'user_id': client.user_id})
+        wait_for(lambda: all(client.first('user_joined', sent[client], lambda d, c=client: d.get('user_id') == c.user_id)
+                             for client in sent), self.args.drain_timeout)
+        end = time.time()
+        latencies = []
+        for client, sent_at in sent.items():
+            echoed = client.first('user_joined', sent_at, lambda d: d.get('user_id') == client.user_id)
+            if echoed is None:
+                self.errors += 1
+            else:
+                latencies.append(echoed - sent_at)
+        return {'latency': summarize(latencies), 'events_per_second': self.events_per_second(start, end),
+                'seconds': round(end - start, 3)}
+
+    def phase_add(self):
+        jobs = [(room_id, f'bench{room_id[:8]}{index:04d}')
+                for index in range(self.args.adds_per_room) for room_id in self.room_ids]
+        latencies, lags, statuses = [], [], {}
+
+        def add(job, worker_index):
+            room_id, track_id = job
+            sent_at = time.time()
+            response = requests.post(f'{self.url(worker_index)}/api/spotify/track-info', json={
+                'room_id': room_id, 'added_by': 'bench', 'async': self.args.async_add,
+                'spotify_url': f'https://open.spotify.com/track/{track_id}'}, timeout=30)
+            return room_id, track_id, sent_at, time.time() - sent_at, response.status_code
+
+        start = time.time()
+        with ThreadPoolExecutor(self.args.add_concurrency) as pool:
+            results = list(pool.map(add, jobs, range(len(jobs))))
+        for room_id, track_id, sent_at, latency, status in results:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            latencies.append(latency)
+        added = [result for result in results if result[4] == (202 if self.args.async_add else 201)]
+
+        def delivered(client, track_id, sent_at):
+            return client.first('song_added', sent_at, lambda d: d['song']['spotify_track_id'] == track_id)
+
+        wait_for(lambda: all(delivered(client, track_id, sent_at)
+                             for room_id, track_id, sent_at, _, _ in added for client in self.clients[room_id]),
+                 self.args.drain_timeout)
+        end = time.time()
+        for room_id, track_id, sent_at, _, _ in added:
+            for client in self.clients[room_id]:
+                received_at = delivered(client, track_id, sent_at)
+                if received_at is None:
+                    self.errors += 1
+                else:
+                    lags.append(received_at - sent_at)
+        self.errors += len(results) - len(added)
+        return {'latency': summarize(latencies), 'broadcast_lag': summarize(lags), 'statuses': statuses,
+                'requests_per_second': round(len(jobs) / max(end - start, 1e-9), 1),
+                'events_per_second': self.events_per_second(start, end), 'seconds': round(end - start, 3)}
+
+    def phase_vote(self):
+        queues = {}
+        for room_id in self.room_ids:
+            response = requests.get(f'{self.url(0)}/api/room/{room_id}/queue', timeout=10)
+            queues[room_id] = [song['id'] for song in response.json()['songs']]
+        latencies, lags = [], []
+        start = time.time()
+        for _ in range(self.args.bursts):
+            burst = []
+            burst_start = time.time()
+            for room_id, clients in self.clients.items():
+                if not queues[room_id]:
+                    continue
+                for client in clients:
+                    sent_at = time.time()
+                    client.sio.emit('vote_song', {'room_id': room_id, 'user_id': client.user_id,
+                                                  'song_id': self.rng.choice(queues[room_id]), 'vote_type': 'up'})
+                    burst.append((client, sent_at))
+
+            def acked(client, sent_at):
+                return client.first('song_voted', sent_at, lambda d: d.get('user_id') == client.user_id)
+
+            wait_for(lambda: all(acked(client, sent_at) and client.first('queue_delta', burst_start)
+                                 for client, sent_at in burst), self.args.drain_timeout)
+            for client, sent_at in burst:
+                acked_at = acked(client, sent_at)
+                delta_at = client.first('queue_delta', burst_start)
+                if acked_at is None or delta_at is None:
+                    self.errors += 1
+                    continue
+                latencies.append(acked_at - sent_at)
+                lags.append(delta_at - burst_start)
+            time.sleep(self.args.burst_interval)
+        end = time.time()
+        votes = self.args.bursts * sum(len(clients) for room_id, clients in self.clients.items() if queues[room_id])
+        return {'votes': votes, 'latency': summarize(latencies), 'broadcast_lag': summarize(lags),
+                'events_per_second': self.events_per_second(start, end), 'seconds': round(end - start, 3)}
+
+    def phase_advance(self):
+        latencies, lags = [], []
+        start = time.time()
+
+        def advance_room(room_id):
+            clients = self.clients[room_id]
+            requester = clients[0]
+            for _ in range(self.args.advances):
+                # Name the song being skipped, as the host's player does
+                playing = (requester.last('next_song') or {}).get('current_song')
+                sent_at = time.time()
+                requester.sio.emit('get_next_song', {'room_id': room_id, 'user_id': requester.user_id,
+                                                     'current_song_id': playing['id'] if playing else None})
+                wait_for(lambda: all(client.first('next_song', sent_at) for client in clients), self.args.drain_timeout)
+                for client in clients:
+                    received_at = client.first('next_song', sent_at)
+                    if received_at is None:
+                        self.errors += 1
+                        continue
+                    if client is requester:
+                        latencies.append(received_at - sent_at)
+                    lags.append(received_at - sent_at)
+
+        with ThreadPoolExecutor(len(self.room_ids)) as pool:
+            list(pool.map(advance_room, self.room_ids))
+        end = time.time()
+        return {'latency': summarize(latencies), 'broadcast_lag': summarize(lags),
+                'events_per_second': self.events_per_second(start, end), 'seconds': round(end - start, 3)}
+
+    def close(self):
+        for client in self.all_clients():
+            try:
+                client.sio.disconnect()
+            except Exception:
+                pass
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    database_dir = None
+    database_url = args.database_url
+    if not database_url:
+        database_dir = tempfile.mkdtemp(prefix='toptrack-load-')
+        database_url = f'sqlite:///{os.path.join(database_dir, "bench.db")}'
+    # Worker output is kept, so a failing run can be explained after the fact
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='toptrack-load-logs-')
+    os.makedirs(log_dir, exist_ok=True)
+    print(json.dumps({'worker_logs': log_dir}), file=sys.stderr)
+    stub = spotify_stub.start(latency=args.spotify_latency, rate_limit=args.spotify_rate_limit)
+    stub_url = f'http://127.0.0.1:{stub.server_port}'
+    env = dict(os.environ,
+               FLASK_ENV='production',
+               SPOTIFY_CLIENT_ID=os.getenv('SPOTIFY_CLIENT_ID', 'bench'),
+               SPOTIFY_CLIENT_SECRET=os.getenv('SPOTIFY_CLIENT_SECRET', 'bench'),
+               SECRET_KEY=os.getenv('SECRET_KEY', 'bench'),
+               SPOTIFY_API_BASE=stub_url,
+               SPOTIFY_ACCOUNTS_BASE=stub_url,
+               DATABASE_URL=database_url,
+               LOG_LEVEL='WARNING',
+               # Every client adds and votes from one address as fast as it can
+               RATE_LIMITING='false')
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    if args.workers > 1:
+        env['SOCKETIO_MESSAGE_QUEUE'] = args.bus or f'unix://{os.path.join(database_dir or tempfile.mkdtemp(), "bus")}'
+    ports = [args.base_port + index for index in range(args.workers)]
+    workers = []
+    test = None
+    try:
+        seeded = subprocess.run([sys.executable, __file__, '--seed-rooms', str(args.rooms)], cwd=BACKEND_DIR,
+                                env=env, check=True, capture_output=True, text=True)
+        room_ids = json.loads(seeded.stdout.strip().splitlines()[-1])
+        for port in ports:
+            with open(os.path.join(log_dir, f'worker-{port}.log'), 'w') as log_file:
+                workers.append(subprocess.Popen([sys.executable, 'app.py'], cwd=BACKEND_DIR, env=dict(env, PORT=str(port)),
+                                                stdout=log_file, stderr=subprocess.STDOUT))
+            wait_ready(port)
+        wait_settled(ports)
+
+        test = LoadTest(args, ports, room_ids)
+        test.connect()
+        phases = {}
+        for name in ('join', 'add', 'vote', 'advance'):
+            phases[name] = getattr(test, f'phase_{name}')()
+            print(json.dumps({'phase': name, **phases[name]}), file=sys.stderr)
+        server = {key: 0 for key in ('requests', 'rate_limited', 'retries', 'errors')}
+        for port in ports:
+            stats = requests.get(f'http://127.0.0.1:{port}/api/spotify/client-stats', timeout=10).json()
+            for key in server:
+                server[key] += stats[key]
+    finally:
+        if test is not None:
+            test.close()
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.wait()
+        stub.shutdown()
+        if database_dir:
+            shutil.rmtree(database_dir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'database': database_url.split(':', 1)[0],
+        'workers': args.workers,
+        'async_add': args.async_add,
+        'rooms': args.rooms,
+        'clients_per_room': args.clients_per_room,
+        'phases': phases,
+        'errors': test.errors,
+        'worker_logs': log_dir,
+        'spotify_stub': stub.stats(),
+        'spotify_client': server
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--clients-per-room', type=int, default=10)
+    parser.add_argument('--adds-per-room', type=int, default=10)
+    parser.add_argument('--add-concurrency', type=int, default=10, help='add requests in flight at once')
+    parser.add_argument('--async-add', action='store_true', help='add tracks through the async job queue')
+    parser.add_argument('--bursts', type=int, default=5)
+    parser.add_argument('--burst-interval', type=float, default=0.5, help='seconds between vote bursts')
+    parser.add_argument('--advances', type=int, default=3, help='get_next_song requests per room')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--bus', help='message queue URL for --workers > 1 (default: a temporary unix:// bus)')
+    parser.add_argument('--database-url', help='default: a temporary SQLite file')
+    parser.add_argument('--spotify-latency', type=float, default=0.02, help='seconds the stub waits per call')
+    parser.add_argument('--spotify-rate-limit', type=float, default=0.0, help='fraction of stub calls answered 429')
+    parser.add_argument('--drain-timeout', type=float, default=15)
+    parser.add_argument('--base-port', type=int, default=5200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--log-dir', help='write each worker\'s output here (default: a new temporary directory)')
+    parser.add_argument('--seed-rooms', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed_rooms:
+        sys.path.insert(0, BACKEND_DIR)
+        print(json.dumps(seed(args.seed_rooms)))
+        return
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
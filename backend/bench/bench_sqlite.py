@@ -0,0 +1,194 @@
+"""SQLite under concurrent load: default settings vs the tuned profile.
+
+Runs the same mixed workload against a fresh SQLite file once per profile
+(SQLITE_PROFILE=default and tuned, see sqlite_profile.py). --processes
+worker processes share the file, like several app workers would; each runs
+--readers greenlets loading a room's queue and --writers greenlets writing
+vote batches (delete + insert + vote_count update + commit, the shape of a
+vote flush) for --duration seconds. Reports operations per second,
+latency percentiles and `database is locked` errors per profile.
+
+    cd backend
+    python bench/bench_sqlite.py --processes 4 --duration 10 --output sqlite.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2)
+
+
+def summarize(latencies):
+    return {
+        'ops': len(latencies),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': percentile(latencies, 1.0)
+    }
+
+
+def seed(songs):
+    """Create the schema and one room with `songs` songs; returns (room_id, song_ids)"""
+    from app import create_app
+    from extensions import db
+    from models import Room, Song
+    flask_app = create_app()
+    with flask_app.app_context():
+        db.create_all()
+        room = Room(name='bench', host_id='bench')
+        db.session.add(room)
+        db.session.flush()
+        new_songs = [Song(room_id=room.id, spotify_track_id=f'bench{index}', title=f'Song {index}',
+                          artist='Bench', added_by='bench', vote_count=0, is_played=False)
+                     for index in range(songs)]
+        db.session.add_all(new_songs)
+        db.session.commit()
+        return room.id, [song.id for song in new_songs]
+
+
+def child(args):
+    """One worker process: run readers and writers, print latencies as JSON"""
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from sqlalchemy.exc import OperationalError
+    from app import create_app
+    import rooms
+    flask_app = create_app()
+
+    with open(args.child) as f:
+        setup = json.load(f)
+    room_id, song_ids = setup['room_id'], setup['song_ids']
+    rng = random.Random(os.getpid())
+    deadline = time.time() + args.duration
+    result = {'reads': [], 'writes': [], 'locked': 0, 'errors': 0}
+
+    def run(operation, latencies):
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                with flask_app.app_context():
+                    operation()
+                latencies.append(time.perf_counter() - start)
+            except OperationalError as e:
+                if 'locked' in str(e):
+                    result['locked'] += 1
+                else:
+                    result['errors'] += 1
+            gevent.sleep(0)
+
+    def read():
+        rooms.load_room_queue(room_id)
+
+    def write():
+        users = [f'{os.getpid()}-{rng.randrange(1000)}' for _ in range(args.batch)]
+        changes = {}
+        for user_id in users:
+            changes[(room_id, user_id)] = (None, rng.choice(song_ids))
+        rooms.flush_votes(changes)
+        # Withdraw them again so the vote table stays small
+        rooms.flush_votes({key: (new, None) for key, (old, new) in changes.items()})
+
+    greenlets = [gevent.spawn(run, read, result['reads']) for _ in range(args.readers)]
+    greenlets += [gevent.spawn(run, write, result['writes']) for _ in range(args.writers)]
+    gevent.joinall(greenlets)
+    print(json.dumps(result))
+
+
+def run_profile(profile, args):
+    database_dir = tempfile.mkdtemp(prefix='toptrack-sqlite-')
+    env = dict(os.environ,
+               FLASK_ENV='production',
+               SPOTIFY_CLIENT_ID=os.getenv('SPOTIFY_CLIENT_ID', 'bench'),
+               SPOTIFY_CLIENT_SECRET=os.getenv('SPOTIFY_CLIENT_SECRET', 'bench'),
+               SECRET_KEY=os.getenv('SECRET_KEY', 'bench'),
+               DATABASE_URL=f'sqlite:///{os.path.join(database_dir, "bench.db")}',
+               SQLITE_PROFILE=profile)
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    setup_path = os.path.join(database_dir, 'setup.json')
+    try:
+        subprocess.run([sys.executable, __file__, '--seed-into', setup_path, '--songs', str(args.songs)],
+                       cwd=BACKEND_DIR, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        command = [sys.executable, __file__, '--child', setup_path, '--duration', str(args.duration),
+                   '--readers', str(args.readers), '--writers', str(args.writers), '--batch', str(args.batch)]
+        processes = [subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL, text=True)
+                     for _ in range(args.processes)]
+        reads, writes, locked, errors = [], [], 0, 0
+        for process in processes:
+            output, _ = process.communicate()
+            lines = [line for line in output.splitlines() if line.startswith('{"reads"')]
+            if not lines:
+                errors += 1
+                continue
+            child_result = json.loads(lines[-1])
+            reads += child_result['reads']
+            writes += child_result['writes']
+            locked += child_result['locked']
+            errors += child_result['errors']
+    finally:
+        shutil.rmtree(database_dir, ignore_errors=True)
+    return {
+        'profile': profile,
+        'reads': summarize(reads),
+        'writes': summarize(writes),
+        'reads_per_second': round(len(reads) / args.duration, 1),
+        'writes_per_second': round(len(writes) / args.duration, 1),
+        'locked_errors': locked,
+        'other_errors': errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default='default,tuned')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=20, help='reader greenlets per process')
+    parser.add_argument('--writers', type=int, default=5, help='writer greenlets per process')
+    parser.add_argument('--batch', type=int, default=20, help='votes per write batch')
+    parser.add_argument('--songs', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--seed-into', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child or args.seed_into:
+        sys.path.insert(0, BACKEND_DIR)
+        import logging
+        logging.disable(logging.CRITICAL)
+        if args.seed_into:
+            room_id, song_ids = seed(args.songs)
+            with open(args.seed_into, 'w') as f:
+                json.dump({'room_id': room_id, 'song_ids': song_ids}, f)
+        else:
+            child(args)
+        return
+
+    results = []
+    for profile in args.profiles.split(','):
+        result = run_profile(profile, args)
+        results.append(result)
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'processes': args.processes, 'readers': args.readers, 'writers': args.writers,
+                       'duration': args.duration, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
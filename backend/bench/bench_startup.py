@@ -0,0 +1,129 @@
+"""Worker boot time: building the app in every worker vs forking a preloaded one.
+
+cold: a fresh interpreter imports the app and calls create_app(), as every
+worker does without preloading. Reported split into the import and the
+create_app() call, with the interpreter's own start-up excluded.
+forked: a process that built the app once forks, and each child handles a
+first request, as gunicorn workers do with `preload_app` (gunicorn.conf.py);
+the time covers the fork, the after-fork reset and that request.
+
+    cd backend
+    python bench/bench_startup.py --runs 10 --output startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Imported only on paths most workers never take
+LAZY_MODULES = ('alembic', 'flask_migrate')
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'runs': len(values),
+        'p50_ms': round(statistics.median(values) * 1000, 2),
+        'min_ms': round(values[0] * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2)
+    }
+
+
+def cold_child():
+    """Import and build the app once; print the timings as JSON"""
+    from gevent import monkey
+    monkey.patch_all()
+    started = time.perf_counter()
+    from app import create_app
+    imported = time.perf_counter()
+    create_app()
+    created = time.perf_counter()
+    print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                      'modules': len(sys.modules),
+                      'lazy_modules_loaded': [name for name in LAZY_MODULES if name in sys.modules]}))
+
+
+def forked_child(runs):
+    """Build the app once, then time `runs` forks that each serve a first request"""
+    from gevent import monkey
+    monkey.patch_all()
+    from app import create_app
+    app = create_app()
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            status = app.test_client().get('/api/rate-limit-stats').status_code
+            os._exit(0 if status == 200 else 1)
+        _, status = os.waitpid(pid, 0)
+        if status:
+            raise SystemExit('forked worker failed')
+        timings.append(time.perf_counter() - started)
+    print(json.dumps({'forked': timings}))
+
+
+def run_child(mode, args, env):
+    output = subprocess.run([sys.executable, __file__, mode, '--runs', str(args.runs)], cwd=BACKEND_DIR, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('mode', nargs='?', choices=('cold', 'forked'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        sys.path.insert(0, BACKEND_DIR)
+        import logging
+        logging.disable(logging.CRITICAL)
+        if args.mode == 'cold':
+            cold_child()
+        else:
+            forked_child(args.runs)
+        return
+
+    database_dir = tempfile.mkdtemp(prefix='toptrack-startup-')
+    env = dict(os.environ,
+               FLASK_ENV='production',
+               SPOTIFY_CLIENT_ID=os.getenv('SPOTIFY_CLIENT_ID', 'bench'),
+               SPOTIFY_CLIENT_SECRET=os.getenv('SPOTIFY_CLIENT_SECRET', 'bench'),
+               SECRET_KEY=os.getenv('SECRET_KEY', 'bench'),
+               DATABASE_URL=f'sqlite:///{os.path.join(database_dir, "bench.db")}')
+    env.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    try:
+        # The first run creates the schema; time a database that is already set up
+        run_child('cold', args, env)
+        cold = [run_child('cold', args, env) for _ in range(args.runs)]
+        forked = run_child('forked', args, env)['forked']
+    finally:
+        shutil.rmtree(database_dir, ignore_errors=True)
+
+    result = {
+        'cold': {
+            'import': summarize([run['import'] for run in cold]),
+            'create_app': summarize([run['create_app'] for run in cold]),
+            'total': summarize([run['import'] + run['create_app'] for run in cold]),
+            'modules': cold[-1]['modules'],
+            'lazy_modules_loaded': cold[-1]['lazy_modules_loaded']
+        },
+        'forked': summarize(forked)
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Concurrent vote storm: checks that stored vote counts end up exact.
+
+Creates a room with --songs songs and fires --votes votes from --users
+users at it, each vote in its own greenlet, while the write-behind buffer
+flushes in the background. Users toggle and move their votes at random,
+so most votes are withdrawals or switches. Afterwards it checks, for every
+song, that song.vote_count in the database, the number of vote rows and
+the in-memory queue count all equal the final ballots. Exits non-zero on
+any mismatch.
+
+    cd backend
+    python bench/bench_votes.py --votes 5000 --users 500 --songs 20
+    DATABASE_URL=postgresql://localhost/toptrack_bench python bench/bench_votes.py
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--votes', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--songs', type=int, default=20)
+    parser.add_argument('--spread', type=float, default=0.5, help='seconds the votes are spread over')
+    parser.add_argument('--flush-interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    database_dir = None
+    if not os.getenv('DATABASE_URL'):
+        database_dir = tempfile.mkdtemp(prefix='toptrack-votes-')
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(database_dir, "bench.db")}'
+    os.environ.setdefault('SPOTIFY_CLIENT_ID', 'bench')
+    os.environ.setdefault('SPOTIFY_CLIENT_SECRET', 'bench')
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ['VOTE_FLUSH_INTERVAL'] = str(args.flush_interval)
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(BACKEND_DIR)
+    from gevent import monkey
+    monkey.patch_all()
+    import logging
+    import gevent
+    from sqlalchemy import event, func
+    from app import create_app
+    from extensions import db
+    from models import Room, Song, Vote
+    import rooms
+    flask_app = create_app()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    statements = {'count': 0}
+    with flask_app.app_context():
+        db.create_all()
+        dialect = db.engine.dialect.name
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *a, **kw: statements.__setitem__('count', statements['count'] + 1))
+        room = Room(name='bench', host_id='bench')
+        db.session.add(room)
+        db.session.flush()
+        song_ids = []
+        for index in range(args.songs):
+            song = Song(room_id=room.id, spotify_track_id=f'bench{index}', title=f'Song {index}',
+                        artist='Bench', added_by='bench', vote_count=0, is_played=False)
+            db.session.add(song)
+            db.session.flush()
+            song_ids.append(song.id)
+        db.session.commit()
+        room_id = room.id
+
+    rng = random.Random(args.seed)
+    votes = [(f'user{rng.randrange(args.users)}', rng.choice(song_ids)) for _ in range(args.votes)]
+
+    def vote(user_id, song_id):
+        with flask_app.app_context():
+            rooms.vote_on_song({'room_id': room_id, 'user_id': user_id, 'song_id': song_id,
+                                'sid': 'bench'})
+
+    statements['count'] = 0
+    start = time.perf_counter()
+    greenlets = [gevent.spawn_later(rng.random() * args.spread, vote, user_id, song_id)
+                 for user_id, song_id in votes]
+    # Extra flushes racing the background one
+    greenlets += [gevent.spawn_later(rng.random() * args.spread, rooms.vote_buffer.flush) for _ in range(20)]
+    gevent.joinall(greenlets, raise_error=True)
+    vote_seconds = time.perf_counter() - start
+    rooms.vote_buffer.flush()
+    total_seconds = time.perf_counter() - start
+
+    ballots = rooms.vote_buffer.ballots(room_id)
+    expected = {song_id: 0 for song_id in song_ids}
+    for song_id in ballots.values():
+        expected[song_id] += 1
+    with flask_app.app_context():
+        stored = dict(db.session.query(Song.id, Song.vote_count)
+                      .filter(Song.room_id == room_id))
+        rows = dict(db.session.query(Vote.song_id, func.count())
+                    .filter(Vote.room_id == room_id).group_by(Vote.song_id))
+    queue = rooms.queue_index.room(room_id)
+    mismatches = [
+        {'song_id': song_id, 'expected': count, 'stored': stored.get(song_id),
+         'vote_rows': rows.get(song_id, 0), 'in_memory': queue.get(song_id)['vote_count']}
+        for song_id, count in expected.items()
+        if not (stored.get(song_id) == rows.get(song_id, 0) == queue.get(song_id)['vote_count'] == count)
+    ]
+
+    result = {
+        'database': dialect,
+        'votes': args.votes,
+        'users': args.users,
+        'songs': args.songs,
+        'seconds_to_last_vote': round(vote_seconds, 3),
+        'seconds_to_durable': round(total_seconds, 3),
+        'sql_statements': statements['count'],
+        'final_ballots': len(ballots),
+        'mismatches': mismatches
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if database_dir:
+        shutil.rmtree(database_dir, ignore_errors=True)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Local stand-in for api.spotify.com and accounts.spotify.com.
+
+Answers the calls the backend makes with made-up but well-formed data, so
+benchmarks can add tracks and refresh tokens without network access or a
+Spotify account. Point the backend at it with
+
+    SPOTIFY_API_BASE=http://127.0.0.1:5099 SPOTIFY_ACCOUNTS_BASE=http://127.0.0.1:5099
+
+Every track ID exists except ones starting with `missing`. `latency` adds
+a delay to each response and `rate_limit` answers that fraction of calls
+with 429 (Retry-After: 0), to exercise the client's retry path.
+
+    python bench/spotify_stub.py --port 5099 --latency 0.05
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_track(track_id):
+    return {
+        'id': track_id,
+        'type': 'track',
+        'name': f'Track {track_id}',
+        'artists': [{'name': f'Artist {sum(map(ord, track_id)) % 50}'}],
+        'album': {'name': f'Album {track_id[:4]}', 'images': [{'url': f'https://i.scdn.co/image/{track_id}'}]},
+        'duration_ms': 150000 + sum(map(ord, track_id)) % 90000,
+        'popularity': sum(map(ord, track_id)) % 100,
+        'explicit': False,
+        'preview_url': None,
+        'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'}
+    }
+
+
+class SpotifyStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, rate_limit=0.0):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.rate_limited = 0
+
+    def stats(self):
+        return {'requests': self.requests, 'rate_limited': self.rate_limited}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _throttle(self):
+        """Apply the configured delay; True when this call should get a 429"""
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.rate_limit and random.random() < self.server.rate_limit:
+            self.server.rate_limited += 1
+            self._reply(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, {'Retry-After': '0'})
+            return True
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self._throttle():
+            return
+        if urlparse(self.path).path == '/api/token':
+            self._reply(200, {'access_token': f'stub-{random.getrandbits(64):x}', 'token_type': 'Bearer',
+                              'expires_in': 3600, 'refresh_token': 'stub-refresh'})
+        else:
+            self._reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+    def do_GET(self):
+        if self._throttle():
+            return
+        url = urlparse(self.path)
+        if url.path == '/v1/me':
+            self._reply(200, {'id': 'stub-user', 'display_name': 'Stub User'})
+        elif url.path == '/v1/tracks':
+            ids = parse_qs(url.query).get('ids', [''])[0].split(',')
+            self._reply(200, {'tracks': [None if track_id.startswith('missing') else fake_track(track_id)
+                                         for track_id in ids if track_id]})
+        elif url.path.startswith('/v1/tracks/'):
+            track_id = url.path.rsplit('/', 1)[1]
+            if track_id.startswith('missing'):
+                self._reply(404, {'error': {'status': 404, 'message': 'Non existing id'}})
+            else:
+                self._reply(200, fake_track(track_id))
+        else:
+            self._reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+
+def start(port=0, latency=0.0, rate_limit=0.0):
+    """Serve the stub on a background thread; returns the server (server.server_port)"""
+    server = SpotifyStub(('127.0.0.1', port), latency=latency, rate_limit=rate_limit)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='fraction of calls answered with 429')
+    args = parser.parse_args()
+    server = SpotifyStub(('127.0.0.1', args.port), latency=args.latency, rate_limit=args.rate_limit)
+    print(f"Spotify stub listening on http://127.0.0.1:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Versioned per-room queue broadcasts.
+
+Every change to a room's queue (songs added, songs removed, vote counts)
+is broadcast with a per-room version number that increases by one with
+every change, so clients can tell when they missed one. Vote count
+changes are collected for a short window and sent as a single
+`queue_delta` event carrying {song_id: vote_count} instead of one frame
+per vote.
+
+The last `history` changes of each room are kept in a ring buffer, so a
+client that reconnects with the version it last saw can be sent just the
+changes it missed. Clients that fell further behind get a full snapshot,
+built once per version and shared by everyone asking for it.
+
+Changes also carry the epoch of the worker that produced them: versions
+restart when a room moves to another worker, so a changed epoch means the
+client has to take a snapshot too.
+"""
+from collections import deque
+import time
+
+import gevent
+
+
+class VoteBroadcaster:
+    """Versioned queue change log with coalesced vote broadcasts.
+
+    `emit(event, payload, room_id)` does the actual broadcast.
+    """
+
+    def __init__(self, emit, window=0.15, epoch=None, history=256, snapshot_ttl=1.0):
+        self._emit = emit
+        self.window = window
+        self.epoch = epoch
+        self.history = history
+        self.snapshot_ttl = snapshot_ttl
+        self._pending = {}    # room_id -> {song_id: vote_count}
+        self._timers = {}     # room_id -> greenlet flushing that room
+        self._versions = {}   # room_id -> last version sent
+        self._logs = {}       # room_id -> deque of (version, event, payload)
+        self._snapshots = {}  # room_id -> (version, limit, built_at, snapshot)
+        self.snapshots_built = 0
+        self.snapshots_shared = 0
+
+    def version(self, room_id):
+        return self._versions.get(room_id, 0)
+
+    def forget(self, room_id):
+        self.flush(room_id)
+        self._versions.pop(room_id, None)
+        self._logs.pop(room_id, None)
+        self._snapshots.pop(room_id, None)
+
+    def record(self, room_id, event, payload):
+        """Broadcast a queue change to the room under the next version"""
+        version = self._versions.get(room_id, 0) + 1
+        self._versions[room_id] = version
+        payload = dict(payload, room_id=room_id, version=version, epoch=self.epoch)
+        log = self._logs.get(room_id)
+        if log is None:
+            log = self._logs[room_id] = deque(maxlen=self.history)
+        log.append((version, event, payload))
+        self._emit(event, payload, room_id)
+        return version
+
+    def song_voted(self, room_id, song_id, vote_count):
+        self._pending.setdefault(room_id, {})[song_id] = vote_count
+        if room_id not in self._timers:
+            self._timers[room_id] = gevent.spawn_later(self.window, self.flush, room_id)
+
+    def flush(self, room_id):
+        timer = self._timers.pop(room_id, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill()
+        votes = self._pending.pop(room_id, None)
+        if not votes:
+            return
+        self.record(room_id, 'queue_delta', {'votes': votes})
+
+    def since(self, room_id, version, epoch):
+        """Changes after `version` as [{'event', 'data'}], or None if they are no longer all kept"""
+        current = self._versions.get(room_id, 0)
+        if epoch != self.epoch or version is None or version > current:
+            return None
+        log = self._logs.get(room_id) or ()
+        if version < current and (not log or log[0][0] > version + 1):
+            return None
+        return [{'event': event, 'data': payload} for v, event, payload in log if v > version]
+
+    def snapshot(self, room_id, build, limit=10):
+        """Full queue state at the current version; `build(limit)` returns the songs.
+
+        The snapshot is shared by every caller until the version changes
+        (or it is `snapshot_ttl` seconds old, so expired songs drop out).
+        """
+        version = self._versions.get(room_id, 0)
+        cached = self._snapshots.get(room_id)
+        now = time.monotonic()
+        if cached and cached[0] == version and cached[1] == limit and now - cached[2] < self.snapshot_ttl:
+            self.snapshots_shared += 1
+            return cached[3]
+        snapshot = {'room_id': room_id, 'version': version, 'epoch': self.epoch, 'songs': build(limit)}
+        self._snapshots[room_id] = (version, limit, now, snapshot)
+        self.snapshots_built += 1
+        return snapshot
+
+    def stats(self):
+        return {
+            'rooms': len(self._logs),
+            'logged_changes': sum(len(log) for log in self._logs.values()),
+            'snapshots_built': self.snapshots_built,
+            'snapshots_shared': self.snapshots_shared
+        }
@@ -0,0 +1,92 @@
+"""Room chat relay.
+
+Messages are relayed by the worker that owns the room (see sharding.py).
+Messages posted to a room within `window` seconds of each other go out as
+one `receive_messages` frame, so a busy room costs each member one frame
+per window rather than one per message. Every message gets a per-room
+sequence number; the last `history` messages of each room are kept in a
+ring buffer and sent to clients that join, in one `chat_history` frame.
+
+Chat frames are safe to lose: a client that was skipped because it fell
+behind (see pubsub.Backpressure) notices the gap in sequence numbers and
+asks for the history instead of the frames it missed.
+"""
+from collections import OrderedDict, deque
+
+import gevent
+
+
+class ChatRelay:
+    """Batched chat broadcasts with per-room history.
+
+    `emit(event, payload, room_id)` does the actual broadcast. History is
+    kept for the `max_rooms` rooms that chatted most recently.
+    """
+
+    def __init__(self, emit, window=0.05, history=50, max_rooms=1000, epoch=None):
+        self._emit = emit
+        self.window = window
+        self.history = history
+        self.max_rooms = max_rooms
+        self.epoch = epoch
+        self._pending = {}            # room_id -> messages not yet broadcast
+        self._timers = {}             # room_id -> greenlet flushing that room
+        self._seqs = {}               # room_id -> last sequence number used
+        self._logs = OrderedDict()    # room_id -> deque of recent messages
+        self.messages = 0
+        self.frames = 0
+
+    def post(self, room_id, message):
+        """Queue `message` (a dict) for the room; returns its sequence number"""
+        seq = self._seqs.get(room_id, 0) + 1
+        self._seqs[room_id] = seq
+        message = dict(message, seq=seq)
+        log = self._logs.get(room_id)
+        if log is None:
+            log = self._logs[room_id] = deque(maxlen=self.history)
+            while len(self._logs) > self.max_rooms:
+                evicted, _ = self._logs.popitem(last=False)
+                if evicted not in self._pending:
+                    self._seqs.pop(evicted, None)
+        else:
+            self._logs.move_to_end(room_id)
+        log.append(message)
+        self.messages += 1
+        pending = self._pending.setdefault(room_id, [])
+        pending.append(message)
+        if len(pending) >= self.history:
+            self.flush(room_id)
+        elif room_id not in self._timers:
+            self._timers[room_id] = gevent.spawn_later(self.window, self.flush, room_id)
+        return seq
+
+    def flush(self, room_id):
+        timer = self._timers.pop(room_id, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill()
+        messages = self._pending.pop(room_id, None)
+        if not messages:
+            return
+        self.frames += 1
+        self._emit('receive_messages', {'room_id': room_id, 'epoch': self.epoch, 'messages': messages}, room_id)
+
+    def recent(self, room_id):
+        """The room's history as a `chat_history` payload"""
+        return {'room_id': room_id, 'epoch': self.epoch, 'seq': self._seqs.get(room_id, 0),
+                'messages': list(self._logs.get(room_id, ()))}
+
+    def loaded_rooms(self):
+        return list(self._logs)
+
+    def forget(self, room_id):
+        self.flush(room_id)
+        self._seqs.pop(room_id, None)
+        self._logs.pop(room_id, None)
+
+    def stats(self):
+        return {
+            'rooms': len(self._logs),
+            'kept_messages': sum(len(log) for log in self._logs.values()),
+            'messages': self.messages,
+            'frames': self.frames
+        }
@@ -0,0 +1,144 @@
+"""Settings read from the environment.
+
+`load_config()` returns every setting as a dict for `app.config`;
+`create_app(config)` lays its own values over it, so tests and benchmarks
+can configure an app without touching os.environ.
+"""
+import os
+
+from ratelimit import parse_limits
+
+# Without these the app can't talk to Spotify or sign sessions
+REQUIRED_SETTINGS = ('SPOTIFY_CLIENT_ID', 'SPOTIFY_CLIENT_SECRET', 'SECRET_KEY')
+
+# Token bucket limits per user and room, as action=rate/burst (tokens a second, bucket size);
+# RATE_LIMITS overrides single actions. RATE_LIMIT_STORE=redis://... shares them between workers
+DEFAULT_RATE_LIMITS = 'track_info=1/10,bulk_add=0.1/3,vote_song=2/10,get_next_song=0.5/5,send_message=1/5'
+
+
+def database_url(url):
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    return url
+
+
+def load_config(env=None):
+    env = os.environ if env is None else env
+    config = {}
+    config['SECRET_KEY'] = env.get('SECRET_KEY')
+    config['SQLALCHEMY_DATABASE_URI'] = database_url(env.get('DATABASE_URL', 'sqlite:///toptrack.db'))
+    config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Structured logs at LOG_LEVEL, as logfmt or LOG_FORMAT=json; hot-path events
+    # (votes, joins, messages) are only logged for a LOG_SAMPLE_RATE fraction
+    config['LOG_LEVEL'] = env.get('LOG_LEVEL', 'INFO')
+    config['LOG_FORMAT'] = env.get('LOG_FORMAT', 'logfmt')
+    config['LOG_SAMPLE_RATE'] = float(env.get('LOG_SAMPLE_RATE', '0.01'))
+    # Missing REQUIRED_SETTINGS stop the app from starting unless FLASK_ENV=development
+    config['FLASK_ENV'] = env.get('FLASK_ENV', 'production')
+    # Create the schema of an empty database and check an existing one is migrated
+    # to the latest revision, once when the app is created (see schema.py)
+    config['SCHEMA_CHECK'] = env.get('SCHEMA_CHECK', 'true').lower() == 'true'
+    # File-backed SQLite gets the tuned profile (WAL, pool, one writer at a time, see
+    # sqlite_profile.py) unless SQLITE_PROFILE=default
+    config['SQLITE_PROFILE'] = env.get('SQLITE_PROFILE', 'tuned')
+    config['SQLITE_BUSY_TIMEOUT_MS'] = int(env.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+    config['SQLITE_MMAP_SIZE'] = int(env.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+    config['SQLITE_POOL_SIZE'] = int(env.get('SQLITE_POOL_SIZE', '10'))
+    config['SQLITE_MAX_OVERFLOW'] = int(env.get('SQLITE_MAX_OVERFLOW', '20'))
+    # With SOCKETIO_MESSAGE_QUEUE set, room emits are fanned out to every worker over a bus
+    config['SOCKETIO_MESSAGE_QUEUE'] = env.get('SOCKETIO_MESSAGE_QUEUE')
+    # Votes are written behind: flushed every VOTE_FLUSH_INTERVAL seconds or once
+    # VOTE_FLUSH_BATCH users have pending changes, whichever comes first
+    config['VOTE_FLUSH_INTERVAL'] = float(env.get('VOTE_FLUSH_INTERVAL', '0.5'))
+    config['VOTE_FLUSH_BATCH'] = int(env.get('VOTE_FLUSH_BATCH', '200'))
+    # Vote count changes are coalesced per room into one queue_delta per window (seconds)
+    config['VOTE_BROADCAST_WINDOW'] = float(env.get('VOTE_BROADCAST_WINDOW', '0.15'))
+    # Recent queue changes kept per room so reconnecting clients only get what they missed
+    config['QUEUE_HISTORY_SIZE'] = int(env.get('QUEUE_HISTORY_SIZE', '256'))
+    # Spotify track metadata cache: in-process LRU, optionally backed by the track_metadata table
+    config['TRACK_CACHE_SIZE'] = int(env.get('TRACK_CACHE_SIZE', '5000'))
+    config['TRACK_CACHE_TTL'] = int(env.get('TRACK_CACHE_TTL', str(24 * 3600)))
+    config['TRACK_CACHE_PERSIST'] = env.get('TRACK_CACHE_PERSIST', 'false').lower() == 'true'
+    # Tokens in use are renewed in the background this many seconds before they expire
+    config['TOKEN_RENEW_MARGIN'] = int(env.get('TOKEN_RENEW_MARGIN', '600'))
+    config['TOKEN_RENEW_INTERVAL'] = int(env.get('TOKEN_RENEW_INTERVAL', '60'))
+    # Played/expired songs are swept out of the song table in small batches. SWEEP_MODE
+    # 'archive' moves them to song_history (kept HISTORY_RETENTION_DAYS, 0 = forever),
+    # 'delete' drops them outright. SWEEP_GRACE is how long past expiry a song is kept.
+    config['SWEEP_MODE'] = env.get('SWEEP_MODE', 'archive')
+    config['SWEEP_INTERVAL'] = int(env.get('SWEEP_INTERVAL', '60'))
+    config['SWEEP_BATCH'] = int(env.get('SWEEP_BATCH', '500'))
+    config['SWEEP_GRACE'] = int(env.get('SWEEP_GRACE', '600'))
+    config['HISTORY_RETENTION_DAYS'] = int(env.get('HISTORY_RETENTION_DAYS', '30'))
+    # A user whose last connection left a room is announced as gone after PRESENCE_GRACE
+    # seconds unless they come back; User rows are written every PRESENCE_FLUSH_INTERVAL
+    config['PRESENCE_GRACE'] = float(env.get('PRESENCE_GRACE', '5'))
+    config['PRESENCE_FLUSH_INTERVAL'] = float(env.get('PRESENCE_FLUSH_INTERVAL', '5'))
+    # Maximum number of tracks a single bulk add may queue
+    config['BULK_ADD_MAX'] = int(env.get('BULK_ADD_MAX', '100'))
+    # How long a track being added stays claimed against concurrent adds of it (seconds)
+    config['ADD_RESERVATION_TTL'] = int(env.get('ADD_RESERVATION_TTL', '30'))
+    # ASYNC_TRACK_ADD makes POST /api/spotify/track-info answer 202 with a job id and deliver the
+    # song through the song_added event (a request can ask with "async": true/false). Jobs run on
+    # JOB_WORKERS greenlets per worker; adds are refused with 503 once JOB_QUEUE_SIZE are waiting
+    config['ASYNC_TRACK_ADD'] = env.get('ASYNC_TRACK_ADD', 'false').lower() == 'true'
+    config['JOB_QUEUE'] = env.get('JOB_QUEUE', 'pool://')
+    config['JOB_WORKERS'] = int(env.get('JOB_WORKERS', '10'))
+    config['JOB_QUEUE_SIZE'] = int(env.get('JOB_QUEUE_SIZE', '500'))
+    config['JOB_HISTORY_SIZE'] = int(env.get('JOB_HISTORY_SIZE', '1000'))
+    # With a message queue, each room's queue and votes are owned by one worker
+    # (consistent hashing over live workers); others forward room events to it.
+    # Without WORKER_ID each process names itself, including workers forked from a preloaded app.
+    # A starting worker owns no rooms for SHARD_SETTLE_TIME seconds while it learns its peers
+    config['ROOM_SHARDING'] = env.get('ROOM_SHARDING', 'true').lower() == 'true'
+    config['WORKER_ID'] = env.get('WORKER_ID') or None
+    config['SHARD_HEARTBEAT_INTERVAL'] = float(env.get('SHARD_HEARTBEAT_INTERVAL', '2'))
+    config['SHARD_WORKER_TIMEOUT'] = float(env.get('SHARD_WORKER_TIMEOUT', '6'))
+    config['SHARD_CALL_TIMEOUT'] = float(env.get('SHARD_CALL_TIMEOUT', '2'))
+    config['SHARD_SETTLE_TIME'] = float(env.get('SHARD_SETTLE_TIME', '3'))
+    # The room owner advances the queue PLAYBACK_GRACE seconds after a song's duration
+    # has elapsed, if the host reported playing it within PLAYBACK_REPORT_TIMEOUT seconds;
+    # get_next_song requests that don't say which song they advance past are ignored for
+    # ADVANCE_DEBOUNCE seconds after a song started
+    config['PLAYBACK_GRACE'] = float(env.get('PLAYBACK_GRACE', '1'))
+    config['PLAYBACK_POLL_INTERVAL'] = float(env.get('PLAYBACK_POLL_INTERVAL', '10'))
+    config['PLAYBACK_REPORT_TIMEOUT'] = float(env.get('PLAYBACK_REPORT_TIMEOUT', '30'))
+    config['ADVANCE_DEBOUNCE'] = float(env.get('ADVANCE_DEBOUNCE', '3'))
+    # Chat messages are at most CHAT_MAX_MESSAGE_LENGTH characters; they are broadcast in
+    # CHAT_BATCH_WINDOW batches and the last CHAT_HISTORY_SIZE of each room are sent to joining clients
+    config['CHAT_MAX_MESSAGE_LENGTH'] = int(env.get('CHAT_MAX_MESSAGE_LENGTH', '1000'))
+    config['CHAT_BATCH_WINDOW'] = float(env.get('CHAT_BATCH_WINDOW', '0.05'))
+    config['CHAT_HISTORY_SIZE'] = int(env.get('CHAT_HISTORY_SIZE', '50'))
+    # Chat frames are skipped for clients with more than SOCKET_MAX_BACKLOG packets still unsent
+    config['SOCKET_MAX_BACKLOG'] = int(env.get('SOCKET_MAX_BACKLOG', '100'))
+    # Stats endpoints and /api/metrics need `Authorization: Bearer <STATS_TOKEN>`;
+    # without one they only answer requests from this host
+    config['STATS_TOKEN'] = env.get('STATS_TOKEN')
+    # Number of reverse proxies (load balancer, Render's router, ...) in front of the app whose
+    # X-Forwarded-For/-Proto are trusted, so rate limits and the stats check see the client address
+    config['TRUSTED_PROXIES'] = int(env.get('TRUSTED_PROXIES', '0'))
+    config['RATE_LIMITING'] = env.get('RATE_LIMITING', 'true').lower() == 'true'
+    config['RATE_LIMITS'] = {**parse_limits(DEFAULT_RATE_LIMITS), **parse_limits(env.get('RATE_LIMITS'))}
+    config['RATE_LIMIT_STORE'] = env.get('RATE_LIMIT_STORE', 'memory://')
+    # Each client address may do RATE_LIMIT_ADDRESS_FACTOR times what one user may,
+    # whatever user ids it sends (users in one room often share an address)
+    config['RATE_LIMIT_ADDRESS_FACTOR'] = float(env.get('RATE_LIMIT_ADDRESS_FACTOR', '10'))
+    # Spotify Configuration
+    config['SPOTIFY_CLIENT_ID'] = env.get('SPOTIFY_CLIENT_ID')
+    config['SPOTIFY_CLIENT_SECRET'] = env.get('SPOTIFY_CLIENT_SECRET')
+    config['SPOTIFY_REDIRECT_URI'] = env.get('SPOTIFY_REDIRECT_URI', 'http://127.0.0.1:5000/callback')
+    config['FRONTEND_URL'] = env.get('FRONTEND_URL', 'http://localhost:3000')
+    config['SPOTIFY_API_BASE'] = env.get('SPOTIFY_API_BASE', 'https://api.spotify.com')
+    config['SPOTIFY_ACCOUNTS_BASE'] = env.get('SPOTIFY_ACCOUNTS_BASE', 'https://accounts.spotify.com')
+    config['SPOTIFY_POOL_SIZE'] = int(env.get('SPOTIFY_POOL_SIZE', '50'))
+    config['SPOTIFY_MAX_RETRIES'] = int(env.get('SPOTIFY_MAX_RETRIES', '2'))
+    config['SPOTIFY_MAX_RETRY_AFTER'] = float(env.get('SPOTIFY_MAX_RETRY_AFTER', '5'))
+    # At most SPOTIFY_MAX_CONCURRENCY Spotify calls in flight per worker; calls that wait longer
+    # than SPOTIFY_QUEUE_TIMEOUT seconds for a slot are answered with 429 without being sent
+    config['SPOTIFY_MAX_CONCURRENCY'] = int(env.get('SPOTIFY_MAX_CONCURRENCY', '20'))
+    config['SPOTIFY_QUEUE_TIMEOUT'] = float(env.get('SPOTIFY_QUEUE_TIMEOUT', '2'))
+    return config
+
+
+def missing_settings(config):
+    return [name for name in REQUIRED_SETTINGS if not config.get(name)]
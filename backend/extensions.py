@@ -0,0 +1,67 @@
+"""Flask extensions and per-process instruments, created unbound.
+
+create_app() binds them to an app; importing this module has no side
+effects, so models, routes and socket handlers import what they share from
+here.
+"""
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+from flask_socketio import SocketIO
+
+from metrics import Registry, COUNT_BUCKETS
+from ratelimit import RateLimiter
+
+db = SQLAlchemy()
+socketio = SocketIO()
+
+# Prometheus metrics for this worker, served at /api/metrics (see metrics.py)
+metrics = Registry()
+http_latency = metrics.histogram('toptrack_http_request_duration_seconds', 'REST request latency by route',
+                                 ('route', 'method', 'status'))
+socket_latency = metrics.histogram('toptrack_socketio_handler_duration_seconds', 'Socket.IO handler latency by event',
+                                   ('event',))
+socket_errors = metrics.counter('toptrack_socketio_handler_errors_total', 'Socket.IO handlers that raised', ('event',))
+db_queries = metrics.histogram('toptrack_db_queries_per_request', 'SQL statements run per REST request or Socket.IO event',
+                               ('handler',), buckets=COUNT_BUCKETS)
+db_statements = metrics.counter('toptrack_db_statements_total', 'SQL statements run, including background work')
+emit_fanout = metrics.histogram('toptrack_emit_fanout_clients', 'Clients on this worker reached by one room emit',
+                                buckets=COUNT_BUCKETS)
+chat_messages = metrics.counter('toptrack_chat_messages_total', 'Chat messages received by outcome', ('result',))
+dropped_deliveries = metrics.counter('toptrack_socketio_dropped_total', 'Deliveries skipped for clients that fell behind',
+                                     ('event',))
+rate_limited = metrics.counter('toptrack_rate_limited_total', 'Requests and events refused by a rate limit',
+                               ('action',))
+job_wait = metrics.histogram('toptrack_job_wait_seconds', 'Time background jobs spent queued before running',
+                             ('kind',))
+job_duration = metrics.histogram('toptrack_job_duration_seconds', 'Time background jobs took to run', ('kind',))
+jobs_finished = metrics.counter('toptrack_jobs_total', 'Background jobs finished by outcome', ('kind', 'result'))
+
+# Limits and store are set by create_app from RATE_LIMITS / RATE_LIMIT_STORE
+rate_limiter = RateLimiter({})
+
+def over_limit(action, user_id, address, room_id):
+    """Seconds until `user_id` at `address` may do `action` in the room again, or 0.0 if it may now"""
+    wait = rate_limiter.check_client(action, user_id, address, room_id)
+    if wait:
+        rate_limited.inc(action=action)
+    return wait
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    db_statements.inc()
+    if has_app_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+
+
+def observe_job(job):
+    """`on_finished` hook for job queues"""
+    job_wait.observe(job.started_at - job.queued_at, kind=job.kind)
+    job_duration.observe(job.finished_at - job.started_at, kind=job.kind)
+    jobs_finished.inc(kind=job.kind, result=job.status)
+
+
+def app_context_runner(app):
+    """`run_in_context` for background workers: runs fn inside an app context"""
+    def run_in_app_context(fn):
+        with app.app_context():
+            return fn()
+    return run_in_app_context
@@ -0,0 +1,33 @@
+"""Gunicorn settings: `gunicorn -c gunicorn.conf.py` from backend/.
+
+The app is built once in the master (preload) and forked into the workers,
+so imports, create_app() and the schema check happen once rather than per
+worker, and what they load stays shared copy-on-write. Each worker then
+takes its own worker id and database connections (app.reset_after_fork)
+and starts its background workers.
+With more than one worker, set SOCKETIO_MESSAGE_QUEUE (see the README).
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import gc  # noqa: E402
+import os  # noqa: E402
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+preload_app = True
+wsgi_app = 'app:create_app()'
+
+
+def when_ready(server):
+    # Objects built while preloading live as long as the workers; keeping the
+    # collector off them stops it from copying their pages into every worker
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    # Heartbeat on the bus from the start: peers learn about this worker, and
+    # it about them, before any room is routed here
+    import rooms
+    rooms.start_background_workers()
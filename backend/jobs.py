@@ -0,0 +1,185 @@
+"""Background jobs for work that shouldn't hold an HTTP request open.
+
+A request submits a job and answers 202 with its id straight away; a
+bounded pool of worker greenlets runs the jobs and the result reaches the
+client another way (a Socket.IO event, or GET /api/jobs/<id>). A job has a
+key, and submitting a key that is still queued or running returns the job
+already in flight instead of a second one. When `max_pending` jobs are
+waiting, submissions are refused so callers can shed load.
+
+The queue is chosen by URL (JOB_QUEUE):
+
+    pool://      worker greenlets in this process (default)
+    inline://    runs each job in the submitting greenlet before submit()
+                 returns; a local stand-in for tests and benchmarks
+"""
+from collections import OrderedDict
+import time
+import uuid
+
+import gevent
+from gevent.queue import Queue
+
+import logs
+
+log = logs.get_logger('toptrack.jobs')
+
+
+class JobFailed(Exception):
+    """Raised by a job function to fail the job with `result` as its outcome"""
+
+    def __init__(self, result=None):
+        super().__init__(result)
+        self.result = result
+
+
+class Job:
+    def __init__(self, kind, key, fn):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.fn = fn
+        self.status = 'queued'
+        self.result = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'result': self.result,
+            'queued_at': int(self.queued_at * 1000),
+            'started_at': int(self.started_at * 1000) if self.started_at else None,
+            'finished_at': int(self.finished_at * 1000) if self.finished_at else None
+        }
+
+
+class JobQueue:
+    """Runs submitted jobs on at most `workers` greenlets.
+
+    `fn(job)` runs through `run_in_context` (e.g. inside an app context);
+    what it returns becomes the job's result, and a JobFailed it raises
+    fails the job with the exception's result. `on_finished(job)` is called
+    after every job. The last `history` finished jobs can still be looked up.
+    """
+
+    def __init__(self, workers=10, max_pending=500, history=1000, run_in_context=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        self._run_in_context = run_in_context or (lambda fn: fn())
+        self._queue = Queue()
+        self._active = {}               # key -> job queued or running
+        self._pending = {}              # job id -> job queued or running
+        self._finished = OrderedDict()  # job id -> finished job, oldest first
+        self._workers = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.on_finished = None
+
+    def submit(self, kind, key, fn):
+        """Queue `fn` as a job, unless one with `key` is already in flight.
+
+        Returns (job, created); (None, False) when the queue is full.
+        """
+        job = self._active.get(key)
+        if job is not None:
+            self.deduplicated += 1
+            return job, False
+        if self._queue.qsize() >= self.max_pending:
+            self.rejected += 1
+            return None, False
+        job = Job(kind, key, fn)
+        self._active[key] = job
+        self._pending[job.id] = job
+        self._enqueue(job)
+        return job, True
+
+    def _enqueue(self, job):
+        self._queue.put(job)
+        self._workers = [worker for worker in self._workers if not worker.dead]
+        if len(self._workers) < min(self.workers, self._queue.qsize() + self.running):
+            self._workers.append(gevent.spawn(self._work))
+
+    def _work(self):
+        while True:
+            self._run(self._queue.get())
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        self.running += 1
+        try:
+            job.result = self._run_in_context(lambda: job.fn(job))
+            job.status = 'done'
+            self.completed += 1
+        except JobFailed as e:
+            job.result = e.result
+            job.status = 'failed'
+            self.failed += 1
+        except Exception:
+            log.error('job_failed', exc_info=True, kind=job.kind, job_id=job.id)
+            job.result = {'error': 'Job failed'}
+            job.status = 'failed'
+            self.failed += 1
+        finally:
+            self.running -= 1
+            job.finished_at = time.time()
+            job.fn = None
+            if self._active.get(job.key) is job:
+                del self._active[job.key]
+            del self._pending[job.id]
+            self._finished[job.id] = job
+            while len(self._finished) > self.history:
+                self._finished.popitem(last=False)
+        if self.on_finished:
+            self.on_finished(job)
+
+    def get(self, job_id):
+        return self._pending.get(job_id) or self._finished.get(job_id)
+
+    def attach(self, key):
+        """The job with `key` that is queued or running, counted as a deduplicated
+        submission, or None. For callers that must check before submitting."""
+        job = self._active.get(key)
+        if job is not None:
+            self.deduplicated += 1
+        return job
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queued': self.depth(),
+            'running': self.running,
+            'workers': len([worker for worker in self._workers if not worker.dead]),
+            'max_workers': self.workers,
+            'max_pending': self.max_pending,
+            'completed': self.completed,
+            'failed': self.failed,
+            'deduplicated': self.deduplicated,
+            'rejected': self.rejected,
+            'finished_kept': len(self._finished)
+        }
+
+
+class InlineJobQueue(JobQueue):
+    """Runs every job in the submitting greenlet, before submit() returns"""
+
+    def _enqueue(self, job):
+        self._run(job)
+
+
+def make_job_queue(url, **options):
+    if not url or url.startswith('pool://'):
+        return JobQueue(**options)
+    if url.startswith('inline://'):
+        return InlineJobQueue(**options)
+    raise ValueError(f"Unsupported job queue URL: {url}")
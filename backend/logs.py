@@ -0,0 +1,100 @@
+"""Leveled, structured logging.
+
+Log lines are an event name plus key=value fields, written as logfmt or,
+with LOG_FORMAT=json, one JSON object per line:
+
+    log = logs.get_logger('toptrack.votes')
+    log.info('song_added', room_id=room_id, track_id=track_id)
+
+Events on the hot path (every vote, join, message) pass `sampled=True`
+and are only written for a `sample_rate` fraction of occurrences; the
+line carries `sample_rate` so counts can be scaled back up. Fields are
+only formatted when the level is enabled, so disabled debug logging
+costs one comparison.
+"""
+from datetime import datetime, timezone
+import json
+import logging
+import random
+import sys
+
+_settings = {'sample_rate': 1.0}
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="\n\t'):
+        return json.dumps(text)
+    return text
+
+
+class LogfmtFormatter(logging.Formatter):
+    def format(self, record):
+        parts = [
+            f'ts={datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds")}',
+            f'level={record.levelname.lower()}',
+            f'logger={record.name}',
+            f'event={_quote(record.getMessage())}'
+        ]
+        parts += [f'{key}={_quote(value)}' for key, value in getattr(record, 'fields', {}).items()]
+        if record.exc_info:
+            parts.append(f'exception={_quote(self.formatException(record.exc_info))}')
+        return ' '.join(parts)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+            **getattr(record, 'fields', {})
+        }
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+def configure(level='INFO', fmt='logfmt', sample_rate=1.0, stream=None):
+    """Send all logging (ours and libraries') to `stream` in the chosen format"""
+    _settings['sample_rate'] = max(0.0, min(1.0, float(sample_rate)))
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JSONFormatter() if fmt == 'json' else LogfmtFormatter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+
+class StructuredLogger:
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+
+    def _log(self, level, event, sampled, exc_info, fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        if sampled:
+            rate = _settings['sample_rate']
+            if rate < 1.0:
+                if random.random() >= rate:
+                    return
+                fields['sample_rate'] = rate
+        self._logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event, sampled=False, **fields):
+        self._log(logging.DEBUG, event, sampled, None, fields)
+
+    def info(self, event, sampled=False, **fields):
+        self._log(logging.INFO, event, sampled, None, fields)
+
+    def warning(self, event, sampled=False, **fields):
+        self._log(logging.WARNING, event, sampled, None, fields)
+
+    def error(self, event, exc_info=False, **fields):
+        self._log(logging.ERROR, event, False, exc_info, fields)
+
+
+def get_logger(name):
+    return StructuredLogger(name)
@@ -0,0 +1,129 @@
+"""In-process metrics rendered in the Prometheus text format.
+
+Counters and histograms are updated on the hot path with a dict lookup and
+an addition; nothing is exported until /api/metrics is scraped. Values
+that components already track (cache hits, Spotify calls, ...) are exposed
+through callbacks evaluated at scrape time instead of being counted twice.
+Each worker process exposes its own numbers; Prometheus adds them up.
+"""
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, key)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.label_names + ('le',)
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(names, key + (_number(float(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(names, key + ("+Inf",))} {series[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {round(series[-2], 6)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, key)} {series[-1]}')
+        return lines
+
+
+class Callback:
+    """A metric read at scrape time: `read()` returns a number, or
+    {label value tuple: number} when the metric has labels"""
+
+    def __init__(self, name, help, kind, read, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        self.label_names = tuple(labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        values = self.read()
+        if not self.label_names:
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, key)} {_number(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, read, kind='gauge', labels=()):
+        return self._register(Callback(name, help, kind, read, labels))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f'# {metric.name} unavailable: {e}')
+        return '\n'.join(lines) + '\n'
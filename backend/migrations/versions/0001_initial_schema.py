@@ -0,0 +1,106 @@
+"""initial schema
+
+The tables as they were created by db.create_all() before migrations were
+introduced. Databases created that way should be stamped with this revision
+(flask db stamp 0001_initial_schema) before running flask db upgrade.
+
+Revision ID: 0001_initial_schema
+Revises: 
+Create Date: 2026-10-18 05:30:04.948628
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_initial_schema'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # room.current_song_id -> song.id is added once song exists (room <-> song cycle)
+    op.create_table('room',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('host_id', sa.String(length=100), nullable=False),
+    sa.Column('is_active', sa.Boolean(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('current_song_id', sa.String(length=36), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('song',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('room_id', sa.String(length=36), nullable=False),
+    sa.Column('title', sa.String(length=200), nullable=False),
+    sa.Column('artist', sa.String(length=200), nullable=False),
+    sa.Column('album', sa.String(length=200), nullable=True),
+    sa.Column('spotify_url', sa.String(length=500), nullable=True),
+    sa.Column('youtube_url', sa.String(length=500), nullable=True),
+    sa.Column('spotify_track_id', sa.String(length=100), nullable=True),
+    sa.Column('duration', sa.Integer(), nullable=True),
+    sa.Column('duration_ms', sa.Integer(), nullable=True),
+    sa.Column('image_url', sa.String(length=500), nullable=True),
+    sa.Column('preview_url', sa.String(length=500), nullable=True),
+    sa.Column('popularity', sa.Integer(), nullable=True),
+    sa.Column('explicit', sa.Boolean(), nullable=True),
+    sa.Column('added_by', sa.String(length=100), nullable=False),
+    sa.Column('added_at', sa.DateTime(), nullable=True),
+    sa.Column('vote_count', sa.Integer(), nullable=True),
+    sa.Column('is_played', sa.Boolean(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['room_id'], ['room.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('room') as batch_op:
+        batch_op.create_foreign_key('fk_room_current_song_id', 'song', ['current_song_id'], ['id'])
+    op.create_table('spotify_token',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('spotify_user_id', sa.String(length=100), nullable=False),
+    sa.Column('access_token', sa.Text(), nullable=False),
+    sa.Column('refresh_token', sa.Text(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('spotify_user_id')
+    )
+    op.create_table('track_metadata',
+    sa.Column('spotify_track_id', sa.String(length=100), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('fetched_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('spotify_track_id')
+    )
+    op.create_table('user',
+    sa.Column('id', sa.String(length=100), nullable=False),
+    sa.Column('username', sa.String(length=50), nullable=False),
+    sa.Column('is_online', sa.Boolean(), nullable=True),
+    sa.Column('current_room_id', sa.String(length=36), nullable=True),
+    sa.Column('joined_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['current_room_id'], ['room.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('vote',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('song_id', sa.String(length=36), nullable=False),
+    sa.Column('room_id', sa.String(length=36), nullable=False),
+    sa.Column('user_id', sa.String(length=100), nullable=False),
+    sa.Column('voted_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['room_id'], ['room.id'], ),
+    sa.ForeignKeyConstraint(['song_id'], ['song.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('song_id', 'user_id', 'room_id', name='unique_vote')
+    )
+
+
+def downgrade():
+    op.drop_table('vote')
+    op.drop_table('user')
+    op.drop_table('track_metadata')
+    op.drop_table('spotify_token')
+    with op.batch_alter_table('room') as batch_op:
+        batch_op.drop_constraint('fk_room_current_song_id', type_='foreignkey')
+    op.drop_table('song')
+    op.drop_table('room')
@@ -0,0 +1,48 @@
+"""hot path indexes for song and vote
+
+Composite indexes for the room queue read, the duplicate-track check and
+the per-user vote lookup. On Postgres the song indexes are partial
+(WHERE is_played = false) so played history does not bloat them.
+Databases whose tables were created by db.create_all() after these indexes
+were declared already have them, so existing indexes are skipped.
+
+Revision ID: 0002_hot_path_indexes
+Revises: 0001_initial_schema
+Create Date: 2026-10-18 05:45:12.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_hot_path_indexes'
+down_revision = '0001_initial_schema'
+branch_labels = None
+depends_on = None
+
+
+UNPLAYED = sa.text('is_played = false')
+
+INDEXES = [
+    ('ix_song_room_queue', 'song', ['room_id', 'is_played', 'vote_count', 'added_at', 'expires_at'], UNPLAYED),
+    ('ix_song_room_track', 'song', ['room_id', 'spotify_track_id', 'is_played'], UNPLAYED),
+    ('ix_vote_room_user', 'vote', ['room_id', 'user_id'], None),
+]
+
+
+def existing_indexes(table):
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    for name, table, columns, where in INDEXES:
+        if name in existing_indexes(table):
+            continue
+        op.create_index(name, table, columns, unique=False, postgresql_where=where)
+
+
+def downgrade():
+    for name, table, _, _ in reversed(INDEXES):
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
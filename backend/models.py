@@ -0,0 +1,124 @@
+"""Database models"""
+from datetime import datetime
+import uuid
+
+from extensions import db
+
+class Room(db.Model):
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    name = db.Column(db.String(100), nullable=False)
+    host_id = db.Column(db.String(100), nullable=False)  # Spotify user ID
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    current_song_id = db.Column(db.String(36), db.ForeignKey('song.id'), nullable=True)
+    current_song_started_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    songs = db.relationship('Song', backref='room', lazy=True, foreign_keys='Song.room_id')
+    
+# Update your Song model to include new fields:
+
+class Song(db.Model):
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    room_id = db.Column(db.String(36), db.ForeignKey('room.id'), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    artist = db.Column(db.String(200), nullable=False)
+    album = db.Column(db.String(200), nullable=True)  # Add this
+    spotify_url = db.Column(db.String(500), nullable=True)
+    youtube_url = db.Column(db.String(500), nullable=True)
+    spotify_track_id = db.Column(db.String(100), nullable=True)
+    duration = db.Column(db.Integer, nullable=True)  # in seconds
+    duration_ms = db.Column(db.Integer, nullable=True)  # Add this - in milliseconds
+    image_url = db.Column(db.String(500), nullable=True)  # Add this
+    preview_url = db.Column(db.String(500), nullable=True)  # Add this
+    popularity = db.Column(db.Integer, nullable=True)  # Add this
+    explicit = db.Column(db.Boolean, default=False, nullable=True)  # Add this
+    added_by = db.Column(db.String(100), nullable=False)
+    added_at = db.Column(db.DateTime, default=datetime.utcnow)
+    vote_count = db.Column(db.Integer, default=0)
+    is_played = db.Column(db.Boolean, default=False)
+    expires_at = db.Column(db.DateTime, nullable=True)
+
+    # Indexes for the hot queries; on Postgres they only cover unplayed songs
+    __table_args__ = (
+        # Room queue: unplayed, unexpired songs by vote_count DESC, added_at DESC
+        db.Index('ix_song_room_queue', 'room_id', 'is_played', 'vote_count', 'added_at', 'expires_at',
+                 postgresql_where=db.text('is_played = false')),
+        # Duplicate check before adding a track to a room
+        db.Index('ix_song_room_track', 'room_id', 'spotify_track_id', 'is_played',
+                 postgresql_where=db.text('is_played = false')),
+        # Sweeper: songs past their expiry
+        db.Index('ix_song_expires_at', 'expires_at'),
+    )
+    
+class Vote(db.Model):
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    song_id = db.Column(db.String(36), db.ForeignKey('song.id'), nullable=False)
+    room_id = db.Column(db.String(36), db.ForeignKey('room.id'), nullable=False)  # Add this line
+    user_id = db.Column(db.String(100), nullable=False)  # user identifier
+    voted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Ensure one vote per user per song per room
+    __table_args__ = (
+        db.UniqueConstraint('song_id', 'user_id', 'room_id', name='unique_vote'),
+        # A user's current vote in a room
+        db.Index('ix_vote_room_user', 'room_id', 'user_id'),
+    )
+
+class User(db.Model):
+    id = db.Column(db.String(100), primary_key=True)  # user identifier (can be session-based)
+    username = db.Column(db.String(50), nullable=False)
+    is_online = db.Column(db.Boolean, default=True)
+    current_room_id = db.Column(db.String(36), db.ForeignKey('room.id'), nullable=True)
+    joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SpotifyToken(db.Model):
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    spotify_user_id = db.Column(db.String(100), unique=True, nullable=False)
+    access_token = db.Column(db.Text, nullable=False)
+    refresh_token = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SongHistory(db.Model):
+    """Compact record of a song swept out of the live song table"""
+    id = db.Column(db.String(36), primary_key=True)  # the original Song.id
+    room_id = db.Column(db.String(36), nullable=False)
+    spotify_track_id = db.Column(db.String(100), nullable=True)
+    title = db.Column(db.String(200), nullable=False)
+    artist = db.Column(db.String(200), nullable=False)
+    added_by = db.Column(db.String(100), nullable=False)
+    added_at = db.Column(db.DateTime, nullable=True)
+    vote_count = db.Column(db.Integer, default=0)
+    is_played = db.Column(db.Boolean, default=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+class TrackMetadata(db.Model):
+    spotify_track_id = db.Column(db.String(100), primary_key=True)
+    data = db.Column(db.Text, nullable=False)  # Spotify track JSON
+    fetched_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+def song_to_dict(song):
+    """Serialize a Song row the way queue and playback events expect it"""
+    return {
+        'id': song.id,
+        'room_id': song.room_id,
+        'title': song.title,
+        'artist': song.artist,
+        'album': song.album,
+        'spotify_url': song.spotify_url,
+        'spotify_track_id': song.spotify_track_id,
+        'duration': song.duration,
+        'duration_ms': song.duration_ms,
+        'image_url': song.image_url,
+        'preview_url': song.preview_url,
+        'popularity': song.popularity,
+        'explicit': song.explicit,
+        'added_by': song.added_by,
+        'added_at': song.added_at.isoformat() if song.added_at else None,
+        'vote_count': song.vote_count,
+        'is_played': song.is_played,
+        'expires_at': song.expires_at.isoformat() if song.expires_at else None,
+        'youtube_url': song.youtube_url
+    }
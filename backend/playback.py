@@ -0,0 +1,199 @@
+"""Server-side playback clock for each room.
+
+The worker that owns a room (see sharding.py) knows which song is playing
+and when it started. It arms a gevent timer for the moment the song ends
+(`duration_ms` plus a small grace period) and advances the queue itself,
+so rooms keep playing without any client asking. Clients are told when the
+song started and how far into it they are, and no longer have to poll
+Spotify to find out.
+
+The clock only runs while somebody listens: the host's player reports
+whether it is playing and where it is in the song, and each report moves
+the room's clock to match. A paused host stops the timer, and a song that
+runs out while the host hasn't reported playing it for `report_timeout`
+seconds (the host left, or nothing is playing) is held until a report
+says otherwise instead of being skipped.
+
+Advancing is keyed by the song being left: "advance past song X" is a
+no-op once X is no longer playing. The timer, the host's player noticing
+the track ended and a skip button pressed twice all name the same song,
+so only the first of them advances.
+"""
+import time
+
+import gevent
+from gevent.lock import Semaphore
+
+import logs
+
+log = logs.get_logger('toptrack.playback')
+
+
+class PlaybackScheduler:
+    """Now-playing state and end-of-song timers per room.
+
+    `loader(room_id)` returns (song dict, started_at epoch seconds) for the
+    song a room is playing according to the database, or None; it is
+    called the first time a room is touched on this worker.
+    `on_song_end(room_id, song_id)` advances a room whose song ran out.
+    `due_rooms()` lists rooms playing a song in the database and runs every
+    `poll_interval` seconds, so rooms this worker takes over (or that were
+    playing when it restarted) get their timers back. `owns(room_id)` says
+    whether this worker should run a room's timer. The callbacks run inside
+    `run_in_context` (e.g. to push an app context). A song ending only
+    advances the room if the host's last report, at most `report_timeout`
+    seconds old, said it was playing that song.
+    """
+
+    def __init__(self, loader, on_song_end, due_rooms, owns=lambda room_id: True, grace=1.0,
+                 poll_interval=10, report_timeout=30, run_in_context=None):
+        self._loader = loader
+        self._on_song_end = on_song_end
+        self._due_rooms = due_rooms
+        self._owns = owns
+        self.grace = grace
+        self.poll_interval = poll_interval
+        self.report_timeout = report_timeout
+        self._run_in_context = run_in_context or (lambda fn: fn())
+        self._rooms = {}   # room_id -> (song dict, started_at) or None when nothing plays
+        self._timers = {}  # room_id -> Greenlet
+        self._reports = {}  # room_id -> (paused, position_ms, reported_at) from the host's player
+        self._locks = {}   # room_id -> Semaphore held while advancing
+        self._worker = None
+        self.songs_ended = 0
+        self.redundant_requests = 0
+        self.songs_held = 0
+        self.stale_reports = 0
+
+    def now_playing(self, room_id):
+        """(song, started_at) playing in the room, or None"""
+        if room_id not in self._rooms:
+            loaded = self._loader(room_id)
+            # The loader may have yielded to a greenlet that set the room meanwhile
+            if room_id not in self._rooms:
+                if loaded is None:
+                    self._rooms[room_id] = None
+                else:
+                    self.play(room_id, *loaded)
+        return self._rooms[room_id]
+
+    def play(self, room_id, song, started_at):
+        """Record `song` (None to stop) as playing since `started_at` and arm its timer"""
+        self._cancel_timer(room_id)
+        # The host hasn't played the new song yet
+        self._reports.pop(room_id, None)
+        if song is None:
+            self._rooms[room_id] = None
+            return
+        self._rooms[room_id] = (song, started_at)
+        self._arm_timer(room_id, song, started_at)
+
+    def report(self, room_id, song_id, paused, position_ms, now=None):
+        """The host's player is `position_ms` into `song_id`, paused or playing.
+
+        Moves the room's clock to the reported position and re-arms its timer,
+        or stops it while paused. Returns False, changing nothing, when the
+        room is playing another song (a report racing an advance).
+        """
+        playing = self.now_playing(room_id)
+        if playing is None or playing[0]['id'] != song_id:
+            self.stale_reports += 1
+            return False
+        now = now or time.time()
+        song = playing[0]
+        self._cancel_timer(room_id)
+        self._reports[room_id] = (paused, position_ms, now)
+        self._rooms[room_id] = (song, now - position_ms / 1000)
+        if not paused:
+            self._arm_timer(room_id, song, now - position_ms / 1000)
+        return True
+
+    def paused(self, room_id):
+        report = self._reports.get(room_id)
+        return report is not None and report[0]
+
+    def host_playing(self, room_id, now=None):
+        """Whether the host recently reported playing the room's song"""
+        report = self._reports.get(room_id)
+        return report is not None and not report[0] and (now or time.time()) - report[2] <= self.report_timeout
+
+    def _arm_timer(self, room_id, song, started_at):
+        if song.get('duration_ms'):
+            delay = max(0.0, started_at + song['duration_ms'] / 1000 + self.grace - time.time())
+            self._timers[room_id] = gevent.spawn_later(delay, self._song_ended, room_id, song['id'])
+
+    def lock(self, room_id):
+        """Semaphore serialising advances of one room"""
+        lock = self._locks.get(room_id)
+        if lock is None:
+            lock = self._locks[room_id] = Semaphore()
+        return lock
+
+    def position_ms(self, room_id, now=None):
+        playing = self._rooms.get(room_id)
+        if playing is None:
+            return None
+        if self.paused(room_id):
+            return self._reports[room_id][1]
+        return max(0, int(((now or time.time()) - playing[1]) * 1000))
+
+    def loaded_rooms(self):
+        return list(self._rooms)
+
+    def forget(self, room_id):
+        """Drop a room, e.g. when it moved to another worker"""
+        self._cancel_timer(room_id)
+        self._rooms.pop(room_id, None)
+        self._reports.pop(room_id, None)
+        lock = self._locks.get(room_id)
+        if lock is not None and not lock.locked():
+            del self._locks[room_id]
+
+    def _cancel_timer(self, room_id):
+        timer = self._timers.pop(room_id, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+
+    def _song_ended(self, room_id, song_id):
+        self._timers.pop(room_id, None)
+        # Nobody is listening: keep the song until the host reports playing it again
+        if not self.host_playing(room_id):
+            self.songs_held += 1
+            log.info('auto_advance_held', room_id=room_id, song_id=song_id, paused=self.paused(room_id))
+            return
+        self.songs_ended += 1
+        try:
+            self._run_in_context(lambda: self._on_song_end(room_id, song_id))
+        except Exception as e:
+            log.error('auto_advance_failed', room_id=room_id, song_id=song_id, error=str(e))
+
+    def start(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            # Sleep first: right after start the worker doesn't know its peers yet
+            gevent.sleep(self.poll_interval)
+            try:
+                self._run_in_context(self.resume_rooms)
+            except Exception as e:
+                log.error('playback_resume_failed', error=str(e))
+
+    def resume_rooms(self):
+        """Pick up timers for playing rooms this worker owns but hasn't loaded"""
+        for room_id in self._due_rooms():
+            if room_id not in self._rooms and self._owns(room_id):
+                self.now_playing(room_id)
+
+    def stats(self):
+        return {
+            'rooms': len(self._rooms),
+            'playing': sum(1 for playing in self._rooms.values() if playing is not None),
+            'timers': len(self._timers),
+            'paused': sum(1 for report in self._reports.values() if report[0]),
+            'songs_ended': self.songs_ended,
+            'songs_held': self.songs_held,
+            'stale_reports': self.stale_reports,
+            'redundant_requests': self.redundant_requests
+        }
@@ -0,0 +1,216 @@
+"""Who is in which room, tracked per Socket.IO session.
+
+Each connection (sid) belongs to one user and may join several rooms; a
+user may have several connections (tabs, devices). The registry keeps the
+membership both ways, so a room's member count is a dict length and a
+disconnect only touches the rooms that sid was in.
+
+Leaving is debounced: when a user's last connection leaves a room, the
+`user_left` event waits `grace` seconds, and a rejoin in that window (a
+page reload or a flaky connection reconnecting) cancels it, so neither
+user_left nor a second user_joined is broadcast. User rows
+(is_online/current_room_id) are written in periodic batches of the users
+whose presence changed, not on every join.
+
+Presence is per worker: with several workers, counts cover the clients
+connected to this one.
+"""
+
+import gevent
+from gevent.lock import Semaphore
+
+import logs
+
+log = logs.get_logger('toptrack.presence')
+
+
+class PresenceRegistry:
+    """Room membership keyed by sid, with debounced leave events.
+
+    `on_joined(room_id, user_id, username)` and `on_left(room_id, user_id)`
+    announce a user arriving in or finally leaving a room.
+    `persist({user_id: (username, room_id or None)})` writes a batch of
+    user presence (None = offline) and runs inside `run_in_context`. When a
+    batch fails its users are written one at a time, and a user whose write
+    keeps failing is dropped after `max_attempts` flushes.
+    """
+
+    def __init__(self, on_joined, on_left, persist, grace=5.0, flush_interval=5.0, run_in_context=None,
+                 max_attempts=3):
+        self._on_joined = on_joined
+        self._on_left = on_left
+        self._persist = persist
+        self.grace = grace
+        self.flush_interval = flush_interval
+        self._run_in_context = run_in_context or (lambda fn: fn())
+        self._sessions = {}   # sid -> [user_id, username, set of room_ids]
+        self._user_sids = {}  # user_id -> set of sids
+        self._rooms = {}      # room_id -> {user_id: number of that user's sids in the room}
+        self._leaving = {}    # (room_id, user_id) -> Greenlet announcing the leave
+        self._dirty = {}      # user_id -> (username, room_id or None) not yet written
+        self._failures = {}   # user_id -> flushes its write has failed in a row
+        self.max_attempts = max_attempts
+        self._flush_lock = Semaphore()
+        self._worker = None
+        self.joins = 0
+        self.quiet_rejoins = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def join(self, sid, room_id, user_id, username=None):
+        """Add a session to a room; returns True when the user is new in the room"""
+        session = self._sessions.get(sid)
+        if session is None or session[0] != user_id:
+            if session is not None:
+                self.disconnect(sid)
+            session = self._sessions[sid] = [user_id, username, set()]
+            self._user_sids.setdefault(user_id, set()).add(sid)
+        if username:
+            session[1] = username
+        if room_id in session[2]:
+            return False
+        session[2].add(room_id)
+        self.joins += 1
+        members = self._rooms.setdefault(room_id, {})
+        members[user_id] = members.get(user_id, 0) + 1
+        self._dirty[user_id] = (session[1], room_id)
+        self._ensure_worker()
+        if members[user_id] > 1:
+            return False
+        pending = self._leaving.pop((room_id, user_id), None)
+        if pending is not None:
+            # Back before the leave was announced: nobody needs to hear about it
+            pending.kill(block=False)
+            self.quiet_rejoins += 1
+            return False
+        self._on_joined(room_id, user_id, session[1])
+        return True
+
+    def leave(self, sid, room_id):
+        session = self._sessions.get(sid)
+        if session is None or room_id not in session[2]:
+            return
+        session[2].discard(room_id)
+        user_id = session[0]
+        members = self._rooms.get(room_id, {})
+        remaining = members.get(user_id, 1) - 1
+        if remaining > 0:
+            members[user_id] = remaining
+            return
+        members.pop(user_id, None)
+        if not members:
+            self._rooms.pop(room_id, None)
+        self._dirty[user_id] = (session[1], self._current_room(user_id))
+        self._ensure_worker()
+        if (room_id, user_id) not in self._leaving:
+            self._leaving[(room_id, user_id)] = gevent.spawn_later(self.grace, self._announce_leave, room_id, user_id)
+
+    def disconnect(self, sid):
+        session = self._sessions.get(sid)
+        if session is None:
+            return
+        for room_id in list(session[2]):
+            self.leave(sid, room_id)
+        del self._sessions[sid]
+        sids = self._user_sids.get(session[0])
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._user_sids[session[0]]
+
+    def _current_room(self, user_id):
+        """A room the user is still in on any connection, or None"""
+        for sid in self._user_sids.get(user_id, ()):
+            rooms = self._sessions[sid][2]
+            if rooms:
+                return next(iter(rooms))
+        return None
+
+    def _announce_leave(self, room_id, user_id):
+        self._leaving.pop((room_id, user_id), None)
+        if user_id in self._rooms.get(room_id, {}):
+            return
+        try:
+            self._on_left(room_id, user_id)
+        except Exception as e:
+            log.error('presence_event_failed', room_id=room_id, user_id=user_id, error=str(e))
+
+    def count(self, room_id):
+        return len(self._rooms.get(room_id, ()))
+
+    def members(self, room_id):
+        return list(self._rooms.get(room_id, ()))
+
+    def room_counts(self):
+        return {room_id: len(members) for room_id, members in self._rooms.items()}
+
+    def rooms_of(self, sid):
+        session = self._sessions.get(sid)
+        return set(session[2]) if session else set()
+
+    def sids_of(self, user_id):
+        return set(self._user_sids.get(user_id, ()))
+
+    def flush(self):
+        """Write the presence of users that changed since the last flush"""
+        with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            try:
+                self._run_in_context(lambda: self._persist(batch))
+            except Exception as e:
+                log.warning('presence_batch_failed', users=len(batch), error=str(e))
+                failed = self._persist_each(batch)
+            else:
+                failed = {}
+            for user_id in batch:
+                if user_id not in failed:
+                    self._failures.pop(user_id, None)
+            for user_id, (change, error) in failed.items():
+                attempts = self._failures.get(user_id, 0) + 1
+                if attempts >= self.max_attempts:
+                    self._failures.pop(user_id, None)
+                    self.dropped += 1
+                    log.error('presence_write_dropped', user_id=user_id, attempts=attempts, error=error)
+                else:
+                    self._failures[user_id] = attempts
+                    # Keep newer changes that arrived meanwhile
+                    self._dirty.setdefault(user_id, change)
+            self.flushes += 1
+            return len(batch) - len(failed)
+
+    def _persist_each(self, batch):
+        """Write users one at a time; returns {user_id: (change, error)} of those that failed"""
+        failed = {}
+        for user_id, change in batch.items():
+            try:
+                self._run_in_context(lambda: self._persist({user_id: change}))
+            except Exception as e:
+                failed[user_id] = (change, str(e))
+        return failed
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error('presence_flush_failed', error=str(e))
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'users': len(self._user_sids),
+            'rooms': len(self._rooms),
+            'pending_leaves': len(self._leaving),
+            'pending_writes': len(self._dirty),
+            'joins': self.joins,
+            'quiet_rejoins': self.quiet_rejoins,
+            'flushes': self.flushes,
+            'dropped_writes': self.dropped
+        }
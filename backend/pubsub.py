@@ -0,0 +1,301 @@
+"""Pluggable pub/sub backends for running Socket.IO on several workers.
+
+Flask-SocketIO keeps room membership per process, so an emit to a room only
+reaches the members connected to the emitting worker. Plugging a
+`BusManager` in as the Socket.IO client manager publishes every emit on a
+message bus; each worker listens on the bus and delivers the emit to its
+own members of the room.
+
+Backends are chosen by URL (SOCKETIO_MESSAGE_QUEUE):
+
+    redis://host:6379/0       Redis pub/sub (needs the `redis` package)
+    unix:///tmp/toptrack-bus  Unix datagram sockets in a directory, for
+                              several workers on one host without Redis
+    local://                  in-process, for tests that run several
+                              Socket.IO servers in one process
+
+Frames on the bus are JSON (`encode_frame`/`decode_frame`), never pickles:
+whoever can write to the bus could otherwise run code in every worker.
+"""
+from datetime import date, datetime
+import glob
+import json
+import os
+import socket
+import stat
+import time
+import uuid
+
+import gevent
+from gevent.queue import Queue
+import socketio
+
+import logs
+from serialization import Encoded
+
+log = logs.get_logger('toptrack.bus')
+
+
+def _tag(value):
+    if isinstance(value, Encoded):
+        return {'$encoded': value.raw}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} cannot be sent on the bus')
+
+
+def _untag(obj):
+    if len(obj) == 1:
+        if '$encoded' in obj:
+            return Encoded(obj['$encoded'])
+        if '$datetime' in obj:
+            return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+def encode_frame(message):
+    """JSON bytes for a bus message; datetimes and pre-encoded songs come back as they went in"""
+    return json.dumps(message, default=_tag, separators=(',', ':')).encode('utf-8')
+
+
+def decode_frame(raw):
+    """The message in a bus frame, or None if it isn't one of ours"""
+    try:
+        message = json.loads(raw, object_hook=_untag)
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class LocalBus:
+    """In-process bus: every subscriber gets its own queue"""
+
+    def __init__(self):
+        self._subscribers = {}  # channel -> [Queue]
+
+    def publish(self, channel, payload):
+        for queue in self._subscribers.get(channel, []):
+            queue.put(payload)
+
+    def subscribe(self, channel):
+        queue = Queue()
+        self._subscribers.setdefault(channel, []).append(queue)
+        try:
+            while True:
+                yield queue.get()
+        finally:
+            self._subscribers[channel].remove(queue)
+
+
+class UnixSocketBus:
+    """Bus over Unix datagram sockets, one socket file per subscriber.
+
+    Publishing sends the payload to every `<channel>.*.sock` in the
+    directory; subscribers that went away are cleaned up when a send to
+    them fails. Payloads must fit in one datagram (a few hundred KB on
+    Linux), which Socket.IO emits comfortably do.
+
+    The kernel queues only a few datagrams per socket (net.unix.max_dgram_qlen,
+    often 10), so a subscriber reads its socket into an in-process queue as
+    fast as it can, and a publisher that still finds the socket full backs
+    off and retries for up to `send_timeout` seconds before dropping.
+
+    The directory is private to the user running the workers (0700); one
+    that belongs to someone else is refused, as they could read and inject
+    frames.
+    """
+
+    def __init__(self, directory, refresh_interval=1.0, send_timeout=2.0):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.send_timeout = send_timeout
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            raise PermissionError(f"Bus directory {directory} must be a directory owned by this user")
+        if stat.S_IMODE(info.st_mode) & 0o077:
+            os.chmod(directory, 0o700)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._peers = {}  # channel -> (listed_at, [paths])
+        self.retried = 0
+        self.dropped = 0
+
+    def _peer_paths(self, channel):
+        listed_at, paths = self._peers.get(channel, (0, []))
+        if time.monotonic() - listed_at > self.refresh_interval:
+            paths = glob.glob(os.path.join(self.directory, f'{channel}.*.sock'))
+            self._peers[channel] = (time.monotonic(), paths)
+        return paths
+
+    def publish(self, channel, payload):
+        for path in list(self._peer_paths(channel)):
+            try:
+                self._send(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Subscriber exited without unlinking its socket
+                self._peers.pop(channel, None)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def _send(self, payload, path):
+        deadline = None
+        delay = 0.001
+        while True:
+            try:
+                self._sender.sendto(payload, path)
+                return
+            except BlockingIOError:
+                # The subscriber's socket is full; poll() can't tell when an
+                # unconnected datagram peer has room again, so back off
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + self.send_timeout
+                    self.retried += 1
+                elif now >= deadline:
+                    self.dropped += 1
+                    log.warning('bus_message_dropped', subscriber=path, waited=self.send_timeout)
+                    return
+                gevent.sleep(delay)
+                delay = min(delay * 2, 0.05)
+
+    def subscribe(self, channel):
+        path = os.path.join(self.directory, f'{channel}.{uuid.uuid4().hex}.sock')
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        self._peers.pop(channel, None)
+        received = Queue()
+
+        def read():
+            while True:
+                received.put(receiver.recv(1 << 20))
+
+        reader = gevent.spawn(read)
+        try:
+            while True:
+                yield received.get()
+        finally:
+            reader.kill()
+            receiver.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class RedisBus:
+    """Redis pub/sub; `redis` is only imported when this backend is used"""
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, payload):
+        self._redis.publish(channel, payload)
+
+    def subscribe(self, channel):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                yield message['data']
+
+
+_local_bus = None
+
+
+def make_bus(url):
+    """Build a bus from a SOCKETIO_MESSAGE_QUEUE URL, or None for a single process"""
+    global _local_bus
+    if not url:
+        return None
+    if url.startswith('local://'):
+        if _local_bus is None:
+            _local_bus = LocalBus()
+        return _local_bus
+    if url.startswith('unix://'):
+        return UnixSocketBus(url[len('unix://'):])
+    if url.startswith(('redis://', 'rediss://', 'unix+redis://')):
+        return RedisBus(url)
+    raise ValueError(f"Unsupported message queue URL: {url}")
+
+
+class FanoutCounter:
+    """Client manager mixin reporting how many local clients each room emit
+    reached to `on_fanout(count)`; emits to a single sid are not reported"""
+    on_fanout = None
+
+    def get_participants(self, namespace, room):
+        count = 0
+        for participant in super().get_participants(namespace, room):
+            count += 1
+            yield participant
+        if self.on_fanout is not None and room not in self.rooms.get(namespace, {}).get(None, ()):
+            self.on_fanout(count)
+
+
+class Backpressure:
+    """Client manager mixin that stops sending `lossy_events` to clients that
+    have more than `max_backlog` packets queued and not yet written out (a
+    slow connection, or a polling client that stopped polling). Those events
+    must be safe to miss; skipped deliveries are reported to
+    `on_drop(event, count)`."""
+    lossy_events = frozenset()
+    max_backlog = 0
+    on_drop = None
+
+    def _skip_slow(self, event, namespace, room, skip_sid):
+        if event not in self.lossy_events or not self.max_backlog or self.server is None:
+            return skip_sid
+        sockets = self.server.eio.sockets
+        slow = []
+        for sid, eio_sid in socketio.BaseManager.get_participants(self, namespace or '/', room):
+            connection = sockets.get(eio_sid)
+            if connection is not None and connection.queue.qsize() > self.max_backlog:
+                slow.append(sid)
+        if not slow:
+            return skip_sid
+        if self.on_drop is not None:
+            self.on_drop(event, len(slow))
+        if skip_sid is None:
+            return slow
+        return (skip_sid if isinstance(skip_sid, list) else [skip_sid]) + slow
+
+
+class LocalManager(Backpressure, FanoutCounter, socketio.BaseManager):
+    """Socket.IO's default single-process client manager, with fan-out reporting"""
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        skip_sid = self._skip_slow(event, namespace, room, skip_sid)
+        return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+
+
+class BusManager(Backpressure, FanoutCounter, socketio.PubSubManager):
+    """Socket.IO client manager that fans emits out over a bus"""
+    name = 'bus'
+
+    def __init__(self, bus, channel='toptrack-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.bus = bus
+
+    def _handle_emit(self, message):
+        # Each worker decides for its own clients which of them are too far behind
+        message['skip_sid'] = self._skip_slow(message['event'], message.get('namespace'),
+                                              message.get('room'), message.get('skip_sid'))
+        return super()._handle_emit(message)
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, encode_frame(data))
+
+    def _listen(self):
+        # Decoded here: PubSubManager would unpickle frames it gets as bytes
+        for payload in self.bus.subscribe(self.channel):
+            message = decode_frame(payload)
+            if message is not None:
+                yield message
+            # Don't starve request greenlets during a broadcast storm
+            gevent.sleep(0)
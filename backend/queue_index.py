@@ -0,0 +1,208 @@
+"""In-memory ranked song queues, one per room.
+
+Each room keeps its unplayed songs in a list sorted by
+(vote_count, added_at, song_id) so the best song is always at the end:
+popping the next song is O(1), a vote change is a bisect remove/insert and
+a top-N read is a slice of the tail. The database stays the source of truth
+for durability; a room's queue is loaded from it once on first access.
+
+Each queue also indexes its songs by Spotify track ID, so duplicate adds are
+rejected without a query, and tracks that are being added right now are
+reserved so concurrent adds of the same track resolve it only once.
+"""
+from bisect import bisect_left, insort
+from datetime import datetime
+import time
+
+
+class RoomQueue:
+    """Ranked queue of unplayed songs for a single room"""
+
+    def __init__(self):
+        self._ranked = []    # sorted keys, best song last
+        self._entries = {}   # song_id -> [key, expires_at, song dict]
+        self._tracks = {}    # spotify_track_id -> song_id
+        self._reserved = {}  # spotify_track_id -> monotonic deadline of an add in flight
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, song_id):
+        return song_id in self._entries
+
+    @staticmethod
+    def _key(song_id, vote_count, added_at):
+        return (vote_count or 0, added_at or datetime.min, song_id)
+
+    def add(self, song, added_at, expires_at=None):
+        """Insert a serialized song dict ranked by its vote_count and added_at"""
+        song_id = song['id']
+        if song_id in self._entries:
+            self.remove(song_id)
+        key = self._key(song_id, song.get('vote_count'), added_at)
+        self._entries[song_id] = [key, expires_at, song]
+        insort(self._ranked, key)
+        track_id = song.get('spotify_track_id')
+        if track_id:
+            self._tracks[track_id] = song_id
+            self._reserved.pop(track_id, None)
+
+    def get(self, song_id):
+        entry = self._entries.get(song_id)
+        return entry[2] if entry else None
+
+    def remove(self, song_id):
+        entry = self._entries.pop(song_id, None)
+        if entry is None:
+            return None
+        index = bisect_left(self._ranked, entry[0])
+        del self._ranked[index]
+        self._forget_track(entry[2])
+        return entry[2]
+
+    def _forget_track(self, song):
+        track_id = song.get('spotify_track_id')
+        if track_id and self._tracks.get(track_id) == song['id']:
+            del self._tracks[track_id]
+
+    def has_track(self, track_id, now=None):
+        """True if the track is queued and has not expired"""
+        song_id = self._tracks.get(track_id)
+        if song_id is None:
+            return False
+        if self._expired(song_id, now or datetime.utcnow()):
+            self.remove(song_id)
+            return False
+        return True
+
+    def reserve(self, track_ids, ttl=30, now=None):
+        """Claim tracks for an add about to happen.
+
+        Returns (reserved, queued, in_flight): the tracks the caller may add
+        now, the ones already queued and the ones another add has claimed.
+        A claim ends when the song is added, on release() or after `ttl`
+        seconds.
+        """
+        now = now or datetime.utcnow()
+        clock = time.monotonic()
+        reserved, queued, in_flight = [], [], []
+        for track_id in track_ids:
+            if self.has_track(track_id, now):
+                queued.append(track_id)
+            elif self._reserved.get(track_id, 0) > clock:
+                in_flight.append(track_id)
+            else:
+                self._reserved[track_id] = clock + ttl
+                reserved.append(track_id)
+        return reserved, queued, in_flight
+
+    def release(self, track_ids):
+        for track_id in track_ids:
+            self._reserved.pop(track_id, None)
+
+    def set_votes(self, song_id, vote_count):
+        """Move a song to its new rank after its vote count changed"""
+        entry = self._entries.get(song_id)
+        if entry is None:
+            return None
+        old_key = entry[0]
+        if old_key[0] == vote_count:
+            return entry[2]
+        del self._ranked[bisect_left(self._ranked, old_key)]
+        entry[0] = (vote_count, old_key[1], old_key[2])
+        insort(self._ranked, entry[0])
+        entry[2]['vote_count'] = vote_count
+        return entry[2]
+
+    def playable(self, song_id, now=None):
+        """True if the song is queued and has not expired"""
+        return song_id in self._entries and not self._expired(song_id, now or datetime.utcnow())
+
+    def _expired(self, song_id, now):
+        expires_at = self._entries[song_id][1]
+        return expires_at is not None and expires_at <= now
+
+    def pop(self, now=None):
+        """Remove and return the highest ranked song that has not expired"""
+        now = now or datetime.utcnow()
+        while self._ranked:
+            key = self._ranked.pop()
+            entry = self._entries.pop(key[2])
+            self._forget_track(entry[2])
+            if entry[1] is None or entry[1] > now:
+                return entry[2]
+        return None
+
+    def top(self, limit=10, now=None):
+        """Return up to `limit` songs in play order, dropping expired ones"""
+        now = now or datetime.utcnow()
+        songs = []
+        index = len(self._ranked) - 1
+        while index >= 0 and len(songs) < limit:
+            song_id = self._ranked[index][2]
+            if self._expired(song_id, now):
+                self.remove(song_id)
+            else:
+                songs.append(self._entries[song_id][2])
+            index -= 1
+        return songs
+
+
+class QueueIndex:
+    """Lazily built RoomQueue per room.
+
+    `loader(room_id)` must yield (song dict, added_at, expires_at) for the
+    room's unplayed, unexpired songs; it is only called the first time a
+    room is touched.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._rooms = {}
+
+    def room(self, room_id):
+        queue = self._rooms.get(room_id)
+        if queue is None:
+            queue = RoomQueue()
+            for song, added_at, expires_at in self._loader(room_id):
+                queue.add(song, added_at, expires_at)
+            # The loader may yield to other greenlets; keep whichever won
+            queue = self._rooms.setdefault(room_id, queue)
+        return queue
+
+    def is_loaded(self, room_id):
+        return room_id in self._rooms
+
+    def loaded_rooms(self):
+        return list(self._rooms)
+
+    def add(self, room_id, song, added_at, expires_at=None):
+        # An unloaded room will pick the song up from the database on first read
+        if room_id in self._rooms:
+            self._rooms[room_id].add(song, added_at, expires_at)
+
+    def set_votes(self, room_id, song_id, vote_count):
+        if room_id in self._rooms:
+            return self._rooms[room_id].set_votes(song_id, vote_count)
+        return None
+
+    def remove(self, room_id, song_id):
+        if room_id in self._rooms:
+            return self._rooms[room_id].remove(song_id)
+        return None
+
+    def pop(self, room_id, now=None):
+        return self.room(room_id).pop(now)
+
+    def top(self, room_id, limit=10, now=None):
+        return self.room(room_id).top(limit, now)
+
+    def reserve_tracks(self, room_id, track_ids, ttl=30):
+        return self.room(room_id).reserve(track_ids, ttl)
+
+    def release_tracks(self, room_id, track_ids):
+        if room_id in self._rooms:
+            self._rooms[room_id].release(track_ids)
+
+    def discard(self, room_id):
+        self._rooms.pop(room_id, None)
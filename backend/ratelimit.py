@@ -0,0 +1,161 @@
+"""Token bucket rate limiting.
+
+Each (action, user, room) gets a bucket that holds up to `burst` tokens
+and refills at `rate` tokens per second; an action is allowed when its
+bucket has a token to spend. A rejected caller is told how long until it
+would have one. Callers that name their own user id are also limited by
+their address (RateLimiter.check_client).
+
+Buckets live in a store chosen by URL (RATE_LIMIT_STORE):
+
+    memory://                 in this process; each worker limits on its own
+    redis://host:6379/0       in Redis, shared by every worker (needs the
+                              `redis` package)
+"""
+from collections import OrderedDict
+import time
+
+import logs
+
+log = logs.get_logger('toptrack.ratelimit')
+
+
+class MemoryStore:
+    """Buckets in this process. Idle buckets refill to full, so only the most
+    recently used `max_keys` are kept and older ones are simply dropped."""
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()  # key -> [tokens, time of last refill]
+
+    def take(self, key, rate, burst, cost=1.0):
+        """Spend `cost` tokens; returns 0.0, or the seconds until they would be there"""
+        now = self._clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(burst), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        if bucket[0] < cost:
+            return (cost - bucket[0]) / rate
+        bucket[0] -= cost
+        return 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisStore:
+    """Buckets in Redis: one script call per check, shared by every worker"""
+
+    # Returned as a string: Lua numbers come back from Redis as truncated integers
+    SCRIPT = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens < cost then wait = (cost - tokens) / rate else tokens = tokens - cost end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url, prefix='toptrack:ratelimit:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, cost=1.0):
+        name = self.prefix + ':'.join('' if part is None else str(part) for part in key)
+        return float(self._script(keys=[name], args=[rate, burst, cost, time.time()]))
+
+    def __len__(self):
+        return 0
+
+
+def make_store(url):
+    if not url or url.startswith('memory://'):
+        return MemoryStore()
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisStore(url)
+    raise ValueError(f"Unsupported rate limit store URL: {url}")
+
+
+def parse_limits(spec):
+    """{'action': (rate, burst)} from 'action=rate/burst,...'; rates and bursts must be positive"""
+    limits = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        action, _, value = item.partition('=')
+        rate, _, burst = value.partition('/')
+        rate, burst = float(rate), float(burst or rate)
+        if not rate > 0 or not burst > 0:
+            raise ValueError(f"Rate limit '{item.strip()}' needs a rate and burst above 0; "
+                             "leave the action out of RATE_LIMITS to not limit it")
+        limits[action.strip()] = (rate, burst)
+    return limits
+
+
+class RateLimiter:
+    """Per-action token buckets keyed by (action, user, room).
+
+    Actions without a limit are always allowed. If the store fails (Redis
+    down), checks are let through rather than failing every request.
+    `address_factor` scales the limits for the bucket each client address
+    gets on top of its users' buckets (see check_client).
+    """
+
+    def __init__(self, limits, store=None, address_factor=10):
+        self.limits = dict(limits)
+        self.store = store or MemoryStore()
+        self.address_factor = address_factor
+        self.allowed = 0
+        self.rejected = {}  # action -> count
+
+    def check(self, action, user_id, room_id=None, cost=1.0, scale=1.0):
+        """0.0 when the action is allowed now, otherwise the seconds to wait"""
+        limit = self.limits.get(action)
+        if limit is None:
+            return 0.0
+        try:
+            wait = self.store.take((action, user_id, room_id), limit[0] * scale, limit[1] * scale, cost)
+        except Exception as e:
+            log.warning('rate_limit_store_failed', action=action, error=str(e))
+            return 0.0
+        if wait:
+            self.rejected[action] = self.rejected.get(action, 0) + 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def check_client(self, action, user_id, address, room_id=None):
+        """check() for a user id the client names itself, coming from `address`.
+
+        The user's bucket is kept per address, so naming someone else's user
+        id doesn't spend their tokens, and the address has a bucket of its own
+        (`address_factor` times the limit, across rooms), so making up a new
+        user id for every request doesn't get around the limit.
+        """
+        wait = self.check(action, f"{user_id or ''}@{address}", room_id)
+        if wait:
+            return wait
+        return self.check(action, address, None, scale=self.address_factor)
+
+    def stats(self):
+        return {
+            'address_factor': self.address_factor,
+            'limits': {action: {'rate': rate, 'burst': burst} for action, (rate, burst) in self.limits.items()},
+            'store': type(self.store).__name__,
+            'keys': len(self.store),
+            'allowed': self.allowed,
+            'rejected': dict(self.rejected)
+        }
@@ -0,0 +1,541 @@
+"""Room state and the operations on it.
+
+Each room's queue, vote tallies, playback clock and chat live in memory on
+the worker that owns the room (see sharding.py); votes and presence are
+written behind in batches and expired songs are swept in the background.
+The stateful parts are set up by init_app(app, message_bus).
+"""
+from datetime import datetime, timedelta
+import atexit
+import time
+
+from flask import current_app
+import gevent
+from sqlalchemy.exc import DataError, IntegrityError
+
+from extensions import db, socketio, app_context_runner
+from models import Room, Song, Vote, User, SongHistory, song_to_dict
+from queue_index import QueueIndex
+from vote_buffer import VoteBuffer
+from broadcaster import VoteBroadcaster
+from serialization import SongPayloadCache
+from sweeper import Sweeper
+from sharding import ShardCoordinator, ShardUnavailable, default_worker_id
+from playback import PlaybackScheduler
+from presence import PresenceRegistry
+from chat import ChatRelay
+import logs
+
+log = logs.get_logger('toptrack.rooms')
+
+# Set up by init_app()
+vote_buffer = None
+vote_broadcaster = None
+chat = None
+sweeper = None
+presence = None
+shard = None
+playback = None
+
+
+def load_room_queue(room_id):
+    """Load a room's playable songs for the in-memory queue index"""
+    now = datetime.utcnow()
+    songs = Song.query.filter_by(room_id=room_id, is_played=False)
+    songs = songs.filter((Song.expires_at == None) | (Song.expires_at > now))
+    return [(song_to_dict(song), song.added_at, song.expires_at) for song in songs.all()]
+
+# Each song's JSON is built once and reused until its votes or played flag change
+song_payloads = SongPayloadCache()
+
+# Ranked per-room queues served from memory; the DB is only read on first access
+queue_index = QueueIndex(load_room_queue)
+
+def load_room_votes(room_id):
+    """Load the persisted one-vote-per-user ballots of a room, on songs still to be played"""
+    votes = (db.session.query(Vote.user_id, Vote.song_id)
+             .join(Song, Song.id == Vote.song_id)
+             .filter(Vote.room_id == room_id, Song.is_played == False)  # noqa: E712
+             .all())
+    return {user_id: song_id for user_id, song_id in votes}
+
+def insert_votes_ignoring_duplicates():
+    """INSERT into vote that skips rows already present under unique_vote"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return Vote.__table__.insert()
+    return insert(Vote.__table__).on_conflict_do_nothing(index_elements=['song_id', 'user_id', 'room_id'])
+
+def flush_votes(changes):
+    """Persist a batch of ballot changes and vote_count deltas in one transaction.
+
+    Runs a fixed number of set-based statements whatever the batch size: one
+    delete of the moved/withdrawn votes, one insert of the new ones (a no-op
+    for votes already stored, so a retried batch can't double count), one
+    delete of any of those on songs that have been played since, and one
+    UPDATE ... SET vote_count = vote_count + delta for every touched song.
+    Returns {song_id: (room_id, vote_count)} as stored, when the database
+    supports UPDATE ... RETURNING.
+    """
+    deltas = {}
+    removed = []
+    added = []
+    for (room_id, user_id), (old_song_id, new_song_id) in changes.items():
+        if old_song_id:
+            removed.append({'b_room_id': room_id, 'b_user_id': user_id, 'b_song_id': old_song_id})
+            deltas[old_song_id] = deltas.get(old_song_id, 0) - 1
+        if new_song_id:
+            added.append({'song_id': new_song_id, 'room_id': room_id, 'user_id': user_id})
+            deltas[new_song_id] = deltas.get(new_song_id, 0) + 1
+    deltas = {song_id: delta for song_id, delta in deltas.items() if delta}
+
+    vote_table = Vote.__table__
+    song_table = Song.__table__
+    counts = {}
+    try:
+        if removed:
+            db.session.execute(
+                vote_table.delete().where(
+                    (vote_table.c.song_id == db.bindparam('b_song_id')) &
+                    (vote_table.c.user_id == db.bindparam('b_user_id')) &
+                    (vote_table.c.room_id == db.bindparam('b_room_id'))),
+                removed)
+        if added:
+            db.session.execute(insert_votes_ignoring_duplicates(), added)
+            # A song that started playing while this batch was in flight keeps no votes
+            played = db.select(song_table.c.id).where(song_table.c.id.in_({row['song_id'] for row in added}),
+                                                      song_table.c.is_played == True)  # noqa: E712
+            db.session.execute(vote_table.delete().where(vote_table.c.song_id.in_(played)))
+        if deltas:
+            update = (song_table.update()
+                      .where(song_table.c.id.in_(list(deltas)))
+                      .values(vote_count=song_table.c.vote_count +
+                              db.case(deltas, value=song_table.c.id, else_=0)))
+            if db.engine.dialect.update_returning:
+                result = db.session.execute(update.returning(
+                    song_table.c.id, song_table.c.room_id, song_table.c.vote_count))
+                counts = {song_id: (room_id, vote_count) for song_id, room_id, vote_count in result}
+            else:
+                db.session.execute(update)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    log.debug('votes_flushed', changes=len(changes), songs=len(deltas))
+    return counts
+
+def reconcile_vote_count(room_id, song_id, vote_count):
+    """Correct an in-memory vote count that disagrees with the stored one
+    (e.g. another worker wrote votes for the room with ROOM_SHARDING off)"""
+    if not queue_index.is_loaded(room_id) or not shard.is_local(room_id):
+        return
+    song = queue_index.room(room_id).get(song_id)
+    if song is not None and song['vote_count'] != vote_count:
+        queue_index.set_votes(room_id, song_id, vote_count)
+        vote_broadcaster.song_voted(room_id, song_id, vote_count)
+
+
+def sweep_songs_batch(limit):
+    """Archive or delete one batch of expired songs and their votes; returns (songs, counters)"""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['SWEEP_GRACE'])
+    playing = db.session.query(Room.current_song_id).filter(Room.current_song_id != None)
+    song_ids = [row.id for row in Song.query.with_entities(Song.id).filter(
+        (Song.expires_at < cutoff) | ((Song.expires_at == None) & (Song.is_played == True) & (Song.added_at < cutoff)),
+        ~Song.id.in_(playing)
+    ).limit(limit).all()]
+    if not song_ids:
+        return 0, {}
+
+    song_table = Song.__table__
+    try:
+        if current_app.config['SWEEP_MODE'] == 'archive':
+            columns = ['id', 'room_id', 'spotify_track_id', 'title', 'artist', 'added_by', 'added_at', 'vote_count', 'is_played']
+            db.session.execute(SongHistory.__table__.insert().from_select(
+                columns + ['archived_at'],
+                db.select(*[song_table.c[name] for name in columns], db.literal(datetime.utcnow(), db.DateTime))
+                .where(song_table.c.id.in_(song_ids))))
+        votes = db.session.execute(Vote.__table__.delete().where(Vote.__table__.c.song_id.in_(song_ids))).rowcount
+        db.session.execute(song_table.delete().where(song_table.c.id.in_(song_ids)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    outcome = 'songs_archived' if current_app.config['SWEEP_MODE'] == 'archive' else 'songs_deleted'
+    return len(song_ids), {'votes_deleted': votes, outcome: len(song_ids)}
+
+def prune_history_batch(limit):
+    """Delete one batch of song_history rows past HISTORY_RETENTION_DAYS; returns (rows, {})"""
+    days = current_app.config['HISTORY_RETENTION_DAYS']
+    if days <= 0:
+        return 0, {}
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    history_ids = [row.id for row in SongHistory.query.with_entities(SongHistory.id)
+                   .filter(SongHistory.archived_at < cutoff).limit(limit).all()]
+    if history_ids:
+        SongHistory.query.filter(SongHistory.id.in_(history_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    return len(history_ids), {}
+
+def persist_presence(changes):
+    """Write a batch of {user_id: (username, room_id or None)} to the user table in one transaction"""
+    user_table = User.__table__
+    now = datetime.utcnow()
+    room_ids = {room_id for _, room_id in changes.values() if room_id}
+    known_rooms = {row.id for row in Room.query.with_entities(Room.id).filter(Room.id.in_(room_ids))} if room_ids else set()
+    existing = {row.id for row in User.query.with_entities(User.id).filter(User.id.in_(list(changes)))}
+    inserts, updates = [], []
+    for user_id, (username, room_id) in changes.items():
+        room_id = room_id if room_id in known_rooms else None
+        row = {'is_online': room_id is not None, 'current_room_id': room_id,
+               'username': str(username or user_id)[:User.username.type.length]}
+        if user_id in existing:
+            updates.append(dict(row, b_id=user_id))
+        else:
+            inserts.append(dict(row, id=user_id, joined_at=now))
+    try:
+        if inserts:
+            db.session.execute(user_table.insert(), inserts)
+        if updates:
+            db.session.execute(user_table.update().where(user_table.c.id == db.bindparam('b_id')), updates)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def announce_join(room_id, user_id, username):
+    socketio.emit('user_joined', {'user_id': user_id, 'username': username, 'room_id': room_id,
+                                  'member_count': presence.count(room_id)}, room=room_id)
+
+def announce_leave(room_id, user_id):
+    socketio.emit('user_left', {'user_id': user_id, 'room_id': room_id,
+                                'member_count': presence.count(room_id)}, room=room_id)
+
+# Room operations. Each runs on the worker that owns the room (see sharding.py):
+# called directly when that is this worker, otherwise forwarded over the bus,
+# so they take plain payloads and emit through socketio rather than the request.
+
+def queue_songs(payload):
+    room_id = payload['room_id']
+    for song, added_at, expires_at in payload['songs']:
+        queue_index.add(room_id, song, added_at, expires_at)
+    songs = payload['encoded']
+    if payload['event'] == 'song_added':
+        event = {'song': songs[0], 'message': payload['message']}
+        if payload.get('job_id'):
+            event['job_id'] = payload['job_id']
+        vote_broadcaster.record(room_id, 'song_added', event)
+    else:
+        vote_broadcaster.record(room_id, 'songs_added', {'songs': songs, 'message': payload['message']})
+
+def reserve_room_tracks(payload):
+    return queue_index.reserve_tracks(payload['room_id'], payload['track_ids'],
+                                      current_app.config['ADD_RESERVATION_TTL'])
+
+def release_room_tracks(payload):
+    queue_index.release_tracks(payload['room_id'], payload['track_ids'])
+
+def fits(value, column):
+    """Whether `value` is a non-empty string the column can store"""
+    return isinstance(value, str) and 0 < len(value) <= column.type.length
+
+def valid_vote(payload):
+    return (fits(payload.get('room_id'), Vote.room_id) and fits(payload.get('song_id'), Vote.song_id)
+            and fits(payload.get('user_id'), Vote.user_id))
+
+def vote_on_song(payload):
+    room_id = payload.get('room_id')
+    song_id = payload.get('song_id')
+    user_id = payload.get('user_id')
+    vote_type = payload.get('vote_type', 'up')  # 'up' or 'down'
+
+    # A vote that couldn't be stored would hold up every vote flushed with it
+    if not valid_vote(payload):
+        log.debug('vote_invalid', sampled=True, room_id=room_id, user_id=user_id, song_id=song_id)
+        return
+
+    queue = queue_index.room(room_id)
+    # Only allow one vote per user per room; voting again for the same song
+    # toggles the vote off, voting for another song moves it there
+    if not queue.playable(song_id) and vote_buffer.current_vote(room_id, user_id) != song_id:
+        log.debug('vote_ignored', sampled=True, room_id=room_id, user_id=user_id, song_id=song_id)
+        return
+
+    for changed_song_id, delta in vote_buffer.vote(room_id, user_id, song_id):
+        song = queue.get(changed_song_id)
+        vote_count = max(0, song['vote_count'] + delta) if song else 0
+        if song:
+            queue.set_votes(changed_song_id, vote_count)
+        log.debug('vote', sampled=True, room_id=room_id, user_id=user_id, song_id=changed_song_id,
+                  vote_type='removed' if delta < 0 else vote_type, vote_count=vote_count)
+        # The voter gets an immediate ack; the room gets the coalesced queue_delta
+        socketio.emit('song_voted', {'user_id': user_id, 'room_id': room_id, 'song_id': changed_song_id, 'vote_type': 'removed' if delta < 0 else vote_type, 'vote_count': vote_count}, to=payload['sid'])
+        vote_broadcaster.song_voted(room_id, changed_song_id, vote_count)
+
+def advance_queue(payload):
+    """Move a room on to its top ranked song and broadcast it.
+
+    `current_song_id` names the song being advanced past. If that is no
+    longer playing, another client or the song-end timer got there first:
+    nothing changes and the requester is just told what is playing. Requests
+    that don't name a song are ignored for ADVANCE_DEBOUNCE seconds after a
+    song started.
+    """
+    room_id = payload.get('room_id')
+    with playback.lock(room_id):
+        playing = playback.now_playing(room_id)
+        playing_id = playing[0]['id'] if playing else None
+        if 'current_song_id' in payload:
+            redundant = payload['current_song_id'] != playing_id
+        else:
+            redundant = playing is not None and time.time() - playing[1] < current_app.config['ADVANCE_DEBOUNCE']
+        if not redundant:
+            # The top ranked, unexpired song from the in-memory queue
+            upcoming = queue_index.top(room_id, 1)
+            next_song = upcoming[0] if upcoming else None
+            started_at = time.time()
+            if next_song:
+                Song.query.filter_by(id=next_song['id']).update({'is_played': True})
+                # Ballots on a played song are spent, as vote_buffer.forget_song drops them
+                Vote.query.filter_by(song_id=next_song['id']).delete(synchronize_session=False)
+            # Only advance from the song we think is playing, so a worker with a
+            # stale view of the room can't advance it twice
+            advanced = Room.query.filter(Room.id == room_id, Room.current_song_id == playing_id).update({
+                'current_song_id': next_song['id'] if next_song else None,
+                'current_song_started_at': datetime.utcfromtimestamp(started_at) if next_song else None
+            }, synchronize_session=False)
+            if advanced:
+                db.session.commit()
+            else:
+                db.session.rollback()
+                playback.forget(room_id)
+                redundant = True
+        if redundant:
+            playback.redundant_requests += 1
+            if payload.get('sid'):
+                socketio.emit('next_song', now_playing_payload(room_id), to=payload['sid'])
+            return
+
+        if playing_id:
+            song_payloads.discard(playing_id)
+        if next_song:
+            queue_index.remove(room_id, next_song['id'])
+            next_song['is_played'] = True
+            vote_buffer.forget_song(room_id, next_song['id'])
+            log.info('next_song', room_id=room_id, song_id=next_song['id'])
+        else:
+            log.info('queue_empty', room_id=room_id)
+        playback.play(room_id, next_song, started_at)
+        socketio.emit('next_song', now_playing_payload(room_id), room=room_id)
+        if next_song:
+            vote_broadcaster.record(room_id, 'song_removed', {'song_id': next_song['id']})
+
+def now_playing_payload(room_id):
+    """next_song payload: the playing song, when it started and how far in it is,
+    against the server clock (ms since the epoch)"""
+    now = time.time()
+    playing = playback.now_playing(room_id)
+    if playing is None:
+        return {'room_id': room_id, 'current_song': None, 'server_time': int(now * 1000)}
+    song, started_at = playing
+    return {
+        'room_id': room_id,
+        'current_song': song_payloads.encode(song),
+        'started_at': int(started_at * 1000),
+        'position_ms': playback.position_ms(room_id, now),
+        'paused': playback.paused(room_id),
+        'server_time': int(now * 1000)
+    }
+
+def report_playback(payload):
+    """The host's player says where it is in the room's song"""
+    if not playback.report(payload['room_id'], payload['song_id'], payload['paused'], payload['position_ms']):
+        log.debug('playback_report_stale', room_id=payload['room_id'], song_id=payload['song_id'])
+
+def send_now_playing(payload):
+    """Tell a client that just joined what the room is playing"""
+    socketio.emit('next_song', now_playing_payload(payload['room_id']), to=payload['sid'])
+
+def load_now_playing(room_id):
+    """(song dict, started_at epoch seconds) a room is playing according to the database"""
+    room = Room.query.with_entities(Room.current_song_id, Room.current_song_started_at).filter_by(id=room_id).first()
+    if room is None or room.current_song_id is None:
+        return None
+    song = Song.query.get(room.current_song_id)
+    if song is None:
+        return None
+    started_at = room.current_song_started_at or datetime.utcnow()
+    return song_to_dict(song), (started_at - datetime(1970, 1, 1)).total_seconds()
+
+def playing_room_ids():
+    return [row.id for row in Room.query.with_entities(Room.id).filter(
+        Room.current_song_id != None, Room.is_active == True).all()]
+
+def read_queue(payload):
+    room_id = payload['room_id']
+    return vote_broadcaster.snapshot(
+        room_id, lambda limit: [song_payloads.encode(song) for song in queue_index.top(room_id, limit)],
+        payload.get('limit', 10))
+
+def sync_queue(payload):
+    """Catch a reconnecting client up from the version it last saw"""
+    room_id = payload['room_id']
+    deltas = vote_broadcaster.since(room_id, payload.get('queue_version'), payload.get('queue_epoch'))
+    if deltas is not None:
+        socketio.emit('queue_sync', {'room_id': room_id, 'version': vote_broadcaster.version(room_id),
+                                     'epoch': vote_broadcaster.epoch, 'deltas': deltas}, to=payload['sid'])
+    else:
+        socketio.emit('queue_sync', read_queue(payload), to=payload['sid'])
+
+def post_chat_message(payload):
+    chat.post(payload['room_id'], payload['message'])
+
+def send_chat_history(payload):
+    """Send a client the room's recent messages in one frame"""
+    history = chat.recent(payload['room_id'])
+    if history['messages'] or payload.get('always'):
+        socketio.emit('chat_history', history, to=payload['sid'])
+
+def release_rooms(room_ids):
+    """Persist, then drop, the in-memory state of rooms that moved to another worker"""
+    for room_id in room_ids:
+        playback.forget(room_id)
+        chat.forget(room_id)
+        vote_broadcaster.forget(room_id)
+        vote_buffer.forget_room(room_id)
+        queue_index.discard(room_id)
+    log.info('rooms_released', count=len(room_ids))
+
+def reserve_tracks(room_id, track_ids):
+    """Claim tracks for adding; returns (reserved, queued, in_flight) track ID lists"""
+    try:
+        result = shard.call('reserve_tracks', room_id, {'room_id': room_id, 'track_ids': track_ids})
+    except (gevent.Timeout, ShardUnavailable):
+        result = None
+    if result is not None:
+        return result
+    # The owner did not answer: check the database instead, without a claim
+    queued = {row.spotify_track_id for row in Song.query.with_entities(Song.spotify_track_id).filter(
+        Song.room_id == room_id,
+        Song.is_played == False,
+        Song.spotify_track_id.in_(track_ids)
+    ).all()}
+    return [t for t in track_ids if t not in queued], [t for t in track_ids if t in queued], []
+
+def release_tracks(room_id, track_ids):
+    if track_ids:
+        shard.run('release_tracks', room_id, {'room_id': room_id, 'track_ids': track_ids})
+
+def index_songs(room_id, songs, event, message, job_id=None):
+    """Add freshly committed songs to the room's queue on its owner, which broadcasts `event`.
+
+    Returns the encoded songs so the HTTP response reuses what was broadcast,
+    or None when the owner could not take them; `job_id` goes out with the
+    event when a background job added the songs.
+    """
+    dicts = [song_to_dict(song) for song in songs]
+    encoded = [song_payloads.encode(song) for song in dicts]
+    indexed = shard.run('queue_songs', room_id, {
+        'room_id': room_id,
+        'songs': [(song, model.added_at, model.expires_at) for song, model in zip(dicts, songs)],
+        'encoded': encoded,
+        'event': event,
+        'message': message,
+        'job_id': job_id
+    })
+    return encoded if indexed else None
+
+
+def start_background_workers():
+    sweeper.start()
+    shard.start()
+    playback.start()
+
+
+@atexit.register
+def flush_on_exit():
+    """Don't lose buffered votes and presence writes on a graceful shutdown.
+
+    Registered once, for whichever buffers the last init_app() built.
+    """
+    if vote_buffer is not None:
+        vote_buffer.flush()
+    if presence is not None:
+        presence.flush()
+
+
+def reset_worker_id(worker_id):
+    """Take a new worker id, e.g. in a worker forked from a preloaded app, unless
+    this process already started its background workers under the old one.
+
+    Queue versions and chat seqs are numbered per epoch, so they change with it.
+    """
+    if shard.reset_worker_id(worker_id):
+        vote_broadcaster.epoch = worker_id
+        chat.epoch = worker_id
+
+
+def init_app(app, message_bus=None):
+    global vote_buffer, vote_broadcaster, chat, sweeper, presence, shard, playback
+    config = app.config
+    run_in_app_context = app_context_runner(app)
+    worker_id = config['WORKER_ID'] or default_worker_id()
+
+    vote_buffer = VoteBuffer(load_room_votes, lambda changes: run_in_app_context(lambda: flush_votes(changes)),
+                             flush_interval=config['VOTE_FLUSH_INTERVAL'],
+                             max_batch=config['VOTE_FLUSH_BATCH'],
+                             on_persisted=reconcile_vote_count,
+                             rejected=(IntegrityError, DataError))
+
+    vote_broadcaster = VoteBroadcaster(
+        lambda event, payload, room_id: socketio.emit(event, payload, room=room_id),
+        window=config['VOTE_BROADCAST_WINDOW'],
+        epoch=worker_id,
+        history=config['QUEUE_HISTORY_SIZE'])
+
+    chat = ChatRelay(
+        lambda event, payload, room_id: socketio.emit(event, payload, room=room_id),
+        window=config['CHAT_BATCH_WINDOW'],
+        history=config['CHAT_HISTORY_SIZE'],
+        epoch=worker_id)
+
+    sweeper = Sweeper(sweep_songs_batch, prune_history_batch,
+                      interval=config['SWEEP_INTERVAL'],
+                      batch_size=config['SWEEP_BATCH'],
+                      run_in_context=run_in_app_context)
+
+    # Socket.IO sessions per room on this worker, with debounced join/leave events
+    presence = PresenceRegistry(announce_join, announce_leave, persist_presence,
+                                grace=config['PRESENCE_GRACE'],
+                                flush_interval=config['PRESENCE_FLUSH_INTERVAL'],
+                                run_in_context=run_in_app_context)
+
+    shard = ShardCoordinator(message_bus if config['ROOM_SHARDING'] else None,
+                             {'queue_songs': queue_songs, 'vote_song': vote_on_song,
+                              'get_next_song': advance_queue, 'read_queue': read_queue,
+                              'sync_queue': sync_queue, 'reserve_tracks': reserve_room_tracks,
+                              'release_tracks': release_room_tracks, 'now_playing': send_now_playing,
+                              'playback_state': report_playback,
+                              'chat': post_chat_message, 'chat_history': send_chat_history},
+                             worker_id=worker_id,
+                             heartbeat_interval=config['SHARD_HEARTBEAT_INTERVAL'],
+                             worker_timeout=config['SHARD_WORKER_TIMEOUT'],
+                             call_timeout=config['SHARD_CALL_TIMEOUT'],
+                             settle_time=config['SHARD_SETTLE_TIME'],
+                             loaded_rooms=lambda: (set(queue_index.loaded_rooms()) | set(vote_buffer.loaded_rooms())
+                                                   | set(playback.loaded_rooms()) | set(chat.loaded_rooms())),
+                             on_rooms_lost=release_rooms,
+                             run_in_context=run_in_app_context)
+
+    # Each room's owner advances it when the playing song ends, while the host plays it
+    playback = PlaybackScheduler(load_now_playing,
+                                 lambda room_id, song_id: advance_queue({'room_id': room_id, 'current_song_id': song_id}),
+                                 playing_room_ids,
+                                 owns=shard.is_local,
+                                 grace=config['PLAYBACK_GRACE'],
+                                 poll_interval=config['PLAYBACK_POLL_INTERVAL'],
+                                 report_timeout=config['PLAYBACK_REPORT_TIMEOUT'],
+                                 run_in_context=run_in_app_context)
@@ -0,0 +1,673 @@
+"""REST API"""
+from datetime import datetime, timedelta
+import functools
+import hmac
+import ipaddress
+import math
+import time
+
+from flask import Blueprint, current_app, g, jsonify, make_response, redirect, request
+import gevent
+import requests
+
+from extensions import db, socketio, metrics, http_latency, db_queries, rate_limiter, over_limit
+from models import Room, SpotifyToken
+from jobs import JobFailed
+from metrics import COUNT_BUCKETS
+from queue_index import RoomQueue
+from rooms import reserve_tracks, release_tracks, index_songs, load_room_queue, song_payloads
+from sharding import ShardUnavailable
+from spotify_api import (room_token_cache, song_from_track, room_host, get_host_token, spotify_api_get,
+                         parse_spotify_url, refresh_spotify_token)
+import rooms
+import spotify_api
+import logs
+
+log = logs.get_logger('toptrack.api')
+
+api = Blueprint('api', __name__)
+
+SCOPES = "user-read-playback-state user-modify-playback-state user-read-currently-playing streaming user-read-email user-read-private"
+
+def rate_limit(action):
+    """Answer 429 before the view runs when the caller is over the limit for `action`.
+
+    Callers are told apart by the `user_id` in the JSON body and their address;
+    each address is also limited as a whole (RateLimiter.check_client).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def limited(*args, **kwargs):
+            data = request.get_json(silent=True) or {}
+            wait = over_limit(action, data.get('user_id'), request.remote_addr,
+                              data.get('room_id') or kwargs.get('room_id'))
+            if wait:
+                response = jsonify({'error': 'Too many requests. Please slow down.', 'retry_after': round(wait, 2)})
+                response.headers['Retry-After'] = str(math.ceil(wait))
+                return response, 429
+            return view(*args, **kwargs)
+        return limited
+    return decorator
+
+def internal(view):
+    """Only answer callers presenting `Authorization: Bearer <STATS_TOKEN>`, or local
+    callers when STATS_TOKEN is unset. Stats and metrics name rooms and load."""
+    @functools.wraps(view)
+    def checked(*args, **kwargs):
+        token = current_app.config['STATS_TOKEN']
+        if token:
+            allowed = hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                          f'Bearer {token}'.encode())
+        else:
+            try:
+                allowed = ipaddress.ip_address(request.remote_addr or '').is_loopback
+            except ValueError:
+                allowed = False
+        if not allowed:
+            return jsonify({'error': 'Forbidden'}), 403
+        return view(*args, **kwargs)
+    return checked
+
+@api.before_app_request
+def start_background_workers():
+    rooms.start_background_workers()
+
+@api.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+
+@api.after_app_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_latency.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    db_queries.observe(g.db_queries, handler=route)
+    log.debug('http_request', sampled=True, method=request.method, path=request.path,
+              status=response.status_code, ms=round(elapsed * 1000, 2), db_queries=g.db_queries)
+    return response
+
+@api.route('/api/health')
+def health_check():
+    try:
+        # Test database connection
+        db.session.execute("SELECT 1")
+        return jsonify({'status': 'ok', 'database': 'connected'}), 200
+    except Exception as e:
+        log.error('health_check_failed', error=str(e))
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+# Spotify Authentication Endpoints
+@api.route("/api/spotify-login")
+def spotify_login():
+    import urllib.parse
+    room_name = request.args.get('room_name', 'My Jam Session')
+    auth_url = "https://accounts.spotify.com/authorize"
+    params = {
+        "client_id": current_app.config['SPOTIFY_CLIENT_ID'],
+        "response_type": "code",
+        "redirect_uri": current_app.config['SPOTIFY_REDIRECT_URI'],  # Updated to match callback
+        "scope": SCOPES,
+        "state": room_name  # Pass room name as state parameter
+    }
+    return jsonify({"url": f"{auth_url}?{urllib.parse.urlencode(params)}"})
+
+@api.route('/callback', methods=['GET'])
+def spotify_callback():
+    frontend_url = current_app.config['FRONTEND_URL']
+    # Check for errors from Spotify
+    error = request.args.get('error')
+    if error:
+        error_description = request.args.get('error_description', 'Unknown error')
+        log.warning('spotify_auth_error', error=error, description=error_description)
+        return redirect(f"{frontend_url}/create?error=spotify_error&message={error_description}")
+    
+    code = request.args.get('code')
+    if not code:
+        log.warning('spotify_auth_missing_code')
+        return redirect(f"{frontend_url}/create?error=missing_code&message=No authorization code received")
+
+    redirect_uri = current_app.config['SPOTIFY_REDIRECT_URI']
+
+    try:
+        token_response = spotify_api.spotify.exchange_code(code, redirect_uri)
+        
+        if token_response.status_code != 200:
+            log.warning('token_exchange_failed', status=token_response.status_code, body=token_response.text[:200])
+            return redirect(f"{frontend_url}/create?error=token_failed&message=Failed to exchange code for token")
+
+        token_data = token_response.json()
+        
+        # Get user profile
+        profile_response = spotify_api.spotify.api_get('/v1/me', token_data['access_token'])
+        
+        if profile_response.status_code != 200:
+            log.warning('profile_fetch_failed', status=profile_response.status_code, body=profile_response.text[:200])
+            return redirect(f"{frontend_url}/create?error=profile_failed&message=Failed to get Spotify profile")
+        
+        profile_data = profile_response.json()
+        spotify_user_id = profile_data['id']
+        display_name = profile_data.get('display_name', profile_data.get('id', 'Spotify User'))
+        
+        log.info('spotify_login', spotify_user=spotify_user_id, display_name=display_name)
+        
+        # Store tokens
+        expires_at = datetime.utcnow() + timedelta(seconds=token_data['expires_in'])
+        
+        existing_token = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
+        
+        if existing_token:
+            existing_token.access_token = token_data['access_token']
+            existing_token.refresh_token = token_data['refresh_token']
+            existing_token.expires_at = expires_at
+            existing_token.updated_at = datetime.utcnow()
+        else:
+            new_token = SpotifyToken(
+                spotify_user_id=spotify_user_id,
+                access_token=token_data['access_token'],
+                refresh_token=token_data['refresh_token'],
+                expires_at=expires_at
+            )
+            db.session.add(new_token)
+        
+        db.session.commit()
+        room_token_cache.invalidate_host(spotify_user_id)
+        
+        # Create room
+        room_name = request.args.get('state', 'My Jam Session')
+        room = Room(
+            name=room_name,
+            host_id=spotify_user_id
+        )
+        db.session.add(room)
+        db.session.commit()
+        
+        log.info('room_created', room_id=room.id, name=room.name, host_id=spotify_user_id)
+
+        final_url = f"{frontend_url}/room/{room.id}?spotify_user={spotify_user_id}&display_name={display_name}&auth_success=true"
+        log.debug('callback_redirect', url=final_url)
+
+        return redirect(final_url)
+        
+        
+        
+    except Exception as e:
+        log.error('callback_failed', exc_info=True)
+        # Sanitize error message for redirect
+        error_message = str(e).replace('\n', ' ').replace('\r', ' ')
+        return redirect(f"{frontend_url}/create?error=server_error&message=Authentication failed: {error_message}")
+
+FLAGS = {'true': True, '1': True, 'yes': True, 'on': True,
+         'false': False, '0': False, 'no': False, 'off': False}
+
+def parse_flag(value):
+    """True/False from a JSON boolean, 0/1 or a string like "true"/"off"; None for anything else"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, str)):
+        return FLAGS.get(str(value).strip().lower())
+    return None
+
+@api.route('/api/spotify/track-info', methods=['POST'])
+@rate_limit('track_info')
+def get_spotify_track_info():
+    data = request.json
+    spotify_url = data.get('spotify_url')
+    room_id = data.get('room_id')
+    added_by = data.get('added_by', 'Unknown User')
+    
+    if not spotify_url or 'spotify.com/track/' not in spotify_url:
+        return jsonify({'error': 'Invalid Spotify URL'}), 400
+    
+    if not room_id:
+        return jsonify({'error': 'Room ID is required'}), 400
+    
+    async_add = parse_flag(data.get('async', current_app.config['ASYNC_TRACK_ADD']))
+    if async_add is None:
+        return jsonify({'error': '"async" must be true or false'}), 400
+    
+    # Extract track ID from URL
+    try:
+        track_id = spotify_url.split('/track/')[1].split('?')[0]
+        if not track_id:
+            raise ValueError("Empty track ID")
+    except (IndexError, AttributeError, ValueError):
+        return jsonify({'error': 'Could not extract track ID from URL'}), 400
+    
+    # Get room to find the host
+    host_id = room_host(room_id)
+    if host_id is None:
+        return jsonify({'error': 'Room not found'}), 404
+    
+    if async_add:
+        # The same link already being resolved for this room answers with that job
+        job = spotify_api.jobs.attach((room_id, track_id))
+        if job is not None:
+            return job_accepted(job)
+    
+    # Check the in-memory queue for the song, and claim it so a concurrent
+    # add of the same link doesn't fetch and insert it a second time
+    reserved, queued, in_flight = reserve_tracks(room_id, [track_id])
+    if queued:
+        return jsonify({'error': 'This song is already in the queue'}), 400
+    if in_flight:
+        return jsonify({'error': 'This song is already being added to the queue'}), 400
+    
+    if not async_add:
+        return add_track(room_id, track_id, spotify_url, added_by, host_id, reserved)
+    
+    job, created = spotify_api.jobs.submit('track_add', (room_id, track_id), lambda job: resolve_track(
+        job, room_id, track_id, spotify_url, added_by, host_id, reserved))
+    if not created:
+        release_tracks(room_id, reserved)
+        if job is None:
+            response = jsonify({'error': 'Too many songs are being added right now. Please try again shortly.',
+                                'retry_after': 1})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+    return job_accepted(job)
+
+def room_busy():
+    """503 for a change the room's owner worker could not take (it is moving between workers)"""
+    response = jsonify({'error': 'The room is busy right now. Please try again.', 'retry_after': 1})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def add_track(room_id, track_id, spotify_url, added_by, host_id, reserved, job_id=None):
+    """Fetch a reserved track, store it and broadcast song_added; returns (response, status)"""
+    added = False
+    try:
+        # Recently fetched tracks are served from the cache without calling Spotify
+        track_data = spotify_api.track_cache.get(track_id)
+        if track_data is None:
+            spotify_token, error = get_host_token(host_id)
+            if error:
+                return error
+            
+            # Call Spotify API to get track info
+            log.debug('spotify_fetch_track', track_id=track_id)
+            track_response = spotify_api_get(spotify_token, f'/v1/tracks/{track_id}')
+            
+            if track_response.status_code == 401:
+                return jsonify({'error': 'Authentication failed. Host may need to re-authenticate with Spotify.'}), 401
+            elif track_response.status_code == 404:
+                return jsonify({'error': 'Track not found on Spotify'}), 404
+            elif track_response.status_code == 429:
+                return jsonify({'error': 'Spotify API rate limit exceeded. Please try again later.'}), 429
+            elif track_response.status_code != 200:
+                log.warning('spotify_api_error', status=track_response.status_code, body=track_response.text[:200])
+                return jsonify({'error': f'Spotify API error: {track_response.status_code}'}), 400
+            
+            track_data = track_response.json()
+            spotify_api.track_cache.set(track_id, track_data)
+        
+        new_song = song_from_track(room_id, track_id, spotify_url, added_by, track_data, datetime.utcnow())
+        db.session.add(new_song)
+        db.session.commit()
+        log.info('song_added', sampled=True, room_id=room_id, track_id=track_id)
+        # Index the song and tell all room members it was added
+        encoded = index_songs(room_id, [new_song], 'song_added',
+                              f'{added_by} added "{new_song.title}" by {new_song.artist} to the queue',
+                              job_id=job_id)
+        if encoded is None:
+            # The room's owner didn't take the song, so nobody has seen it: take it back
+            db.session.delete(new_song)
+            db.session.commit()
+            return room_busy()
+        added = True
+        # Return success response
+        return jsonify({
+            'success': True,
+            'message': 'Song added to queue successfully',
+            'song': encoded[0]
+        }), 201
+    except requests.exceptions.Timeout:
+        log.warning('spotify_timeout', track_id=track_id)
+        return jsonify({'error': 'Request to Spotify timed out. Please try again.'}), 408
+    except requests.exceptions.RequestException as e:
+        log.warning('spotify_network_error', error=str(e))
+        return jsonify({'error': 'Network error when fetching track info'}), 500
+    except Exception:
+        log.error('track_add_failed', exc_info=True, room_id=room_id, track_id=track_id)
+        return jsonify({'error': 'Failed to fetch track information'}), 500
+    finally:
+        if not added:
+            release_tracks(room_id, reserved)
+
+def resolve_track(job, room_id, track_id, spotify_url, added_by, host_id, reserved):
+    """Async add job: add the track, or tell the room it could not be added"""
+    response, status = add_track(room_id, track_id, spotify_url, added_by, host_id, reserved, job_id=job.id)
+    result = {**response.get_json(), 'http_status': status}
+    if status >= 400:
+        socketio.emit('song_add_failed', {'room_id': room_id, 'job_id': job.id, 'track_id': track_id,
+                                          'added_by': added_by, 'error': result.get('error'),
+                                          'http_status': status}, room=room_id)
+        raise JobFailed(result)
+    return result
+
+def job_accepted(job):
+    return jsonify({
+        'success': True,
+        'message': 'Song is being added to the queue',
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/api/jobs/{job.id}'
+    }), 202
+
+@api.route('/api/spotify/tracks/bulk', methods=['POST'])
+@rate_limit('bulk_add')
+def add_spotify_tracks_bulk():
+    """Queue many tracks at once from track links and/or a playlist or album link"""
+    data = request.json or {}
+    room_id = data.get('room_id')
+    added_by = data.get('added_by', 'Unknown User')
+    urls = data.get('spotify_urls') or []
+    if data.get('spotify_url'):
+        urls = urls + [data['spotify_url']]
+    max_tracks = current_app.config['BULK_ADD_MAX']
+    
+    if not room_id:
+        return jsonify({'error': 'Room ID is required'}), 400
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'error': 'No Spotify URLs provided'}), 400
+    if len(urls) > max_tracks:
+        return jsonify({'error': f'At most {max_tracks} URLs can be added at once'}), 400
+    
+    parsed = [parse_spotify_url(url) for url in urls]
+    if any(kind is None for kind, _ in parsed):
+        return jsonify({'error': 'Invalid Spotify URL'}), 400
+    
+    host_id = room_host(room_id)
+    if host_id is None:
+        return jsonify({'error': 'Room not found'}), 404
+    
+    spotify_token = None
+    reserved = []
+    added_ids = set()
+    try:
+        # Expand playlists and albums into track IDs, keeping paste order
+        track_ids = []
+        for kind, spotify_id in parsed:
+            if kind == 'track':
+                track_ids.append(spotify_id)
+                continue
+            if spotify_token is None:
+                spotify_token, error = get_host_token(host_id)
+                if error:
+                    return error
+            if kind == 'playlist':
+                url = f'/v1/playlists/{spotify_id}/tracks'
+                params = {'fields': 'items(track(id,type)),next', 'limit': 100}
+            else:
+                url = f'/v1/albums/{spotify_id}/tracks'
+                params = {'limit': 50}
+            while url and len(track_ids) < max_tracks:
+                page_response = spotify_api_get(spotify_token, url, params)
+                if page_response.status_code != 200:
+                    log.warning('spotify_api_error', status=page_response.status_code, kind=kind, spotify_id=spotify_id)
+                    return jsonify({'error': f'Could not read Spotify {kind}: {page_response.status_code}'}), 400
+                page = page_response.json()
+                for item in page.get('items', []):
+                    track = item.get('track', item) if kind == 'playlist' else item
+                    if track and track.get('id') and track.get('type', 'track') == 'track':
+                        track_ids.append(track['id'])
+                url, params = page.get('next'), None
+        
+        # De-duplicate within the request and against the room's queue (and adds in flight)
+        track_ids = list(dict.fromkeys(track_ids))[:max_tracks]
+        reserved, queued, in_flight = reserve_tracks(room_id, track_ids)
+        duplicates = [track_id for track_id in track_ids if track_id not in reserved]
+        track_ids = reserved
+        
+        # Resolve metadata from the cache, then 50 at a time from Spotify
+        tracks = {}
+        missing = []
+        for track_id in track_ids:
+            track_data = spotify_api.track_cache.get(track_id)
+            if track_data is None:
+                missing.append(track_id)
+            else:
+                tracks[track_id] = track_data
+        for start in range(0, len(missing), 50):
+            if spotify_token is None:
+                spotify_token, error = get_host_token(host_id)
+                if error:
+                    return error
+            chunk = missing[start:start + 50]
+            log.debug('spotify_fetch_tracks', count=len(chunk))
+            tracks_response = spotify_api_get(spotify_token, '/v1/tracks',
+                                              {'ids': ','.join(chunk)})
+            if tracks_response.status_code == 429:
+                return jsonify({'error': 'Spotify API rate limit exceeded. Please try again later.'}), 429
+            if tracks_response.status_code != 200:
+                log.warning('spotify_api_error', status=tracks_response.status_code, body=tracks_response.text[:200])
+                return jsonify({'error': f'Spotify API error: {tracks_response.status_code}'}), 400
+            for track_data in tracks_response.json().get('tracks', []):
+                if track_data:
+                    tracks[track_data['id']] = track_data
+                    spotify_api.track_cache.set(track_data['id'], track_data)
+        not_found = [track_id for track_id in track_ids if track_id not in tracks]
+        
+        now = datetime.utcnow()
+        new_songs = []
+        for offset, track_id in enumerate(track_id for track_id in track_ids if track_id in tracks):
+            track_data = tracks[track_id]
+            spotify_url = track_data.get('external_urls', {}).get('spotify') or f'https://open.spotify.com/track/{track_id}'
+            # Stagger added_at so equal-vote songs keep paste order in the queue
+            new_songs.append(song_from_track(room_id, track_id, spotify_url, added_by, track_data,
+                                             now - timedelta(microseconds=offset)))
+        if new_songs:
+            db.session.add_all(new_songs)
+            db.session.commit()
+        
+        log.info('songs_added', room_id=room_id, count=len(new_songs), duplicates=len(duplicates))
+        songs = []
+        if new_songs:
+            songs = index_songs(room_id, new_songs, 'songs_added',
+                                f'{added_by} added {len(new_songs)} songs to the queue')
+            if songs is None:
+                for song in new_songs:
+                    db.session.delete(song)
+                db.session.commit()
+                return room_busy()
+            added_ids = {song.spotify_track_id for song in new_songs}
+        return jsonify({
+            'success': True,
+            'message': f'{len(songs)} songs added to queue',
+            'songs': songs,
+            'duplicates': duplicates,
+            'not_found': not_found
+        }), 201 if songs else 200
+    except requests.exceptions.Timeout:
+        db.session.rollback()
+        log.warning('spotify_timeout', room_id=room_id)
+        return jsonify({'error': 'Request to Spotify timed out. Please try again.'}), 408
+    except requests.exceptions.RequestException as e:
+        db.session.rollback()
+        log.warning('spotify_network_error', error=str(e))
+        return jsonify({'error': 'Network error when fetching track info'}), 500
+    except Exception:
+        db.session.rollback()
+        log.error('bulk_add_failed', exc_info=True, room_id=room_id)
+        return jsonify({'error': 'Failed to add tracks'}), 500
+    finally:
+        unused = [track_id for track_id in reserved if track_id not in added_ids]
+        if unused:
+            release_tracks(room_id, unused)
+
+@api.route('/api/spotify/track-cache', methods=['GET'])
+@internal
+def get_track_cache_stats():
+    return jsonify(spotify_api.track_cache.stats())
+
+@api.route('/api/sweeper-stats', methods=['GET'])
+@internal
+def get_sweeper_stats():
+    return jsonify(rooms.sweeper.stats())
+
+@api.route('/api/spotify/client-stats', methods=['GET'])
+@internal
+def get_spotify_client_stats():
+    return jsonify({**spotify_api.spotify.stats(), 'tokens': spotify_api.token_manager.stats()})
+
+@api.route('/api/shard-stats', methods=['GET'])
+@internal
+def get_shard_stats():
+    return jsonify({**rooms.shard.stats(), 'queue_log': rooms.vote_broadcaster.stats(), 'song_payloads': song_payloads.stats(),
+                    'playback': rooms.playback.stats(), 'chat': rooms.chat.stats()})
+
+@api.route('/api/rate-limit-stats', methods=['GET'])
+@internal
+def get_rate_limit_stats():
+    return jsonify(rate_limiter.stats())
+
+@api.route('/api/presence-stats', methods=['GET'])
+@internal
+def get_presence_stats():
+    return jsonify(rooms.presence.stats())
+
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # Jobs are kept by the worker that accepted them
+    job = spotify_api.jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@api.route('/api/job-stats', methods=['GET'])
+@internal
+def get_job_stats():
+    return jsonify(spotify_api.jobs.stats())
+
+def rooms_by_members(counts):
+    """Cumulative {(le,): rooms} over member counts; room ids are never exported"""
+    counts = list(counts)
+    buckets = {(str(bound),): sum(1 for count in counts if count <= bound) for bound in COUNT_BUCKETS}
+    buckets[('+Inf',)] = len(counts)
+    return buckets
+
+# Counts other components already keep are read when /api/metrics is scraped
+metrics.callback('toptrack_socketio_clients', 'Socket.IO clients connected to this worker',
+                 lambda: len(socketio.server.manager.rooms.get('/', {}).get(None, {})))
+metrics.callback('toptrack_rooms_by_members', 'Rooms on this worker with at most `le` users connected',
+                 lambda: rooms_by_members(rooms.presence.room_counts().values()), labels=('le',))
+metrics.callback('toptrack_spotify_requests_total', 'Spotify API calls, including retries',
+                 lambda: spotify_api.spotify.request_count, kind='counter')
+metrics.callback('toptrack_spotify_rate_limited_total', 'Spotify API calls answered with 429',
+                 lambda: spotify_api.spotify.rate_limited_count, kind='counter')
+metrics.callback('toptrack_spotify_retries_total', 'Spotify API calls retried after a 429',
+                 lambda: spotify_api.spotify.retry_count, kind='counter')
+metrics.callback('toptrack_spotify_shed_total', 'Spotify calls answered locally because too many were in flight',
+                 lambda: spotify_api.spotify.shed_count, kind='counter')
+metrics.callback('toptrack_spotify_in_flight', 'Spotify calls in flight', lambda: spotify_api.spotify.in_flight)
+metrics.callback('toptrack_spotify_errors_total', 'Spotify API calls that failed without a response',
+                 lambda: spotify_api.spotify.error_count, kind='counter')
+metrics.callback('toptrack_spotify_token_refreshes_total', 'Spotify token refreshes performed',
+                 lambda: spotify_api.token_manager.refreshes, kind='counter')
+metrics.callback('toptrack_spotify_token_refreshes_shared_total', 'Token refreshes that waited on one in flight',
+                 lambda: spotify_api.token_manager.shared_refreshes, kind='counter')
+metrics.callback('toptrack_track_cache_entries', 'Track metadata cache entries', lambda: spotify_api.track_cache.stats()['entries'])
+metrics.callback('toptrack_jobs_queued', 'Background jobs waiting for a worker', lambda: spotify_api.jobs.depth())
+metrics.callback('toptrack_jobs_running', 'Background jobs running', lambda: spotify_api.jobs.running)
+metrics.callback('toptrack_jobs_deduplicated_total', 'Job submissions answered with the same job already in flight',
+                 lambda: spotify_api.jobs.deduplicated, kind='counter')
+metrics.callback('toptrack_jobs_rejected_total', 'Job submissions refused because the queue was full',
+                 lambda: spotify_api.jobs.rejected, kind='counter')
+metrics.callback('toptrack_pending_votes', 'Vote changes waiting to be flushed',
+                 lambda: rooms.vote_buffer.pending_count())
+metrics.callback('toptrack_votes_dropped_total', 'Vote changes the database rejected',
+                 lambda: rooms.vote_buffer.dropped, kind='counter')
+
+@api.route('/api/metrics', methods=['GET'])
+@internal
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@api.route('/api/rooms/<room_id>', methods=['GET'])
+def get_room(room_id):
+    try:
+        # Query the room from database
+        room = Room.query.get(room_id)
+        
+        if not room:
+            return jsonify({
+                'error': 'Room not found'
+            }), 404
+            
+        return jsonify({
+            'room': {
+                'id': room.id,
+                'name': room.name,
+                'host_id': room.host_id,
+                'is_active': room.is_active,
+                'created_at': room.created_at.isoformat(),
+                'current_song_id': room.current_song_id,
+                'current_song_started_at': room.current_song_started_at.isoformat() + 'Z' if room.current_song_started_at else None,
+                'member_count': rooms.presence.count(room_id)
+            }
+        })
+        
+    except Exception as e:
+        log.error('get_room_failed', room_id=room_id, error=str(e))
+        return jsonify({
+            'error': 'Failed to get room details'
+        }), 500
+
+
+@api.route('/api/room/<room_id>/queue', methods=['GET'])
+def get_room_queue(room_id):
+    # Up to 10 songs not played, not expired, ordered by votes DESC, then newest added_at DESC
+    try:
+        queue = rooms.shard.call('read_queue', room_id, {'room_id': room_id, 'limit': 10})
+    except (gevent.Timeout, ShardUnavailable):
+        queue = None
+    if queue is None:
+        # The owner did not answer (e.g. it just went away): read the database directly
+        fallback = RoomQueue()
+        for song, added_at, expires_at in load_room_queue(room_id):
+            fallback.add(song, added_at, expires_at)
+        queue = {'room_id': room_id, 'version': 0, 'epoch': None, 'songs': fallback.top(10)}
+    return jsonify(queue)
+
+
+@api.route('/api/spotify/token/room/<room_id>', methods=['GET'])
+def get_room_spotify_token(room_id):
+    # First find the room's host, from the cache when we've seen the room before
+    host_id = room_host(room_id)
+    if host_id is None:
+        return jsonify({'error': 'Room not found'}), 404
+    spotify_api.token_manager.touch(host_id)
+    
+    cached = room_token_cache.token_for(host_id)
+    # Check if token needs refresh (expires in less than 5 minutes)
+    if cached is None or datetime.utcnow() >= cached[1] - timedelta(minutes=5):
+        # Get the host's Spotify token
+        spotify_token = SpotifyToken.query.filter_by(spotify_user_id=host_id).first()
+        if not spotify_token:
+            return jsonify({'error': 'No token found for room host'}), 404
+        if datetime.utcnow() >= spotify_token.expires_at - timedelta(minutes=5):
+            # Use existing refresh function
+            if not refresh_spotify_token(spotify_token):
+                return jsonify({'error': 'Failed to refresh token'}), 500
+        cached = room_token_cache.set_token(host_id, spotify_token.access_token, spotify_token.expires_at)
+    
+    access_token, expires_at, etag = cached
+    # The client may reuse this response until we would refresh the token; it is a
+    # bearer token, so shared caches (proxies, CDNs) must not keep it
+    max_age = max(0, int((expires_at - timedelta(minutes=5) - datetime.utcnow()).total_seconds()))
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify({
+            'access_token': access_token,
+            'expires_in': int((expires_at - datetime.utcnow()).total_seconds()),
+            'expires_at': expires_at.isoformat() + 'Z'
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    response.vary.add('Origin')
+    return response
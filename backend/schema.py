@@ -0,0 +1,72 @@
+"""Schema check, done once when the app is created.
+
+An empty database gets the tables from the models and is stamped with the
+latest migration, as `flask db upgrade` would leave it. A database that is
+already set up only has its alembic_version compared with the migrations on
+disk: a one-row query, with a warning when it is behind. Neither imports
+Alembic; migrations themselves still run with `flask db upgrade`.
+"""
+import os
+import re
+
+from sqlalchemy import inspect, text
+
+import logs
+
+log = logs.get_logger('toptrack.schema')
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+_REVISION = re.compile(r"^(down_revision|revision) = (?:'([^']*)'|None)", re.MULTILINE)
+
+
+def head_revision(directory=MIGRATIONS_DIR):
+    """The latest revision in the migrations directory (one that no other revision follows)"""
+    revisions, parents = set(), set()
+    versions = os.path.join(directory, 'versions')
+    for name in os.listdir(versions):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(versions, name), encoding='utf-8') as f:
+            for key, value in _REVISION.findall(f.read()):
+                if value:
+                    (revisions if key == 'revision' else parents).add(value)
+    heads = revisions - parents
+    return heads.pop() if len(heads) == 1 else None
+
+
+def current_revision(connection):
+    if not inspect(connection).has_table('alembic_version'):
+        return None
+    return connection.execute(text('SELECT version_num FROM alembic_version')).scalar()
+
+
+def ensure_schema(db):
+    """Create the schema of an empty database, or warn if an existing one is not migrated.
+
+    Runs inside an app context. Returns 'created', 'current' or 'outdated'.
+    """
+    head = head_revision()
+    with db.engine.connect() as connection:
+        empty = not inspect(connection).has_table('room')
+        revision = None if empty else current_revision(connection)
+    if empty:
+        try:
+            db.create_all()
+            with db.engine.begin() as connection:
+                connection.execute(text('CREATE TABLE IF NOT EXISTS alembic_version '
+                                        '(version_num VARCHAR(32) NOT NULL PRIMARY KEY)'))
+                if head and current_revision(connection) is None:
+                    connection.execute(text('INSERT INTO alembic_version (version_num) VALUES (:head)'),
+                                       {'head': head})
+        except Exception:
+            # Another process creating the schema at the same time got there first
+            with db.engine.connect() as connection:
+                if not inspect(connection).has_table('room'):
+                    raise
+        log.info('schema_created', revision=head)
+        return 'created'
+    if head and revision != head:
+        log.warning('schema_outdated', revision=revision, head=head, hint='run flask db upgrade')
+        return 'outdated'
+    return 'current'
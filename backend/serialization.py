@@ -0,0 +1,125 @@
+"""JSON encoding shared by HTTP responses and Socket.IO emits.
+
+Songs are encoded to JSON once and the text is cached per song, so the
+same song sent in a `song_added` emit, the add response, queue snapshots
+and `next_song` is not rebuilt and re-encoded every time. A cached entry
+is re-encoded when the song's vote_count or is_played changes.
+
+Pre-encoded values are wrapped in `Encoded` and can be nested anywhere in
+a payload: `dumps()` splices their text in as-is. This module is also
+plugged in as the Socket.IO json module and as the Flask JSON provider,
+so emits and `jsonify()` both understand `Encoded`. orjson is used when
+installed, otherwise the standard library json module.
+"""
+from collections import OrderedDict
+from datetime import date
+import json
+import re
+import uuid
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Encoded:
+    """A value that is already JSON text"""
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __repr__(self):
+        return f'Encoded({self.raw[:60]!r})'
+
+
+# Encoded values are first written as a marker string and swapped for their
+# text afterwards; the random part keeps user strings from ever matching it.
+_MARKER = f'\x00{uuid.uuid4().hex}:'
+_MARKER_RE = re.compile(re.escape(json.dumps(_MARKER)[:-1]) + r'(\d+)"')
+
+
+def _default(o):
+    if isinstance(o, date):
+        return o.isoformat()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def _encode(obj, default):
+    if orjson is not None:
+        # Datetimes go through `default` too, so both encoders format them alike
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(obj, default=default, option=options).decode('utf-8')
+    return json.dumps(obj, default=default, separators=(',', ':'))
+
+
+def dumps(obj, default=None, **kwargs):
+    """Encode `obj` to JSON text, splicing in any `Encoded` values"""
+    fallback = default or _default
+    raw = []
+
+    def encode_value(o):
+        if isinstance(o, Encoded):
+            raw.append(o.raw)
+            return f'{_MARKER}{len(raw) - 1}'
+        return fallback(o)
+
+    text = _encode(obj, encode_value)
+    if raw:
+        text = _MARKER_RE.sub(lambda match: raw[int(match.group(1))], text)
+    return text
+
+
+def loads(s, **kwargs):
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that understands `Encoded` values"""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj, default=DefaultJSONProvider.default)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+
+class SongPayloadCache:
+    """song_id -> encoded song, re-encoded when its votes or played flag change"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # song_id -> (vote_count, is_played, Encoded)
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, song):
+        """Encoded JSON for a song dict as built by song_to_dict"""
+        entry = self._entries.get(song['id'])
+        if entry is not None and entry[0] == song['vote_count'] and entry[1] == song['is_played']:
+            self._entries.move_to_end(song['id'])
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        encoded = Encoded(dumps(song))
+        self._entries[song['id']] = (song['vote_count'], song['is_played'], encoded)
+        self._entries.move_to_end(song['id'])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return encoded
+
+    def discard(self, song_id):
+        self._entries.pop(song_id, None)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'encoder': 'orjson' if orjson is not None else 'json'
+        }
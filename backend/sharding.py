@@ -0,0 +1,330 @@
+"""Room ownership across workers.
+
+Each room is owned by exactly one live worker, picked by consistent hashing
+of the room_id over the workers that are currently heartbeating on the
+message bus. The owner keeps the room's queue and vote tallies in memory
+and is the only worker that mutates them; other workers forward mutating
+events (and queue reads) to it over the bus and wait for its answer.
+
+A starting worker owns nothing until it has listened to the heartbeats for
+`settle_time` and knows its peers. Rooms only ever move to a worker that
+joins (or away from one that left): the previous owner persists and drops
+its in-memory state for the rooms it lost, then sends the new owner a
+handoff, and the new owner only takes those rooms, loading them from the
+database, once the handoff arrived. Until then operations on them are
+refused rather than run twice.
+"""
+from bisect import bisect
+import hashlib
+import os
+import socket
+import time
+import uuid
+
+import gevent
+from gevent.event import AsyncResult
+
+import logs
+from pubsub import encode_frame, decode_frame
+
+log = logs.get_logger('toptrack.sharding')
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring with `replicas` virtual nodes per worker"""
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._keys = []
+        self._owners = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            key = _hash(f'{node}#{replica}')
+            self._owners[key] = node
+        self._keys = sorted(self._owners)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for replica in range(self.replicas):
+            self._owners.pop(_hash(f'{node}#{replica}'), None)
+        self._keys = sorted(self._owners)
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        index = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[self._keys[index]]
+
+
+class ShardUnavailable(Exception):
+    """No worker can take an operation on the room right now (settling or handing off)"""
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'.replace('.', '-')
+
+
+class ShardCoordinator:
+    """Routes room operations to the room's owner worker.
+
+    `operations` maps an operation name to `fn(payload)`; forwarded calls run
+    through `run_in_context` (e.g. inside an app context) on the owner.
+    `on_rooms_lost(room_ids)` is called with the loaded rooms a worker no
+    longer owns after a rebalance and must persist them before returning;
+    `loaded_rooms()` lists the rooms this worker holds in memory. Without a
+    bus every room is local.
+    """
+
+    def __init__(self, bus, operations, worker_id=None, heartbeat_interval=2.0,
+                 worker_timeout=6.0, call_timeout=2.0, settle_time=3.0, loaded_rooms=None,
+                 on_rooms_lost=None, run_in_context=None):
+        self.bus = bus
+        self.operations = operations
+        self.worker_id = worker_id or default_worker_id()
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_timeout = worker_timeout
+        self.call_timeout = call_timeout
+        self.settle_time = settle_time
+        self._loaded_rooms = loaded_rooms or (lambda: [])
+        self._on_rooms_lost = on_rooms_lost or (lambda room_ids: None)
+        self._run_in_context = run_in_context or (lambda fn: fn())
+        self.ring = HashRing([self.worker_id])
+        self._peers = HashRing()     # the ring without this worker: who owned a room before us
+        self._last_seen = {}         # worker_id -> monotonic time of last heartbeat
+        self._awaiting = {}          # worker_id -> monotonic deadline for its handoff
+        self._released_to = set()      # workers we released our lost rooms to
+        self._calls = {}             # call id -> AsyncResult
+        self._workers = []
+        self._started_at = None
+        self.forwarded = 0
+        self.handled_remote = 0
+        self.refused = 0
+        self.failed = 0
+        self.rebalances = 0
+
+    @property
+    def enabled(self):
+        return self.bus is not None
+
+    @property
+    def settled(self):
+        """Whether this worker has heard its peers long enough to own rooms"""
+        return not self.enabled or (self._started_at is not None
+                                    and time.monotonic() - self._started_at >= self.settle_time)
+
+    def _channel(self, worker_id):
+        return f'toptrack-shard.{worker_id}'
+
+    def owner(self, room_id):
+        return self.ring.owner(room_id) if self.enabled else self.worker_id
+
+    def is_local(self, room_id):
+        """Whether this worker owns the room and may touch its state now"""
+        if not self.enabled:
+            return True
+        if self.ring.owner(room_id) != self.worker_id or not self.settled:
+            return False
+        # Rooms coming from a peer wait for its handoff
+        return not self._awaiting or self._peers.owner(room_id) not in self._awaiting
+
+    def reset_worker_id(self, worker_id):
+        """Rename this worker, e.g. in a process forked after it was created.
+
+        Only possible before start(); returns whether the name changed.
+        """
+        if self._workers:
+            return False
+        self.worker_id = worker_id
+        self.ring = HashRing([worker_id])
+        self._peers = HashRing()
+        self._last_seen = {}
+        self._awaiting = {}
+        self._released_to = set()
+        return True
+
+    def start(self):
+        if not self.enabled or self._workers:
+            return
+        self._started_at = time.monotonic()
+        # Listen before the first heartbeat, so handoffs it triggers reach us
+        self._workers = [
+            gevent.spawn(self._listen_calls),
+            gevent.spawn(self._listen_workers),
+            gevent.spawn(self._heartbeat),
+        ]
+
+    # Routing
+
+    def run(self, operation, room_id, payload):
+        """Run an operation on the room's owner, here if that is us, and wait until it ran.
+
+        Returns False, after logging it, when no owner took the operation in
+        time; callers tell their client instead of losing it silently.
+        """
+        try:
+            self.call(operation, room_id, payload)
+            return True
+        except (gevent.Timeout, ShardUnavailable) as e:
+            self.failed += 1
+            log.warning('room_operation_failed', operation=operation, room_id=room_id,
+                        reason='timeout' if isinstance(e, gevent.Timeout) else 'unavailable')
+            return False
+
+    def call(self, operation, room_id, payload):
+        """Run an operation on the room's owner and return its result.
+
+        Raises gevent.Timeout if the owner does not answer in time, and
+        ShardUnavailable if no worker may run it yet.
+        """
+        owner = self.owner(room_id)
+        if owner == self.worker_id:
+            if not self.is_local(room_id):
+                raise ShardUnavailable(room_id)
+            return self.operations[operation](payload)
+        self.forwarded += 1
+        call_id = uuid.uuid4().hex
+        result = AsyncResult()
+        self._calls[call_id] = result
+        try:
+            self.bus.publish(self._channel(owner), encode_frame(
+                {'type': 'call', 'operation': operation, 'room_id': room_id, 'payload': payload,
+                 'id': call_id, 'reply_to': self.worker_id}))
+            reply = result.get(timeout=self.call_timeout)
+        finally:
+            self._calls.pop(call_id, None)
+        if reply.get('unavailable'):
+            raise ShardUnavailable(room_id)
+        return reply.get('result')
+
+    def _listen_calls(self):
+        for raw in self.bus.subscribe(self._channel(self.worker_id)):
+            message = decode_frame(raw)
+            if message is None or message.get('type') not in ('call', 'reply', 'handoff'):
+                continue
+            if message['type'] == 'reply':
+                pending = self._calls.get(message.get('id'))
+                if pending is not None:
+                    pending.set(message)
+            elif message['type'] == 'handoff':
+                self._handed_off(message.get('worker_id'))
+            elif message.get('operation') in self.operations:
+                gevent.spawn(self._handle_call, message)
+
+    def _handle_call(self, message):
+        reply = {'type': 'reply', 'id': message.get('id')}
+        # The sender's view of the ring may be ahead of or behind ours
+        if not self.is_local(message.get('room_id')):
+            self.refused += 1
+            reply['unavailable'] = True
+        else:
+            self.handled_remote += 1
+            operation = self.operations[message['operation']]
+            try:
+                reply['result'] = self._run_in_context(lambda: operation(message.get('payload')))
+            except Exception:
+                log.error('forwarded_operation_failed', exc_info=True, operation=message['operation'])
+        if message.get('reply_to'):
+            self.bus.publish(self._channel(message['reply_to']), encode_frame(reply))
+
+    # Membership
+
+    def _heartbeat(self):
+        while True:
+            self.bus.publish('toptrack-workers', encode_frame(
+                {'worker_id': self.worker_id, 'awaiting': sorted(self._awaiting)}))
+            self._expire_workers()
+            gevent.sleep(self.heartbeat_interval)
+
+    def _listen_workers(self):
+        for raw in self.bus.subscribe('toptrack-workers'):
+            message = decode_frame(raw)
+            worker_id = message.get('worker_id') if message else None
+            if not isinstance(worker_id, str) or worker_id == self.worker_id:
+                continue
+            known = worker_id in self.ring.nodes
+            self._last_seen[worker_id] = time.monotonic()
+            if not known:
+                log.info('worker_joined', worker_id=worker_id)
+                if not self.settled:
+                    # A peer already running: some of the rooms we will own are its
+                    self._awaiting[worker_id] = time.monotonic() + self.settle_time + self.worker_timeout
+                if self._rebalance(lambda: self._add(worker_id)):
+                    # Persisted what moved to it (if anything): it may load those rooms now
+                    self._released_to.add(worker_id)
+                    self._send_handoff(worker_id)
+            elif self.worker_id in (message.get('awaiting') or ()) and worker_id in self._released_to:
+                # Our handoff got lost on the way
+                self._send_handoff(worker_id)
+
+    def _send_handoff(self, worker_id):
+        self.bus.publish(self._channel(worker_id), encode_frame({'type': 'handoff', 'worker_id': self.worker_id}))
+
+    def _handed_off(self, worker_id):
+        if self._awaiting.pop(worker_id, None) is not None:
+            log.info('rooms_handed_off', worker_id=worker_id)
+
+    def _add(self, worker_id):
+        self.ring.add(worker_id)
+        self._peers.add(worker_id)
+
+    def _remove(self, worker_id):
+        self.ring.remove(worker_id)
+        self._peers.remove(worker_id)
+        self._released_to.discard(worker_id)
+        # Its rooms were never flushed; there is nothing left to wait for
+        self._awaiting.pop(worker_id, None)
+
+    def _expire_workers(self):
+        now = time.monotonic()
+        for worker_id, deadline in list(self._awaiting.items()):
+            if now > deadline:
+                del self._awaiting[worker_id]
+                log.warning('handoff_timed_out', worker_id=worker_id)
+        for worker_id, seen in list(self._last_seen.items()):
+            if now - seen > self.worker_timeout:
+                del self._last_seen[worker_id]
+                log.info('worker_left', worker_id=worker_id)
+                self._rebalance(lambda: self._remove(worker_id))
+
+    def _rebalance(self, change):
+        """Apply a ring change and release the rooms it took away; returns whether they were released"""
+        owned = [room_id for room_id in self._loaded_rooms() if self.is_local(room_id)]
+        change()
+        self.rebalances += 1
+        lost = [room_id for room_id in owned if self.owner(room_id) != self.worker_id]
+        if not lost:
+            return True
+        try:
+            self._run_in_context(lambda: self._on_rooms_lost(lost))
+            return True
+        except Exception:
+            # Without a handoff the new owner waits its timeout out before loading them
+            log.error('rooms_release_failed', exc_info=True, count=len(lost))
+            return False
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'worker_id': self.worker_id,
+            'workers': sorted(self.ring.nodes),
+            'settled': self.settled,
+            'awaiting_handoff': sorted(self._awaiting),
+            'forwarded': self.forwarded,
+            'handled_remote': self.handled_remote,
+            'refused': self.refused,
+            'failed': self.failed,
+            'rebalances': self.rebalances
+        }
@@ -0,0 +1,169 @@
+"""Socket.IO event handlers.
+
+They are registered on the shared `socketio` when this module is imported,
+and bound to the app by create_app().
+"""
+import functools
+import time
+
+from flask import current_app, g, request
+from flask_socketio import emit, join_room, leave_room
+
+from extensions import socketio, socket_latency, socket_errors, db_queries, chat_messages, over_limit
+from models import Room, Song, User
+from spotify_api import room_host
+import rooms
+import logs
+
+log = logs.get_logger('toptrack.socketio')
+
+
+def socket_handler(event, limit=None):
+    """socketio.on(event), also recording the handler's latency and SQL statement count.
+
+    With `limit`, the sender is first checked against that rate limit and, when
+    over it, answered with `rate_limited` instead of running the handler.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def timed(*args):
+            started = time.perf_counter()
+            g.db_queries = 0
+            try:
+                if limit and args and isinstance(args[0], dict):
+                    data = args[0]
+                    wait = over_limit(limit, data.get('user_id') or request.sid, request.remote_addr,
+                                      data.get('room_id'))
+                    if wait:
+                        emit('rate_limited', {'event': event, 'room_id': data.get('room_id'),
+                                              'retry_after': round(wait, 2)})
+                        return
+                return handler(*args)
+            except Exception:
+                socket_errors.inc(event=event)
+                raise
+            finally:
+                socket_latency.observe(time.perf_counter() - started, event=event)
+                db_queries.observe(g.db_queries, handler=event)
+        return socketio.on(event)(timed)
+    return decorator
+
+
+def run_on_owner(event, operation, room_id, payload):
+    """Run a room operation on the room's owner worker; if it can't take it now
+    (the room is moving between workers), the sender gets `room_unavailable`"""
+    if not rooms.shard.run(operation, room_id, payload):
+        emit('room_unavailable', {'event': event, 'room_id': room_id, 'retry_after': 1})
+
+
+@socket_handler('connect')
+def handle_connect(auth=None):
+    rooms.start_background_workers()
+    log.debug('client_connected', sampled=True, sid=request.sid)
+
+@socket_handler('disconnect')
+def handle_disconnect():
+    rooms.presence.disconnect(request.sid)
+    log.debug('client_disconnected', sampled=True, sid=request.sid)
+
+@socket_handler('join_room')
+def handle_join_room(data):
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    # Presence is written to the user table, so a join has to name a user it can store
+    if not rooms.fits(room_id, Room.id) or not rooms.fits(user_id, User.id):
+        emit('join_error', {'room_id': room_id, 'error': 'Joining a room needs a room_id and user_id'})
+        return
+    join_room(room_id)
+    log.info('user_joined', sampled=True, room_id=room_id, user_id=user_id)
+    # The room hears about users that are new to it; a reconnect only gets its own echo
+    if not rooms.presence.join(request.sid, room_id, user_id, data.get('username')):
+        emit('user_joined', {'user_id': user_id, 'username': data.get('username'), 'room_id': room_id,
+                             'member_count': rooms.presence.count(room_id)}, to=request.sid)
+    # The joiner gets what is playing and how far in, instead of polling Spotify
+    run_on_owner('join_room', 'now_playing', room_id, {'room_id': room_id, 'sid': request.sid})
+    run_on_owner('join_room', 'chat_history', room_id, {'room_id': room_id, 'sid': request.sid})
+    # A reconnecting client tells us the last queue version it saw
+    if data.get('queue_version') is not None:
+        run_on_owner('join_room', 'sync_queue', room_id, {'room_id': room_id, 'queue_version': data['queue_version'],
+                                                          'queue_epoch': data.get('queue_epoch'), 'sid': request.sid})
+
+@socket_handler('leave_room')
+def handle_leave_room(data):
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    leave_room(room_id)
+    rooms.presence.leave(request.sid, room_id)
+    log.info('user_left', sampled=True, room_id=room_id, user_id=user_id)
+
+@socket_handler('send_message', limit='send_message')
+def handle_send_message(data):
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    message = data.get('message')
+    if not room_id or not isinstance(message, str) or not message.strip():
+        chat_messages.inc(result='invalid')
+        return
+    max_length = current_app.config['CHAT_MAX_MESSAGE_LENGTH']
+    if len(message) > max_length:
+        chat_messages.inc(result='too_long')
+        emit('chat_error', {'room_id': room_id, 'error': f'Messages are limited to {max_length} characters',
+                            'max_length': max_length})
+        return
+    chat_messages.inc(result='accepted')
+    log.debug('message_sent', sampled=True, room_id=room_id, user_id=user_id)
+    run_on_owner('send_message', 'chat', room_id, {'room_id': room_id, 'message': {
+        'user_id': user_id, 'username': data.get('username'), 'message': message,
+        'sent_at': int(time.time() * 1000)}})
+
+@socket_handler('get_chat_history')
+def handle_get_chat_history(data):
+    """A client that missed chat frames (a gap in `seq`) catches up from the history"""
+    room_id = data.get('room_id')
+    if room_id:
+        run_on_owner('get_chat_history', 'chat_history', room_id,
+                     {'room_id': room_id, 'sid': request.sid, 'always': True})
+
+@socket_handler('vote_song', limit='vote_song')
+def handle_vote_song(data):
+    if not rooms.valid_vote(data):
+        emit('vote_error', {'room_id': data.get('room_id'), 'song_id': data.get('song_id'),
+                            'error': 'A vote needs a room_id, song_id and user_id'})
+        return
+    run_on_owner('vote_song', 'vote_song', data['room_id'], {
+        'room_id': data['room_id'], 'song_id': data['song_id'], 'user_id': data['user_id'],
+        'vote_type': data.get('vote_type', 'up'), 'sid': request.sid})
+
+@socket_handler('play_song')
+def handle_play_song(data):
+    room_id = data.get('room_id')
+    song_id = data.get('song_id')
+    user_id = data.get('user_id')
+    log.debug('play_song', room_id=room_id, user_id=user_id, song_id=song_id)
+    emit('song_played', {'user_id': user_id, 'room_id': room_id, 'song_id': song_id}, room=room_id)
+
+@socket_handler('playback_state')
+def handle_playback_state(data):
+    """The host's player reports whether it plays the room's song and where it is in it"""
+    room_id = data.get('room_id')
+    song_id = data.get('song_id')
+    position_ms = data.get('position_ms')
+    if (not rooms.fits(room_id, Room.id) or not rooms.fits(song_id, Song.id)
+            or not isinstance(position_ms, (int, float)) or position_ms < 0):
+        return
+    # Only the host's player keeps the room's clock
+    if data.get('user_id') is None or data.get('user_id') != room_host(room_id):
+        return
+    # A report that doesn't get through is replaced by the next one in a few seconds
+    rooms.shard.run('playback_state', room_id, {'room_id': room_id, 'song_id': song_id,
+                                                'paused': bool(data.get('paused')), 'position_ms': position_ms})
+
+@socket_handler('get_next_song', limit='get_next_song')
+def handle_get_next_song(data):
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    log.debug('next_song_requested', room_id=room_id, user_id=user_id)
+    payload = {'room_id': room_id, 'sid': request.sid}
+    if 'current_song_id' in data:
+        payload['current_song_id'] = data['current_song_id']
+    run_on_owner('get_next_song', 'get_next_song', room_id, payload)
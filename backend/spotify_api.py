@@ -0,0 +1,212 @@
+"""Spotify Web API calls on behalf of room hosts.
+
+A room calls Spotify with its host's token: this module finds the host,
+refreshes the token on demand and in the background, and caches track
+metadata. The client, token manager, track cache and the job queue that
+resolves tracks added asynchronously are set up by init_app(app).
+"""
+from datetime import datetime, timedelta
+import json
+
+from flask import jsonify
+import requests
+from sqlalchemy.orm import Session
+
+from extensions import db, app_context_runner, observe_job
+from jobs import make_job_queue
+from models import Room, Song, SpotifyToken, TrackMetadata
+from spotify_client import SpotifyClient
+from token_manager import TokenManager, RoomTokenCache
+from track_cache import TrackCache
+import logs
+
+log = logs.get_logger('toptrack.spotify')
+
+# Cached room -> host -> token lookups for the listener token poll
+room_token_cache = RoomTokenCache()
+
+# Set up by init_app()
+spotify = None
+token_manager = None
+track_cache = None
+jobs = None
+
+
+class TrackMetadataStore:
+    """Persistent tier of the track cache backed by the track_metadata table.
+
+    Writes go through a session of their own: the caller's request session
+    may hold work of its own that this must neither commit nor roll back.
+    """
+
+    def get(self, track_id, max_age):
+        row = TrackMetadata.query.get(track_id)
+        if row is None or row.fetched_at < datetime.utcnow() - timedelta(seconds=max_age):
+            return None
+        return json.loads(row.data)
+
+    def set(self, track_id, track_data):
+        try:
+            with Session(db.engine) as session, session.begin():
+                session.merge(TrackMetadata(spotify_track_id=track_id, data=json.dumps(track_data),
+                                            fetched_at=datetime.utcnow()))
+        except Exception as e:
+            log.warning('track_metadata_persist_failed', track_id=track_id, error=str(e))
+
+
+def song_from_track(room_id, track_id, spotify_url, added_by, track_data, now):
+    """Build an unsaved Song from Spotify track JSON"""
+    return Song(
+        room_id=room_id,
+        title=track_data['name'],
+        artist=', '.join([artist['name'] for artist in track_data['artists']]),
+        album=track_data['album']['name'],
+        spotify_url=spotify_url,
+        spotify_track_id=track_id,
+        duration_ms=track_data['duration_ms'],
+        duration=track_data['duration_ms'] // 1000,
+        image_url=track_data['album']['images'][0]['url'] if track_data['album']['images'] else None,
+        preview_url=track_data.get('preview_url'),
+        popularity=track_data.get('popularity', 0),
+        explicit=track_data.get('explicit', False),
+        added_by=added_by,
+        added_at=now,
+        vote_count=0,
+        is_played=False,
+        expires_at=now + timedelta(hours=1),  # Song expires in 1 hour
+        youtube_url=None
+    )
+
+def room_host(room_id):
+    """Host spotify_user_id of a room, or None if there is no such room"""
+    host_id = room_token_cache.host_for(room_id)
+    if host_id is None:
+        room = Room.query.filter_by(id=room_id).first()
+        if not room:
+            return None
+        host_id = room.host_id
+        room_token_cache.set_host(room_id, host_id)
+    return host_id
+
+def get_host_token(host_id):
+    """Return (spotify_token, None) for the room host, or (None, error response)"""
+    spotify_token = SpotifyToken.query.filter_by(spotify_user_id=host_id).first()
+    if not spotify_token:
+        return None, (jsonify({'error': 'Room host not authenticated with Spotify'}), 401)
+    token_manager.touch(host_id)
+    
+    # Check if token is expired and refresh if needed
+    if datetime.utcnow() >= spotify_token.expires_at:
+        log.info('token_expired', spotify_user=host_id)
+        if not refresh_spotify_token(spotify_token):
+            return None, (jsonify({'error': 'Failed to refresh Spotify token. Host may need to re-authenticate.'}), 401)
+    return spotify_token, None
+
+def spotify_api_get(spotify_token, path, params=None):
+    """GET a Spotify Web API path with the host's token, refreshing it once on 401"""
+    response = spotify.api_get(path, spotify_token.access_token, params)
+    if response.status_code == 401:
+        log.info('token_rejected', path=path)
+        if refresh_spotify_token(spotify_token):
+            response = spotify.api_get(path, spotify_token.access_token, params)
+    return response
+
+def parse_spotify_url(url):
+    """Return ('track' | 'playlist' | 'album', id) for a Spotify URL, or (None, None)"""
+    for kind in ('track', 'playlist', 'album'):
+        marker = f'spotify.com/{kind}/'
+        if isinstance(url, str) and marker in url:
+            spotify_id = url.split(marker)[1].split('?')[0].strip('/')
+            return (kind, spotify_id) if spotify_id else (None, None)
+    return None, None
+
+
+def refresh_spotify_token(spotify_token):
+    """Refresh a Spotify access token, sharing one in-flight refresh per user"""
+    ok, shared = token_manager.refresh(spotify_token.spotify_user_id,
+                                       lambda: exchange_refresh_token(spotify_token))
+    if ok and shared:
+        # Another greenlet refreshed and committed the row; pick up its new state
+        db.session.refresh(spotify_token)
+    return ok
+
+def exchange_refresh_token(spotify_token):
+    """Refresh expired Spotify access token"""
+    try:
+        refresh_response = spotify.refresh_token(spotify_token.refresh_token)
+        
+        if refresh_response.status_code == 200:
+            token_data = refresh_response.json()
+            
+            # Update token in database
+            spotify_token.access_token = token_data['access_token']
+            spotify_token.expires_at = datetime.utcnow() + timedelta(seconds=token_data['expires_in'])
+            spotify_token.updated_at = datetime.utcnow()
+            
+            # Update refresh token if provided (Spotify sometimes provides new one)
+            if 'refresh_token' in token_data:
+                spotify_token.refresh_token = token_data['refresh_token']
+            
+            db.session.commit()
+            room_token_cache.invalidate_host(spotify_token.spotify_user_id)
+            log.info('token_refreshed', spotify_user=spotify_token.spotify_user_id)
+            return True
+        else:
+            log.warning('token_refresh_failed', spotify_user=spotify_token.spotify_user_id,
+                        status=refresh_response.status_code, body=refresh_response.text[:200])
+            return False
+            
+    except requests.exceptions.Timeout:
+        log.warning('token_refresh_timeout', spotify_user=spotify_token.spotify_user_id)
+        return False
+        
+    except requests.exceptions.RequestException as e:
+        log.warning('token_refresh_network_error', spotify_user=spotify_token.spotify_user_id, error=str(e))
+        return False
+        
+    except Exception:
+        log.error('token_refresh_error', exc_info=True, spotify_user=spotify_token.spotify_user_id)
+        return False
+
+
+def load_tokens_due(margin, spotify_user_ids):
+    """Return which of the given users' tokens expire within `margin` seconds"""
+    cutoff = datetime.utcnow() + timedelta(seconds=margin)
+    tokens = SpotifyToken.query.with_entities(SpotifyToken.spotify_user_id).filter(
+        SpotifyToken.spotify_user_id.in_(spotify_user_ids),
+        SpotifyToken.expires_at <= cutoff
+    ).all()
+    return [token.spotify_user_id for token in tokens]
+
+def renew_spotify_token(spotify_user_id):
+    spotify_token = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
+    return spotify_token is not None and refresh_spotify_token(spotify_token)
+
+
+def init_app(app):
+    global spotify, token_manager, track_cache, jobs
+    config = app.config
+    # Pooled keep-alive connections shared by every greenlet making Spotify calls
+    spotify = SpotifyClient(
+        config['SPOTIFY_CLIENT_ID'], config['SPOTIFY_CLIENT_SECRET'],
+        api_base=config['SPOTIFY_API_BASE'],
+        accounts_base=config['SPOTIFY_ACCOUNTS_BASE'],
+        pool_size=config['SPOTIFY_POOL_SIZE'],
+        max_retries=config['SPOTIFY_MAX_RETRIES'],
+        max_retry_after=config['SPOTIFY_MAX_RETRY_AFTER'],
+        max_concurrency=config['SPOTIFY_MAX_CONCURRENCY'],
+        queue_timeout=config['SPOTIFY_QUEUE_TIMEOUT']
+    )
+    token_manager = TokenManager(load_tokens_due, renew_spotify_token,
+                                 renew_margin=config['TOKEN_RENEW_MARGIN'],
+                                 poll_interval=config['TOKEN_RENEW_INTERVAL'],
+                                 run_in_context=app_context_runner(app))
+    track_cache = TrackCache(max_entries=config['TRACK_CACHE_SIZE'],
+                             ttl=config['TRACK_CACHE_TTL'],
+                             store=TrackMetadataStore() if config['TRACK_CACHE_PERSIST'] else None)
+    jobs = make_job_queue(config['JOB_QUEUE'],
+                          workers=config['JOB_WORKERS'],
+                          max_pending=config['JOB_QUEUE_SIZE'],
+                          history=config['JOB_HISTORY_SIZE'],
+                          run_in_context=app_context_runner(app))
+    jobs.on_finished = observe_job
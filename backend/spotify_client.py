@@ -0,0 +1,177 @@
+"""Shared HTTP client for the Spotify Accounts and Web APIs.
+
+All Spotify calls go through one `requests.Session`, so connections to
+accounts.spotify.com and api.spotify.com are kept alive and reused instead
+of paying a TCP+TLS handshake per call. Under gevent the session's pool is
+shared by every greenlet; size it for the number of concurrent Spotify
+calls you expect.
+
+`max_concurrency` caps the calls in flight at once across all greenlets. A
+call that can't get a slot within `queue_timeout` seconds is not sent: it
+gets a local 429 answer, which callers already handle as Spotify's own.
+"""
+import base64
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logs
+
+log = logs.get_logger('toptrack.spotify')
+
+
+class SpotifyClient:
+    """Pooled, keep-alive Spotify client with 429 handling.
+
+    Rate-limited calls (429) are retried up to `max_retries` times, waiting
+    for the Retry-After the response asks for (or an exponential backoff if
+    it gives none). Waits longer than `max_retry_after` seconds are not
+    worth holding a request open for, so the 429 is returned instead.
+    """
+
+    def __init__(self, client_id, client_secret,
+                 api_base='https://api.spotify.com',
+                 accounts_base='https://accounts.spotify.com',
+                 pool_size=50, api_timeout=(3.05, 10), accounts_timeout=(3.05, 10),
+                 max_retries=2, max_retry_after=5.0, backoff=0.5, max_concurrency=0, queue_timeout=2.0):
+        self.api_base = api_base.rstrip('/')
+        self.accounts_base = accounts_base.rstrip('/')
+        self.api_timeout = api_timeout
+        self.accounts_timeout = accounts_timeout
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+        credentials = f"{client_id}:{client_secret}".encode('utf-8')
+        self._basic_auth = f"Basic {base64.b64encode(credentials).decode('utf-8')}"
+
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.retry_count = 0
+        self.error_count = 0
+        self.shed_count = 0
+        self.in_flight = 0
+
+    def _request(self, method, url, timeout, **kwargs):
+        attempt = 0
+        while True:
+            if self._slots is not None and not self._slots.acquire(timeout=self.queue_timeout):
+                self.shed_count += 1
+                log.warning('spotify_call_shed', method=method, url=url, in_flight=self.in_flight)
+                return self._busy_response(url)
+            self.request_count += 1
+            self.in_flight += 1
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.RequestException:
+                self.error_count += 1
+                raise
+            finally:
+                self.in_flight -= 1
+                if self._slots is not None:
+                    self._slots.release()
+            if response.status_code != 429:
+                return response
+
+            self.rate_limited_count += 1
+            delay = self._retry_delay(response, attempt)
+            if attempt >= self.max_retries or delay > self.max_retry_after:
+                return response
+            attempt += 1
+            self.retry_count += 1
+            log.warning('spotify_rate_limited', method=method, url=url, retry_in=round(delay, 2))
+            time.sleep(delay)
+
+    def _busy_response(self, url):
+        """A 429 answered locally for a call shed by the concurrency cap"""
+        response = requests.Response()
+        response.status_code = 429
+        response.url = url
+        response.headers['Retry-After'] = '1'
+        response._content = b'{"error": {"status": 429, "message": "Too many Spotify calls in flight"}}'
+        return response
+
+    def _retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After')
+        try:
+            return max(0.0, float(retry_after))
+        except (TypeError, ValueError):
+            return self.backoff * (2 ** attempt)
+
+    # Accounts API
+
+    def _token_request(self, data):
+        return self._request(
+            'POST',
+            f'{self.accounts_base}/api/token',
+            self.accounts_timeout,
+            data=data,
+            headers={
+                'Authorization': self._basic_auth,
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+        )
+
+    def exchange_code(self, code, redirect_uri):
+        return self._token_request({
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': redirect_uri,
+        })
+
+    def refresh_token(self, refresh_token):
+        return self._token_request({
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        })
+
+    # Web API
+
+    def api_get(self, path, access_token, params=None):
+        """GET a Web API path (e.g. '/v1/tracks/<id>') or a full `next` page URL"""
+        url = path if path.startswith('http') else f'{self.api_base}{path}'
+        return self._request(
+            'GET',
+            url,
+            self.api_timeout,
+            params=params,
+            headers={'Authorization': f'Bearer {access_token}'}
+        )
+
+    def stats(self):
+        pools = []
+        manager = self._adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            # The pool queue is pre-filled with None placeholders for unopened slots
+            idle = [conn for conn in list(pool.pool.queue) if conn is not None] if pool.pool is not None else []
+            pools.append({
+                'host': pool.host,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': len(idle)
+            })
+        return {
+            'pool_size': self.pool_size,
+            'requests': self.request_count,
+            'rate_limited': self.rate_limited_count,
+            'retries': self.retry_count,
+            'errors': self.error_count,
+            'max_concurrency': self.max_concurrency,
+            'in_flight': self.in_flight,
+            'shed': self.shed_count,
+            'pools': pools
+        }
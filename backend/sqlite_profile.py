@@ -0,0 +1,88 @@
+"""Production settings for running on SQLite under gevent.
+
+SQLite allows one writer at a time. With the default rollback journal a
+writer also blocks readers, and a connection that finds the database
+locked waits inside SQLite's busy handler, which under gevent blocks the
+whole worker, including the greenlet holding the lock. During vote storms
+that shows up as `database is locked` errors and stalls.
+
+The tuned profile switches to WAL (readers no longer wait for the writer),
+`synchronous=NORMAL` (no fsync per commit, still crash safe in WAL),
+memory-mapped reads and a busy_timeout, sizes the connection pool for many
+concurrent greenlets, and serialises writers at the greenlet level: a
+connection takes the write lock before its first write statement and
+holds it until its transaction ends, so writers queue up cooperatively
+instead of busy-waiting inside SQLite, while reads run concurrently.
+"""
+from gevent.lock import RLock
+from sqlalchemy import event
+
+_READ_ONLY = ('SELECT', 'PRAGMA', 'EXPLAIN', 'WITH')
+
+
+def engine_options(busy_timeout_ms=5000, pool_size=10, max_overflow=20, pool_timeout=30):
+    """SQLALCHEMY_ENGINE_OPTIONS for a file-backed SQLite database"""
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'connect_args': {
+            'timeout': busy_timeout_ms / 1000,
+            # Connections are handed between greenlets, which may sit on different threads
+            'check_same_thread': False
+        }
+    }
+
+
+class SQLiteProfile:
+    """Applies the PRAGMAs and the single-writer lock to an engine"""
+
+    def __init__(self, busy_timeout_ms=5000, mmap_size=256 * 1024 * 1024, synchronous='NORMAL'):
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self._write_lock = RLock()
+        self.write_transactions = 0
+        self.write_waits = 0
+
+    def install(self, engine):
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'commit', self._on_transaction_end)
+        event.listen(engine, 'rollback', self._on_transaction_end)
+        # Connections returned to the pool mid-transaction are rolled back there
+        event.listen(engine.pool, 'reset', self._on_reset)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={self.synchronous}')
+        cursor.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        cursor.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get('sqlite_writer') or statement.lstrip()[:7].upper().startswith(_READ_ONLY):
+            return
+        if self._write_lock.locked():
+            self.write_waits += 1
+        self._write_lock.acquire()
+        conn.info['sqlite_writer'] = True
+        self.write_transactions += 1
+
+    def _release(self, info):
+        if info.pop('sqlite_writer', False):
+            self._write_lock.release()
+
+    def _on_transaction_end(self, conn):
+        self._release(conn.info)
+
+    def _on_reset(self, dbapi_connection, connection_record, reset_state):
+        self._release(connection_record.info)
+
+    def stats(self):
+        return {
+            'write_transactions': self.write_transactions,
+            'write_waits': self.write_waits
+        }
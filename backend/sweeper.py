@@ -0,0 +1,95 @@
+"""Background sweeping of played and expired songs.
+
+Songs stay in the song table after they are played or expire, so without
+sweeping the table (and every queue query) grows without bound. The sweeper
+works in small batches, each its own short transaction, and sleeps between
+batches so it never holds the database write lock long enough to stall
+live voting.
+"""
+import time
+
+import gevent
+
+import logs
+
+log = logs.get_logger('toptrack.sweeper')
+
+
+class Sweeper:
+    """Periodic batched sweep.
+
+    Each pass calls `sweep_batch(batch_size)` until it returns fewer than
+    `batch_size` songs, then `prune_batch(batch_size)` the same way to apply
+    history retention. Both run through `run_in_context` (e.g. inside an app
+    context) and return (rows handled, {counter: increment}); the counters
+    are added up in stats().
+    """
+
+    def __init__(self, sweep_batch, prune_batch=None, interval=60, batch_size=500,
+                 pause=0.05, run_in_context=None):
+        self._sweep_batch = sweep_batch
+        self._prune_batch = prune_batch
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._run_in_context = run_in_context or (lambda fn: fn())
+        self._worker = None
+        self.passes = 0
+        self.batches = 0
+        self.songs_swept = 0
+        self.history_pruned = 0
+        self.counters = {}
+        self.errors = 0
+        self.last_pass_at = None
+        self.last_pass_seconds = None
+        self.max_batch_seconds = 0.0
+
+    def start(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pass()
+            except Exception as e:
+                self.errors += 1
+                log.error('sweep_failed', error=str(e))
+            gevent.sleep(self.interval)
+
+    def _batches(self, batch):
+        total = 0
+        while True:
+            start = time.perf_counter()
+            handled, extra = self._run_in_context(lambda: batch(self.batch_size))
+            self.max_batch_seconds = max(self.max_batch_seconds, time.perf_counter() - start)
+            self.batches += 1
+            for name, value in extra.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            total += handled
+            if handled < self.batch_size:
+                return total
+            # Let vote flushes and requests get the write lock between batches
+            gevent.sleep(self.pause)
+
+    def run_pass(self):
+        start = time.perf_counter()
+        self.songs_swept += self._batches(self._sweep_batch)
+        if self._prune_batch is not None:
+            self.history_pruned += self._batches(self._prune_batch)
+        self.passes += 1
+        self.last_pass_at = time.time()
+        self.last_pass_seconds = time.perf_counter() - start
+
+    def stats(self):
+        return {
+            'passes': self.passes,
+            'batches': self.batches,
+            'songs_swept': self.songs_swept,
+            'history_pruned': self.history_pruned,
+            'errors': self.errors,
+            'last_pass_at': self.last_pass_at,
+            'last_pass_seconds': round(self.last_pass_seconds, 4) if self.last_pass_seconds is not None else None,
+            'max_batch_seconds': round(self.max_batch_seconds, 4),
+            **self.counters
+        }
@@ -0,0 +1,18 @@
+import pytest
+
+
+@pytest.fixture
+def app(tmp_path):
+    """An app on a fresh SQLite file, with background flushes left to the test"""
+    from app import create_app
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "test.db"}',
+        'SPOTIFY_CLIENT_ID': 'test',
+        'SPOTIFY_CLIENT_SECRET': 'test',
+        'SECRET_KEY': 'test',
+        'SOCKETIO_MESSAGE_QUEUE': None,
+        'RATE_LIMITING': False,
+        'LOG_LEVEL': 'WARNING',
+        'VOTE_FLUSH_INTERVAL': 3600,
+        'ADVANCE_DEBOUNCE': 0
+    })
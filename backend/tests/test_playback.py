@@ -0,0 +1,67 @@
+"""PlaybackScheduler: the room's clock follows the host's player"""
+import time
+
+import gevent
+
+from playback import PlaybackScheduler
+
+
+def scheduler(ended, **options):
+    return PlaybackScheduler(lambda room_id: None, lambda room_id, song_id: ended.append(song_id),
+                             lambda: [], grace=0, **options)
+
+
+def test_song_ends_while_the_host_plays_it():
+    ended = []
+    playback = scheduler(ended)
+    playback.play('room', {'id': 'a', 'duration_ms': 100}, time.time())
+    assert playback.report('room', 'a', paused=False, position_ms=0)
+    gevent.sleep(0.2)
+    assert ended == ['a']
+
+
+def test_song_is_held_without_a_report():
+    ended = []
+    playback = scheduler(ended)
+    playback.play('room', {'id': 'a', 'duration_ms': 50}, time.time())
+    gevent.sleep(0.15)
+    assert ended == []
+    assert playback.stats()['songs_held'] == 1
+    # The host comes back past the end of the song: it ends now
+    playback.report('room', 'a', paused=False, position_ms=60)
+    gevent.sleep(0.05)
+    assert ended == ['a']
+
+
+def test_pausing_stops_the_clock():
+    ended = []
+    playback = scheduler(ended)
+    playback.play('room', {'id': 'a', 'duration_ms': 100}, time.time())
+    playback.report('room', 'a', paused=True, position_ms=40)
+    gevent.sleep(0.2)
+    assert ended == []
+    assert playback.position_ms('room') == 40
+    assert playback.stats()['timers'] == 0
+    playback.report('room', 'a', paused=False, position_ms=40)
+    gevent.sleep(0.03)
+    assert ended == []
+    gevent.sleep(0.1)
+    assert ended == ['a']
+
+
+def test_stale_report_holds_the_song():
+    ended = []
+    playback = scheduler(ended, report_timeout=0.05)
+    playback.play('room', {'id': 'a', 'duration_ms': 150}, time.time())
+    playback.report('room', 'a', paused=False, position_ms=0)
+    gevent.sleep(0.25)
+    assert ended == []
+
+
+def test_report_for_another_song_is_ignored():
+    ended = []
+    playback = scheduler(ended)
+    playback.play('room', {'id': 'b', 'duration_ms': 100}, time.time())
+    assert not playback.report('room', 'a', paused=True, position_ms=10)
+    assert not playback.paused('room')
+    assert playback.stats()['stale_reports'] == 1
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+from queue_index import QueueIndex, RoomQueue
+
+NOW = datetime(2026, 1, 1, 12, 0)
+
+
+def song(song_id, votes=0, track_id=None):
+    return {'id': song_id, 'vote_count': votes, 'spotify_track_id': track_id or f'track-{song_id}'}
+
+
+def test_ranked_by_votes_then_newest():
+    queue = RoomQueue()
+    queue.add(song('old', 1), NOW - timedelta(minutes=5))
+    queue.add(song('new', 1), NOW)
+    queue.add(song('top', 3), NOW - timedelta(minutes=10))
+    queue.add(song('none'), NOW)
+    assert [s['id'] for s in queue.top(10, NOW)] == ['top', 'new', 'old', 'none']
+    assert [s['id'] for s in queue.top(2, NOW)] == ['top', 'new']
+
+
+def test_set_votes_moves_a_song():
+    queue = RoomQueue()
+    queue.add(song('a', 2), NOW)
+    queue.add(song('b', 1), NOW)
+    queue.set_votes('b', 5)
+    assert [s['id'] for s in queue.top(10, NOW)] == ['b', 'a']
+    assert queue.get('b')['vote_count'] == 5
+    assert queue.set_votes('missing', 1) is None
+
+
+def test_pop_and_top_skip_expired_songs():
+    queue = RoomQueue()
+    queue.add(song('expired', 9), NOW - timedelta(hours=2), NOW - timedelta(minutes=1))
+    queue.add(song('fresh', 1), NOW, NOW + timedelta(hours=1))
+    assert [s['id'] for s in queue.top(10, NOW)] == ['fresh']
+    assert 'expired' not in queue
+    assert queue.pop(NOW)['id'] == 'fresh'
+    assert queue.pop(NOW) is None
+
+
+def test_reservations_claim_a_track_once():
+    queue = RoomQueue()
+    queue.add(song('a', track_id='queued'), NOW)
+    assert queue.reserve(['queued', 'new'], now=NOW) == (['new'], ['queued'], [])
+    assert queue.reserve(['new'], now=NOW) == ([], [], ['new'])
+    queue.release(['new'])
+    assert queue.reserve(['new'], now=NOW) == (['new'], [], [])
+    # Adding the song ends the claim and marks the track as queued
+    queue.add(song('b', track_id='new'), NOW)
+    assert queue.reserve(['new'], now=NOW) == ([], ['new'], [])
+    assert queue.reserve(['gone'], ttl=-1, now=NOW) == (['gone'], [], [])
+    assert queue.reserve(['gone'], now=NOW) == (['gone'], [], [])
+
+
+def test_index_loads_each_room_once():
+    loads = []
+
+    def loader(room_id):
+        loads.append(room_id)
+        return [(song('a', 1), NOW, None)]
+
+    index = QueueIndex(loader)
+    index.add('r', song('ignored'), NOW)
+    assert not index.is_loaded('r')
+    assert [s['id'] for s in index.top('r', 10, NOW)] == ['a']
+    index.add('r', song('b', 2), NOW)
+    index.set_votes('r', 'a', 3)
+    assert [s['id'] for s in index.top('r', 10, NOW)] == ['a', 'b']
+    assert loads == ['r']
+    index.discard('r')
+    index.top('r', 10, NOW)
+    assert loads == ['r', 'r']
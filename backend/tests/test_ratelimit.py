@@ -0,0 +1,81 @@
+import pytest
+
+from ratelimit import MemoryStore, RateLimiter, parse_limits
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_a_burst_then_refills():
+    clock = Clock()
+    store = MemoryStore(clock=clock)
+    assert [store.take('k', rate=1, burst=3) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert store.take('k', rate=1, burst=3) == 1.0
+    clock.now = 0.5
+    assert store.take('k', rate=1, burst=3) == 0.5
+    clock.now = 2.0
+    assert store.take('k', rate=1, burst=3) == 0.0
+
+
+def test_least_recently_used_buckets_are_dropped():
+    store = MemoryStore(max_keys=2, clock=Clock())
+    for key in ('a', 'b', 'a', 'c'):
+        store.take(key, rate=1, burst=1)
+    assert len(store) == 2
+    # 'b' was dropped, so it starts again with a full bucket
+    assert store.take('b', rate=1, burst=1) == 0.0
+    assert store.take('c', rate=1, burst=1) > 0
+
+
+def test_limits_are_per_action_user_and_room():
+    limiter = RateLimiter({'vote_song': (1, 1)}, MemoryStore(clock=Clock()))
+    assert limiter.check('vote_song', 'u1', 'r1') == 0.0
+    assert limiter.check('vote_song', 'u1', 'r1') > 0
+    assert limiter.check('vote_song', 'u2', 'r1') == 0.0
+    assert limiter.check('vote_song', 'u1', 'r2') == 0.0
+    assert limiter.check('unlimited', 'u1', 'r1') == 0.0
+    assert limiter.stats()['rejected'] == {'vote_song': 1}
+
+
+def test_store_failure_lets_requests_through():
+    class Broken:
+        def take(self, *args, **kwargs):
+            raise ConnectionError('redis down')
+
+        def __len__(self):
+            return 0
+
+    limiter = RateLimiter({'vote_song': (1, 1)}, Broken())
+    assert limiter.check('vote_song', 'u', 'r') == 0.0
+
+
+def test_parse_limits():
+    assert parse_limits('track_info=1/10, vote_song=2') == {'track_info': (1.0, 10.0), 'vote_song': (2.0, 2.0)}
+    assert parse_limits('') == {}
+
+
+def test_parse_limits_rejects_rates_that_never_refill():
+    for spec in ('vote_song=0', 'vote_song=0/5', 'vote_song=-1/5', 'vote_song=1/0'):
+        with pytest.raises(ValueError):
+            parse_limits(spec)
+
+
+def test_client_user_ids_are_kept_apart_per_address():
+    limiter = RateLimiter({'vote_song': (1, 1)}, MemoryStore(clock=Clock()), address_factor=3)
+    assert limiter.check_client('vote_song', 'victim', '10.0.0.1', 'r1') == 0.0
+    # Another address naming the same user has a bucket of its own
+    assert limiter.check_client('vote_song', 'victim', '10.0.0.2', 'r1') == 0.0
+    assert limiter.check_client('vote_song', 'victim', '10.0.0.1', 'r1') > 0
+
+
+def test_made_up_user_ids_share_their_address_bucket():
+    limiter = RateLimiter({'vote_song': (1, 1)}, MemoryStore(clock=Clock()), address_factor=3)
+    waits = [limiter.check_client('vote_song', f'user-{n}', '10.0.0.1', 'r1') for n in range(5)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert all(wait > 0 for wait in waits[3:])
+    assert limiter.check_client('vote_song', 'user-9', '10.0.0.2', 'r1') == 0.0
@@ -0,0 +1,11 @@
+"""Request parsing helpers in routes.py"""
+from routes import parse_flag
+
+
+def test_parse_flag():
+    for value in (True, 1, 'true', 'True', '1', 'yes', 'on'):
+        assert parse_flag(value) is True
+    for value in (False, 0, 'false', '0', 'no', 'off', ' OFF '):
+        assert parse_flag(value) is False
+    for value in ('maybe', '', 2, None, [], {}):
+        assert parse_flag(value) is None
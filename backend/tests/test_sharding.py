@@ -0,0 +1,84 @@
+"""ShardCoordinator: one owner per room, settling and handoffs between workers"""
+import gevent
+import pytest
+
+from pubsub import LocalBus, encode_frame, decode_frame
+from serialization import Encoded
+from sharding import HashRing, ShardCoordinator, ShardUnavailable
+
+
+def coordinator(bus, worker_id, log, loaded=(), **options):
+    options = {'heartbeat_interval': 0.05, 'worker_timeout': 0.3, 'call_timeout': 0.3,
+               'settle_time': 0.15, **options}
+    return ShardCoordinator(bus, {'vote': lambda payload: log.append((worker_id, payload)) or worker_id},
+                            worker_id=worker_id, loaded_rooms=lambda: list(loaded),
+                            on_rooms_lost=lambda room_ids: log.append((worker_id, 'lost', sorted(room_ids))),
+                            **options)
+
+
+def room_owned_by(worker_id, workers):
+    ring = HashRing(workers)
+    return next(f'room-{index}' for index in range(1000) if ring.owner(f'room-{index}') == worker_id)
+
+
+def test_a_starting_worker_owns_nothing_until_settled():
+    log = []
+    worker = coordinator(LocalBus(), 'a', log)
+    worker.start()
+    with pytest.raises(ShardUnavailable):
+        worker.call('vote', 'room', {})
+    assert not worker.run('vote', 'room', {})
+    gevent.sleep(0.2)
+    assert worker.call('vote', 'room', {'n': 1}) == 'a'
+
+
+def test_rooms_move_to_a_joining_worker_after_the_handoff():
+    log, bus = [], LocalBus()
+    old = coordinator(bus, 'a', log)
+    old.start()
+    gevent.sleep(0.2)
+    room = room_owned_by('b', ['a', 'b'])
+    old.call('vote', room, {})
+    old._loaded_rooms = lambda: [room]
+
+    new = coordinator(bus, 'b', log)
+    new.start()
+    gevent.sleep(0.1)
+    # The old owner let the room go; the new one isn't settled yet
+    assert ('a', 'lost', [room]) in log
+    assert old.owner(room) == 'b'
+    with pytest.raises(ShardUnavailable):
+        old.call('vote', room, {})
+    assert new.stats()['refused'] >= 1
+    gevent.sleep(0.2)
+    assert new.stats()['awaiting_handoff'] == []
+    assert old.call('vote', room, {'n': 2}) == 'b'
+    assert new.call('vote', room, {'n': 3}) == 'b'
+
+
+def test_a_new_owner_waits_for_the_handoff():
+    log, bus = [], LocalBus()
+    old = coordinator(bus, 'a', log)
+    old.start()
+    gevent.sleep(0.2)
+    # The old owner can't persist the room it loses, so it never hands it off
+    room = room_owned_by('b', ['a', 'b'])
+    old._loaded_rooms = lambda: [room]
+    old._on_rooms_lost = lambda room_ids: 1 / 0
+    new = coordinator(bus, 'b', log, worker_timeout=0.4)
+    new.start()
+    gevent.sleep(0.25)
+    assert new.stats()['awaiting_handoff'] == ['a']
+    assert not new.is_local(room)
+    gevent.sleep(0.5)
+    assert new.stats()['awaiting_handoff'] == []
+    assert new.is_local(room)
+
+
+def test_frames_are_json():
+    frame = encode_frame({'song': Encoded('{"id":"s"}'), 'songs': [Encoded('[]')]})
+    assert frame == b'{"song":{"$encoded":"{\\"id\\":\\"s\\"}"},"songs":[{"$encoded":"[]"}]}'
+    message = decode_frame(frame)
+    assert message['song'].raw == '{"id":"s"}'
+    assert decode_frame(b'\x80\x04K\x01.') is None
+    assert decode_frame(b'[1]') is None
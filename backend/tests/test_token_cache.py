@@ -0,0 +1,26 @@
+"""RoomTokenCache: bounded room -> host -> token lookups"""
+from datetime import datetime, timedelta
+
+from token_manager import RoomTokenCache
+
+
+def test_room_hosts_are_bounded_least_recently_used_first():
+    cache = RoomTokenCache(max_rooms=2)
+    cache.set_host('a', 'host-a')
+    cache.set_host('b', 'host-b')
+    assert cache.host_for('a') == 'host-a'
+    cache.set_host('c', 'host-c')
+    assert cache.host_for('b') is None
+    assert cache.host_for('a') == 'host-a'
+    assert cache.host_for('c') == 'host-c'
+
+
+def test_tokens_are_bounded_and_expire():
+    cache = RoomTokenCache(max_hosts=1)
+    later = datetime.utcnow() + timedelta(hours=1)
+    cache.set_token('h1', 'token-1', later)
+    cache.set_token('h2', 'token-2', later)
+    assert cache.token_for('h1') is None
+    assert cache.token_for('h2')[0] == 'token-2'
+    cache.set_token('h2', 'token-2', datetime.utcnow() - timedelta(seconds=1))
+    assert cache.token_for('h2') is None
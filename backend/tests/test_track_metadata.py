@@ -0,0 +1,17 @@
+"""TrackMetadataStore writes apart from the request's session"""
+from extensions import db
+from models import Room, TrackMetadata
+from spotify_api import TrackMetadataStore
+
+
+def test_set_leaves_the_request_session_alone(app):
+    with app.app_context():
+        room = Room(name='pending', host_id='host')
+        db.session.add(room)
+        TrackMetadataStore().set('track-1', {'name': 'Song'})
+        # The caller's pending room was neither committed nor thrown away
+        assert room in db.session.new
+        db.session.rollback()
+        assert Room.query.count() == 0
+        assert TrackMetadataStore().get('track-1', max_age=60) == {'name': 'Song'}
+        assert db.session.get(TrackMetadata, 'track-1') is not None
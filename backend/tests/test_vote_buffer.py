@@ -0,0 +1,101 @@
+import gevent
+import pytest
+
+from vote_buffer import VoteBuffer
+
+
+class Rejected(Exception):
+    pass
+
+
+def make_buffer(flusher=None, stored=None, **options):
+    written = []
+
+    def flush(changes):
+        written.append(dict(changes))
+        if flusher:
+            flusher(changes)
+
+    buffer = VoteBuffer(lambda room_id: dict(stored or {}), flush, flush_interval=3600, **options)
+    return buffer, written
+
+
+def test_vote_moves_and_toggles():
+    buffer, _ = make_buffer()
+    assert buffer.vote('r', 'u', 's1') == [('s1', 1)]
+    assert buffer.vote('r', 'u', 's2') == [('s1', -1), ('s2', 1)]
+    assert buffer.vote('r', 'u', 's2') == [('s2', -1)]
+    assert buffer.current_vote('r', 'u') is None
+
+
+def test_changes_merge_per_user_before_a_flush():
+    buffer, written = make_buffer(stored={'u': 's1'})
+    for song_id in ('s2', 's3', 's2', 's4'):
+        buffer.vote('r', 'u', song_id)
+    buffer.vote('r', 'v', 's1')
+    buffer.vote('r', 'v', 's1')
+    assert buffer.flush() == 1
+    assert written == [{('r', 'u'): ('s1', 's4')}]
+    assert buffer.pending_count() == 0
+
+
+def test_votes_arriving_during_a_flush_are_kept_for_the_next():
+    def slow(changes):
+        gevent.sleep(0.01)
+
+    buffer, written = make_buffer(slow)
+    buffer.vote('r', 'u', 's1')
+    flushing = gevent.spawn(buffer.flush)
+    gevent.sleep(0)
+    buffer.vote('r', 'u', 's2')
+    flushing.get()
+    buffer.flush()
+    assert written == [{('r', 'u'): (None, 's1')}, {('r', 'u'): ('s1', 's2')}]
+
+
+def test_failed_flush_is_retried_with_newer_votes_merged():
+    failures = [RuntimeError('database unavailable')]
+
+    def flaky(changes):
+        if failures:
+            raise failures.pop()
+
+    buffer, written = make_buffer(flaky)
+    buffer.vote('r', 'u', 's1')
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    assert buffer.pending_count() == 1
+    buffer.vote('r', 'u', 's2')
+    buffer.flush()
+    assert written[-1] == {('r', 'u'): (None, 's2')}
+    assert buffer.pending_count() == 0
+
+
+def test_rejected_change_is_dropped_and_the_rest_written():
+    def strict(changes):
+        if any(user_id is None for _, user_id in changes):
+            raise Rejected()
+
+    buffer, written = make_buffer(strict, rejected=(Rejected,))
+    buffer.vote('r', None, 's1')
+    for index in range(5):
+        buffer.vote('r', f'u{index}', 's1')
+    assert buffer.flush() == 6
+    stored = {key for batch in written if not any(user_id is None for _, user_id in batch) for key in batch}
+    assert stored == {('r', f'u{index}') for index in range(5)}
+    assert buffer.dropped == 1
+    assert buffer.current_vote('r', None) is None
+    assert buffer.pending_count() == 0
+    # Later flushes are not held up by it
+    buffer.vote('r', 'late', 's1')
+    assert buffer.flush() == 1
+
+
+def test_forget_song_drops_ballots_and_unwritten_votes():
+    buffer, written = make_buffer(stored={'a': 's1'})
+    buffer.vote('r', 'b', 's1')
+    buffer.vote('r', 'c', 's2')
+    buffer.forget_song('r', 's1')
+    assert buffer.current_vote('r', 'a') is None
+    buffer.flush()
+    assert written == [{('r', 'c'): (None, 's2')}]
@@ -0,0 +1,94 @@
+"""Votes end to end: the buffer, the queue and the database must agree"""
+import random
+
+import gevent
+import pytest
+from sqlalchemy import func
+
+from extensions import db
+from models import Room, Song, Vote
+import rooms
+
+
+@pytest.fixture
+def room(app):
+    with app.app_context():
+        room = Room(name='test', host_id='host')
+        db.session.add(room)
+        db.session.flush()
+        for index in range(5):
+            db.session.add(Song(room_id=room.id, spotify_track_id=f'track{index}', title=f'Song {index}',
+                                artist='Test', added_by='test', vote_count=0, is_played=False))
+        db.session.commit()
+        return room.id
+
+
+def song_ids(app, room_id):
+    with app.app_context():
+        return [song_id for song_id, in db.session.query(Song.id).filter_by(room_id=room_id).order_by(Song.title)]
+
+
+def vote(app, room_id, user_id, song_id):
+    with app.app_context():
+        rooms.vote_on_song({'room_id': room_id, 'user_id': user_id, 'song_id': song_id, 'sid': 'test'})
+
+
+def stored_votes(app, room_id):
+    with app.app_context():
+        counts = dict(db.session.query(Song.id, Song.vote_count).filter(Song.room_id == room_id,
+                                                                          Song.is_played == False))  # noqa: E712
+        rows = dict(db.session.query(Vote.song_id, func.count()).filter(Vote.room_id == room_id)
+                    .group_by(Vote.song_id))
+        per_user = db.session.query(Vote.user_id, func.count()).filter(Vote.room_id == room_id) \
+            .group_by(Vote.user_id).having(func.count() > 1).all()
+    return counts, rows, per_user
+
+
+def test_concurrent_votes_end_up_consistent(app, room):
+    songs = song_ids(app, room)
+    rng = random.Random(1)
+    # A storm of thousands of votes from a few hundred users, with flushes landing mid-storm
+    greenlets = [gevent.spawn_later(rng.random() * 0.5, vote, app, room, f'user{rng.randrange(300)}', rng.choice(songs))
+                 for _ in range(5000)]
+    greenlets += [gevent.spawn_later(rng.random() * 0.5, rooms.vote_buffer.flush) for _ in range(25)]
+    gevent.joinall(greenlets, raise_error=True)
+    rooms.vote_buffer.flush()
+
+    expected = {song_id: 0 for song_id in songs}
+    for song_id in rooms.vote_buffer.ballots(room).values():
+        expected[song_id] += 1
+    counts, rows, per_user = stored_votes(app, room)
+    queue = rooms.queue_index.room(room)
+    assert counts == expected
+    assert {song_id: rows.get(song_id, 0) for song_id in songs} == expected
+    assert {song_id: queue.get(song_id)['vote_count'] for song_id in songs} == expected
+    assert per_user == []
+
+
+def test_invalid_votes_never_reach_the_buffer(app, room):
+    songs = song_ids(app, room)
+    vote(app, room, None, songs[0])
+    vote(app, room, 'x' * 101, songs[0])
+    assert rooms.vote_buffer.pending_count() == 0
+
+
+def test_playing_a_song_spends_its_votes(app, room):
+    songs = song_ids(app, room)
+    vote(app, room, 'a', songs[0])
+    vote(app, room, 'b', songs[0])
+    rooms.vote_buffer.flush()
+    vote(app, room, 'c', songs[0])  # not written yet when the song starts
+    with app.app_context():
+        rooms.advance_queue({'room_id': room})
+    assert rooms.playback.now_playing(room)[0]['id'] == songs[0]
+    rooms.vote_buffer.flush()
+    vote(app, room, 'a', songs[1])
+    vote(app, room, 'c', songs[1])
+    rooms.vote_buffer.flush()
+
+    counts, rows, per_user = stored_votes(app, room)
+    assert rows == {songs[1]: 2}
+    assert per_user == []
+    # A worker that reloads the room sees the same ballots
+    with app.app_context():
+        assert rooms.load_room_votes(room) == {'a': songs[1], 'c': songs[1]}
@@ -0,0 +1,165 @@
+"""Spotify token refresh coordination.
+
+Concurrent refreshes of the same user's token are collapsed into one
+in-flight request (single-flight): the first caller does the refresh and
+everyone else waits for its result. A background greenlet also renews
+tokens shortly before they expire, so request handlers normally find a
+fresh token and never have to refresh inline. Only tokens that were used
+recently are renewed, so hosts who left long ago cost nothing.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import time
+
+import gevent
+from gevent.event import AsyncResult
+
+import logs
+
+log = logs.get_logger('toptrack.tokens')
+
+
+class TokenManager:
+    """Single-flight token refreshes plus proactive background renewal.
+
+    `due_loader(margin, spotify_user_ids)` returns those of the given users
+    whose tokens expire within `margin` seconds; `renewer(spotify_user_id)`
+    refreshes one of them and returns True on success. Both run inside the
+    background loop, which `run_in_context` wraps (e.g. to push an app
+    context). Call `touch()` whenever a user's token is handed out.
+    """
+
+    def __init__(self, due_loader, renewer, renew_margin=600, poll_interval=60,
+                 active_window=3600, retry_after=300, run_in_context=None):
+        self._due_loader = due_loader
+        self._renewer = renewer
+        self.renew_margin = renew_margin
+        self.poll_interval = poll_interval
+        self.active_window = active_window
+        self.retry_after = retry_after
+        self._run_in_context = run_in_context or (lambda fn: fn())
+        self._inflight = {}   # spotify_user_id -> AsyncResult
+        self._failed_at = {}  # spotify_user_id -> monotonic time of last failed renewal
+        self._used_at = {}    # spotify_user_id -> monotonic time the token was last handed out
+        self._worker = None
+        self.refreshes = 0
+        self.shared_refreshes = 0
+        self.background_renewals = 0
+
+    def refresh(self, spotify_user_id, do_refresh):
+        """Run `do_refresh()` unless a refresh for this user is already in flight.
+
+        Returns (ok, shared): shared is True when another greenlet did the
+        refresh and the caller only waited for it.
+        """
+        pending = self._inflight.get(spotify_user_id)
+        if pending is not None:
+            self.shared_refreshes += 1
+            return pending.get(), True
+
+        result = AsyncResult()
+        self._inflight[spotify_user_id] = result
+        ok = False
+        try:
+            self.refreshes += 1
+            ok = bool(do_refresh())
+        finally:
+            del self._inflight[spotify_user_id]
+            result.set(ok)
+        return ok, False
+
+    def touch(self, spotify_user_id):
+        """Mark a user's token as in use so the background loop keeps it fresh"""
+        self._used_at[spotify_user_id] = time.monotonic()
+        self.start()
+
+    def start(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self._run_in_context(self.renew_due)
+            except Exception as e:
+                log.error('token_renewal_failed', error=str(e))
+            gevent.sleep(self.poll_interval)
+
+    def renew_due(self):
+        now = time.monotonic()
+        for spotify_user_id in [u for u, used_at in self._used_at.items() if now - used_at > self.active_window]:
+            del self._used_at[spotify_user_id]
+            self._failed_at.pop(spotify_user_id, None)
+        if not self._used_at:
+            return
+        for spotify_user_id in self._due_loader(self.renew_margin, list(self._used_at)):
+            failed_at = self._failed_at.get(spotify_user_id)
+            if failed_at is not None and now - failed_at < self.retry_after:
+                continue
+            if self._renewer(spotify_user_id):
+                self.background_renewals += 1
+                self._failed_at.pop(spotify_user_id, None)
+            else:
+                self._failed_at[spotify_user_id] = now
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'shared_refreshes': self.shared_refreshes,
+            'background_renewals': self.background_renewals,
+            'in_flight': len(self._inflight),
+            'active_users': len(self._used_at)
+        }
+
+
+class RoomTokenCache:
+    """room_id -> host -> access token resolution without DB queries.
+
+    A room's host never changes, so room -> host entries only leave when
+    they are the least recently used of more than `max_rooms`. Host tokens
+    are cached until they are invalidated by a refresh or a new login, they
+    expire, or they are the least recently used of more than `max_hosts`.
+    A stale entry in another worker is still safe to serve: Spotify keeps an
+    access token valid until its own expiry even after it was refreshed.
+    """
+
+    def __init__(self, max_rooms=10000, max_hosts=10000):
+        self.max_rooms = max_rooms
+        self.max_hosts = max_hosts
+        self._room_hosts = OrderedDict()   # room_id -> host spotify_user_id, oldest use first
+        self._host_tokens = OrderedDict()  # host spotify_user_id -> (access_token, expires_at, etag)
+
+    def host_for(self, room_id):
+        host_id = self._room_hosts.get(room_id)
+        if host_id is not None:
+            self._room_hosts.move_to_end(room_id)
+        return host_id
+
+    def set_host(self, room_id, host_id):
+        self._room_hosts[room_id] = host_id
+        self._room_hosts.move_to_end(room_id)
+        while len(self._room_hosts) > self.max_rooms:
+            self._room_hosts.popitem(last=False)
+
+    def token_for(self, host_id):
+        entry = self._host_tokens.get(host_id)
+        if entry is None:
+            return None
+        if entry[1] <= datetime.utcnow():
+            del self._host_tokens[host_id]
+            return None
+        self._host_tokens.move_to_end(host_id)
+        return entry
+
+    def set_token(self, host_id, access_token, expires_at):
+        etag = hashlib.sha256(access_token.encode('utf-8')).hexdigest()[:32]
+        entry = (access_token, expires_at, etag)
+        self._host_tokens[host_id] = entry
+        self._host_tokens.move_to_end(host_id)
+        while len(self._host_tokens) > self.max_hosts:
+            self._host_tokens.popitem(last=False)
+        return entry
+
+    def invalidate_host(self, host_id):
+        self._host_tokens.pop(host_id, None)
@@ -0,0 +1,76 @@
+"""Spotify track metadata cache.
+
+Track metadata is the same for every room, so a track that was added
+anywhere recently can be served without calling Spotify again. Entries live
+in an in-process LRU with a TTL and, optionally, in a persistent store that
+survives restarts and is shared by every worker using the same database.
+"""
+from collections import OrderedDict
+import time
+
+
+class TrackCache:
+    """LRU + TTL cache of Spotify track JSON keyed by spotify_track_id.
+
+    `store`, if given, is the persistent tier: an object with
+    `get(track_id, max_age)` returning the track dict or None, and
+    `set(track_id, track_data)`.
+    """
+
+    def __init__(self, max_entries=5000, ttl=24 * 3600, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self._entries = OrderedDict()  # track_id -> (stored_at, track_data)
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, track_id):
+        entry = self._entries.get(track_id)
+        if entry is not None:
+            if time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(track_id)
+                self.hits += 1
+                return entry[1]
+            del self._entries[track_id]
+
+        if self.store is not None:
+            track_data = self.store.get(track_id, self.ttl)
+            if track_data is not None:
+                self._put(track_id, track_data)
+                self.store_hits += 1
+                return track_data
+
+        self.misses += 1
+        return None
+
+    def set(self, track_id, track_data):
+        self._put(track_id, track_data)
+        if self.store is not None:
+            self.store.set(track_id, track_data)
+
+    def _put(self, track_id, track_data):
+        self._entries[track_id] = (time.monotonic(), track_data)
+        self._entries.move_to_end(track_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.store_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl,
+            'persistent': self.store is not None,
+            'hits': self.hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round((self.hits + self.store_hits) / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,185 @@
+"""Write-behind vote ingestion.
+
+Votes are applied to an in-memory ballot box (one ballot per user per room)
+as soon as they arrive, and the resulting changes are written to the
+database in batches by a background greenlet. Only the net change per
+(room, user) since the last flush is kept, so a user flipping between songs
+during a vote storm costs one row change instead of one per click.
+"""
+import gevent
+from gevent.lock import Semaphore
+
+import logs
+
+log = logs.get_logger('toptrack.votes')
+
+
+class VoteBuffer:
+    """In-memory ballots with batched, single-transaction flushes.
+
+    `loader(room_id)` returns the persisted {user_id: song_id} ballots of a
+    room and is called once per room. `flusher(changes)` receives
+    {(room_id, user_id): (old_song_id, new_song_id)} and must persist it in
+    one transaction, raising on failure. It may return the stored counts as
+    {song_id: (room_id, vote_count)}; `on_persisted(room_id, song_id,
+    vote_count)` is then called with each count plus the changes that
+    arrived while the batch was being written, i.e. what the in-memory
+    count should be.
+
+    A batch failing with one of `rejected` (errors the database raises for
+    bad rows rather than for being unavailable) is split until the changes
+    it rejects are found; those are dropped and the rest are written. Any
+    other failure puts the batch back to be retried by the next flush.
+    """
+
+    def __init__(self, loader, flusher, flush_interval=0.5, max_batch=200, on_persisted=None,
+                 rejected=()):
+        self._loader = loader
+        self._flusher = flusher
+        self._on_persisted = on_persisted
+        self._rejected = tuple(rejected)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._ballots = {}   # room_id -> {user_id: song_id}
+        self._pending = {}   # (room_id, user_id) -> [persisted song_id, latest song_id]
+        self._flush_lock = Semaphore()
+        self._worker = None
+        self.dropped = 0
+
+    def ballots(self, room_id):
+        room_ballots = self._ballots.get(room_id)
+        if room_ballots is None:
+            loaded = dict(self._loader(room_id))
+            room_ballots = self._ballots.setdefault(room_id, loaded)
+        return room_ballots
+
+    def current_vote(self, room_id, user_id):
+        return self.ballots(room_id).get(user_id)
+
+    def vote(self, room_id, user_id, song_id):
+        """Apply a vote and return the resulting [(song_id, delta)] changes.
+
+        Voting for the song you already voted for removes the vote; voting
+        for another song moves it there.
+        """
+        room_ballots = self.ballots(room_id)
+        previous = room_ballots.get(user_id)
+        changes = []
+        if previous is not None:
+            changes.append((previous, -1))
+        if previous == song_id:
+            del room_ballots[user_id]
+            latest = None
+        else:
+            room_ballots[user_id] = song_id
+            changes.append((song_id, 1))
+            latest = song_id
+
+        key = (room_id, user_id)
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = [previous, latest]
+        else:
+            pending[1] = latest
+
+        self._ensure_worker()
+        if len(self._pending) >= self.max_batch:
+            gevent.spawn(self.flush)
+        return changes
+
+    def forget_song(self, room_id, song_id):
+        """Drop ballots for a song that left the queue, whose stored votes the caller deletes"""
+        room_ballots = self._ballots.get(room_id)
+        if room_ballots:
+            for user_id in [u for u, s in room_ballots.items() if s == song_id]:
+                del room_ballots[user_id]
+        # A vote for it that isn't written yet must not be written afterwards
+        for (pending_room_id, _), pending in self._pending.items():
+            if pending_room_id == room_id and pending[1] == song_id:
+                pending[1] = None
+
+    def forget_room(self, room_id):
+        """Persist pending changes, then drop a room's ballots so they reload on next use"""
+        self.flush()
+        self._ballots.pop(room_id, None)
+
+    def loaded_rooms(self):
+        return list(self._ballots)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write all pending ballot changes, in one transaction unless some are rejected"""
+        with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            changes = {key: (old, new) for key, (old, new) in batch.items() if old != new}
+            if not changes:
+                return 0
+            failed = {}
+            error = self._write(changes, failed)
+            if failed:
+                # Put what wasn't written back underneath anything that arrived meanwhile
+                for key in failed:
+                    old, new = batch[key]
+                    newer = self._pending.get(key)
+                    self._pending[key] = [old, newer[1] if newer else new]
+                raise error
+            return len(changes)
+
+    def _write(self, changes, failed):
+        """Flush `changes`, splitting them on a rejection. Changes that could not be
+        written for another reason are added to `failed`; returns that error."""
+        try:
+            persisted = self._flusher(changes)
+        except self._rejected as e:
+            if len(changes) == 1:
+                (room_id, user_id), (old, new) = next(iter(changes.items()))
+                self.dropped += 1
+                # The ballot goes back to what is stored
+                room_ballots = self._ballots.get(room_id)
+                if room_ballots is not None and room_ballots.get(user_id) == new:
+                    if old is None:
+                        room_ballots.pop(user_id, None)
+                    else:
+                        room_ballots[user_id] = old
+                log.error('vote_change_dropped', room_id=room_id, user_id=user_id,
+                          old_song_id=old, new_song_id=new, error=(str(e) or type(e).__name__).splitlines()[0])
+                return None
+            items = list(changes.items())
+            half = len(items) // 2
+            first = self._write(dict(items[:half]), failed)
+            return self._write(dict(items[half:]), failed) or first
+        except Exception as e:
+            failed.update(changes)
+            return e
+        if persisted and self._on_persisted:
+            unflushed = self._pending_deltas()
+            for song_id, (room_id, vote_count) in persisted.items():
+                self._on_persisted(room_id, song_id, vote_count + unflushed.get(song_id, 0))
+        return None
+
+    def _pending_deltas(self):
+        deltas = {}
+        for old, new in self._pending.values():
+            if old == new:
+                continue
+            if old is not None:
+                deltas[old] = deltas.get(old, 0) - 1
+            if new is not None:
+                deltas[new] = deltas.get(new, 0) + 1
+        return deltas
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error('vote_flush_failed', error=str(e))
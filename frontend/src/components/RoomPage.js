@@ -11,9 +11,14 @@ const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:5000';
 export const getSpotifyToken = async (roomId) => {
   try {
     const response = await axios.get(`${API_URL}/api/spotify/token/room/${roomId}`);
+    // The response may come from the HTTP cache, so prefer the absolute
+    // expiry over expires_in, which was computed when it was first served
+    const expiresAt = response.data.expires_at
+      ? Date.parse(response.data.expires_at)
+      : Date.now() + response.data.expires_in * 1000;
     return {
       accessToken: response.data.access_token,
-      expiresIn: response.data.expires_in
+      expiresIn: Math.floor((expiresAt - Date.now()) / 1000)
     };
   } catch (error) {
     console.error('Failed to get Spotify token:', error);
@@ -49,6 +54,8 @@ const RoomPage = () => {
   // Use ref to persist socket instance and other values
   const socketRef = useRef(null);
   const tokenRefreshTimeoutRef = useRef(null);
+  // Last queue version SongQ applied, sent on (re)join so we only get what we missed
+  const queueSyncRef = useRef({ version: null, epoch: null });
 
   // Cleanup function
   const cleanup = useCallback(() => {
@@ -157,24 +164,31 @@ const RoomPage = () => {
     }
   }, [searchParams, roomId, navigate]);
 
-  // Define event handlers using useCallback to maintain reference stability
+  // Define event handlers using useCallback to maintain reference stability.
+  // next_song comes from the server's playback clock: what the room is playing
+  // and how far into it (position_ms), also sent to us when we (re)join
   const handleNextSong = useCallback((data) => {
     console.log('[Socket.IO] Next song event received:', {
       data,
       timestamp: new Date().toISOString()
     });
     
-    if (data.current_song) {
-      const formattedTrack = {
-        uri: `spotify:track:${data.current_song.spotify_track_id}`,
-        title: data.current_song.title,
-        artist: data.current_song.artist,
-        albumArt: data.current_song.image_url,
-        duration_ms: data.current_song.duration_ms
-      };
-      console.log('[Playback] Updating current song to:', formattedTrack);
-      setCurrentSong(formattedTrack);
+    if (!data.current_song) {
+      setCurrentSong(null);
+      return;
     }
+    const formattedTrack = {
+      id: data.current_song.id,
+      uri: `spotify:track:${data.current_song.spotify_track_id}`,
+      title: data.current_song.title,
+      artist: data.current_song.artist,
+      albumArt: data.current_song.image_url,
+      duration_ms: data.current_song.duration_ms,
+      // Local time the song started, so the player can join it mid-track
+      startedAt: Date.now() - (data.position_ms || 0)
+    };
+    // Same song again (e.g. after a reconnect): keep playing, don't restart it
+    setCurrentSong((previous) => (previous?.id === formattedTrack.id ? previous : formattedTrack));
   }, []);
 
   const handleAnyEvent = useCallback((eventName, ...args) => {
@@ -222,7 +236,9 @@ const RoomPage = () => {
         room_id: roomId,
         user_id: userId,
         username: username,
-        role: userRole
+        role: userRole,
+        queue_version: queueSyncRef.current.version,
+        queue_epoch: queueSyncRef.current.epoch
       });
     });
 
@@ -251,6 +267,12 @@ const RoomPage = () => {
       setError(data.message || 'A socket error occurred');
     });
 
+    // The room is moving between server workers and our last action wasn't taken
+    socket.on('room_unavailable', (data) => {
+      console.warn('[Socket.IO] Room unavailable:', data);
+      setError('The room is busy for a moment, please try again');
+    });
+
     socket.on('reconnect_attempt', (attemptNumber) => {
       console.log('[Socket.IO] Reconnection attempt:', {
         attempt: attemptNumber,
@@ -269,30 +291,11 @@ const RoomPage = () => {
         currentUserId: userId
       });
       setRoom(data.room || { id: roomId, name: data.room_name || 'Unknown Room' });
-      setCurrentSong(data.current_song);
       setIsLoading(false);
     });
 
     // Set up event handlers
-    socket.on('next_song', (data) => {
-      console.log('[Socket.IO] Next song event received:', {
-        data,
-        socketId: socket.id,
-        timestamp: new Date().toISOString()
-      });
-      
-      if (data.current_song) {
-        const formattedTrack = {
-          uri: `spotify:track:${data.current_song.spotify_track_id}`,
-          title: data.current_song.title,
-          artist: data.current_song.artist,
-          albumArt: data.current_song.image_url,
-          duration_ms: data.current_song.duration_ms
-        };
-        console.log('[Playback] Updating current song to:', formattedTrack);
-        setCurrentSong(formattedTrack);
-      }
-    });
+    socket.on('next_song', handleNextSong);
 
     socket.onAny((eventName, ...args) => {
       console.log('[Socket.IO] Event received:', {
@@ -316,7 +319,7 @@ const RoomPage = () => {
       }
       cleanup();
     };
-  }, [userId, username, roomId, userRole, cleanup]);
+  }, [userId, username, roomId, userRole, cleanup, handleNextSong]);
 
   // Handle room leave
   const handleLeaveRoom = useCallback(async () => {
@@ -393,7 +396,8 @@ const RoomPage = () => {
     try {
       const response = await axios.post(`${API_URL}/api/spotify/track-info`, {
         spotify_url: url,
-        room_id: roomId
+        room_id: roomId,
+        user_id: userId
       });
       
       return {
@@ -410,14 +414,28 @@ const RoomPage = () => {
       console.error('Failed to get Spotify track info:', error);
       throw new Error('Failed to get track information from Spotify');
     }
-  }, [roomId]);
+  }, [roomId, userId]);
 
   // Handle adding songs to queue
   const handleAddSong = useCallback(async () => {
     if (!songInput.trim() || !socketRef.current) return;
 
     try {
-      
+      // Several links, or a playlist/album link, go through the bulk endpoint;
+      // the new songs arrive through the songs_added socket event
+      const urls = songInput.trim().split(/\s+/);
+      if (urls.length > 1 || /spotify\.com\/(playlist|album)\//.test(urls[0])) {
+        console.log('[Queue] Bulk adding songs:', urls);
+        await axios.post(`${API_URL}/api/spotify/tracks/bulk`, {
+          spotify_urls: urls,
+          room_id: roomId,
+          user_id: userId,
+          added_by: username
+        });
+        setSongInput('');
+        return;
+      }
+
       const songData = await extractSongData(songInput);
       
       if (songData) {
@@ -435,18 +453,21 @@ const RoomPage = () => {
     } finally {
     
     }
-  }, [songInput, roomId, userId, extractSongData]);
+  }, [songInput, roomId, userId, username, extractSongData]);
 
-  // Request next song from queue
+  // Request next song from queue. The server advances the room by itself when a
+  // song ends; naming the song we are skipping makes repeated requests (track-end
+  // detection, double clicks) harmless, as only the first one advances
   const requestNextSong = useCallback(() => {
     if (userRole === 'host' && socketRef.current) {
       console.log('[Socket.IO] Requesting next song from queue');
       socketRef.current.emit('get_next_song', {
         room_id: roomId,
-        user_id: userId
+        user_id: userId,
+        current_song_id: currentSong?.id ?? null
       });
     }
-  }, [roomId, userId, userRole]);
+  }, [roomId, userId, userRole, currentSong]);
 
   // Cleanup on unmount
   useEffect(() => {
@@ -505,6 +526,7 @@ const RoomPage = () => {
             currentSong={currentSong}
             onNextSong={requestNextSong}
             roomId={roomId}
+            userId={userId}
             socket={socketRef.current}
           />
         ) : currentSong ? (
@@ -552,6 +574,7 @@ const RoomPage = () => {
         roomId={roomId} 
         userId={userId} 
         socket={socketRef.current}
+        syncRef={queueSyncRef}
       />}
     
   </div>
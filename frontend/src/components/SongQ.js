@@ -2,7 +2,7 @@ import React, { useEffect, useState } from 'react';
 import './SongQ.css';
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:5000';
 
-const SongQ = ({ roomId, userId, socket }) => {
+const SongQ = ({ roomId, userId, socket, syncRef }) => {
   const [songs, setSongs] = useState([]);
   const [loading, setLoading] = useState(true);
   const [userVoteSongId, setUserVoteSongId] = useState(null);
@@ -15,18 +15,91 @@ const SongQ = ({ roomId, userId, socket }) => {
 
     console.log('[Socket.IO] Setting up SongQ listeners for room:', roomId);
 
+    // Version of the last queue change applied; a gap means we missed one.
+    // Versions restart when the room moves to another server worker, which
+    // shows up as a new epoch. Kept in syncRef so RoomPage can send it when
+    // it rejoins after a reconnect.
+    const sync = syncRef ? syncRef.current : { version: null, epoch: null };
+    sync.version = null;
+    sync.epoch = null;
+
+    const applySnapshot = (data) => {
+        sync.version = data.version ?? null;
+        sync.epoch = data.epoch ?? null;
+        setSongs(data.songs || []);
+    };
+
+    // One refetch at a time: versioned changes arriving while it is in flight
+    // are held and replayed on top of the snapshot, instead of each of them
+    // finding a gap and starting another refetch
+    let resyncing = false;
+    let held = [];
+    let active = true;
+
     const fetchQueue = async () => {
+        if (resyncing) {
+            return;
+        }
+        resyncing = true;
+        let fetched = false;
         try {
             const res = await fetch(`${API_URL}/api/room/${roomId}/queue`);
             const data = await res.json();
-            console.log('[Queue] Fetched initial queue:', data.songs);
-            setSongs(data.songs || []);
-            setLoading(false);
-
+            if (active) {
+                console.log('[Queue] Fetched queue:', data.songs);
+                applySnapshot(data);
+                fetched = true;
+            }
         } catch (error) {
             console.error('[Queue] Failed to fetch:', error);
-            setLoading(false);
+        } finally {
+            resyncing = false;
+            const replay = held;
+            held = [];
+            if (active) {
+                setLoading(false);
+                // Without a snapshot the held changes can't be ordered; the next
+                // change after a gap refetches again
+                if (fetched) {
+                    replay.forEach(([apply, data]) => versioned(apply)(data));
+                }
+            }
+        }
+    };
+
+    // Apply a versioned queue change in order, refetching the queue on a gap
+    const versioned = (apply) => (data) => {
+        if (!data || data.version === undefined) {
+            apply(data);
+            return;
+        }
+        if (resyncing) {
+            held.push([apply, data]);
+            return;
+        }
+        // Without a versioned snapshot there is nothing to order against
+        if (sync.version === null) {
+            apply(data);
+            return;
+        }
+        if ((data.epoch ?? null) !== sync.epoch) {
+            console.log('[Socket.IO] Queue moved to another worker, refetching queue');
+            fetchQueue();
+            return;
+        }
+        if (data.version <= sync.version) {
+            return;
         }
+        if (data.version !== sync.version + 1) {
+            console.log('[Socket.IO] Missed queue changes, refetching queue:', {
+                have: sync.version,
+                got: data.version
+            });
+            fetchQueue();
+            return;
+        }
+        sync.version = data.version;
+        apply(data);
     };
 
     // Define event handlers
@@ -43,10 +116,22 @@ const SongQ = ({ roomId, userId, socket }) => {
                 newSong: data.song
             });
             // Sort by vote count after adding new song
-            return [...prev, data.song].sort((a, b) => b.vote_count - a.vote_count);
+            return [...prev.filter(song => song.id !== data.song.id), data.song]
+                .sort((a, b) => b.vote_count - a.vote_count);
         });
     };
 
+    const handleSongsAdded = (data) => {
+        console.log('[Socket.IO] Songs added event received:', data);
+        if (!data || !Array.isArray(data.songs)) {
+            console.error('[Socket.IO] Invalid songs data received');
+            return;
+        }
+        const added = new Set(data.songs.map(song => song.id));
+        setSongs(prev => [...prev.filter(song => !added.has(song.id)), ...data.songs]
+            .sort((a, b) => b.vote_count - a.vote_count));
+    };
+
     const handleSongVoted = (data) => {
     console.log('[Socket.IO] Vote event received:', data);
     
@@ -68,6 +153,17 @@ const SongQ = ({ roomId, userId, socket }) => {
     if (data.user_id === userId) {
         setUserVoteSongId(data.vote_type === 'removed' ? null : data.song_id);
     }};
+    const handleQueueDelta = (data) => {
+    if (!data || !data.votes) {
+        console.error('[Socket.IO] Invalid queue delta received');
+        return;
+    }
+    setSongs(prev => prev
+        .map(song => song.id in data.votes
+            ? { ...song, vote_count: data.votes[song.id] }
+            : song)
+        .sort((a, b) => b.vote_count - a.vote_count));
+    };
     const handleSongRemoved = (data) => {
     console.log('[Socket.IO] Song removed event received:', data);
     if (!data || !data.song_id) {
@@ -77,22 +173,50 @@ const SongQ = ({ roomId, userId, socket }) => {
     setSongs(prev => prev.filter(song => song.id !== data.song_id));
     };
 
+    const handlers = {
+        song_added: versioned(handleSongAdded),
+        songs_added: versioned(handleSongsAdded),
+        queue_delta: versioned(handleQueueDelta),
+        song_removed: versioned(handleSongRemoved)
+    };
+
+    // Answer to a rejoin: either the changes we missed or a fresh snapshot
+    const handleQueueSync = (data) => {
+        console.log('[Socket.IO] Queue sync received:', data);
+        if (!data) {
+            return;
+        }
+        if (Array.isArray(data.deltas)) {
+            data.deltas.forEach(delta => handlers[delta.event] && handlers[delta.event](delta.data));
+        } else {
+            applySnapshot(data);
+        }
+    };
+
     // Fetch initial queue
     fetchQueue();
 
     // Set up socket event listeners
-    socket.on('song_added', handleSongAdded);
+    socket.on('song_added', handlers.song_added);
+    socket.on('songs_added', handlers.songs_added);
     socket.on('song_voted', handleSongVoted);
-    socket.on('song_removed', handleSongRemoved);
+    socket.on('queue_delta', handlers.queue_delta);
+    socket.on('song_removed', handlers.song_removed);
+    socket.on('queue_sync', handleQueueSync);
 
     // Cleanup function
     return () => {
         console.log('[Socket.IO] Cleaning up SongQ listeners');
-        socket.off('song_added', handleSongAdded);
+        active = false;
+        socket.off('song_added', handlers.song_added);
+        socket.off('songs_added', handlers.songs_added);
         socket.off('song_voted', handleSongVoted);
+        socket.off('queue_delta', handlers.queue_delta);
+        socket.off('song_removed', handlers.song_removed);
+        socket.off('queue_sync', handleQueueSync);
       
     };
-  }, [roomId, userId, socket]);
+  }, [roomId, userId, socket, syncRef]);
 
  const handleVote = async (songId) => {
     if (!socket) {
@@ -15,7 +15,15 @@ const track = {
     duration_ms: 0
 };
 
-function WebPlayback({ accessToken, currentSong, onNextSong, roomId, socket }) {
+// Where the room is in `song` by the server's playback clock, so a host who
+// (re)joins mid-song picks it up there instead of from the start
+const roomPosition = (song) => {
+    if (!song?.startedAt) return 0;
+    const position = Date.now() - song.startedAt;
+    return position > 0 && (!song.duration_ms || position < song.duration_ms) ? position : 0;
+};
+
+function WebPlayback({ accessToken, currentSong, onNextSong, roomId, userId, socket }) {
     // Player instance and state refs
     const playerRef = React.useRef(null);
     const mountedRef = React.useRef(true);
@@ -916,7 +924,7 @@ function WebPlayback({ accessToken, currentSong, onNextSong, roomId, socket }) {
                             },
                             body: JSON.stringify({ 
                                 uris: [currentSong.uri],
-                                position_ms: 0
+                                position_ms: roomPosition(currentSong)
                             })
                         });
                         
@@ -1042,7 +1050,7 @@ function WebPlayback({ accessToken, currentSong, onNextSong, roomId, socket }) {
                         },
                         body: JSON.stringify({ 
                             uris: [currentSong.uri],
-                            position_ms: 0
+                            position_ms: roomPosition(currentSong)
                         })
                     });
                     
@@ -1195,7 +1203,7 @@ function WebPlayback({ accessToken, currentSong, onNextSong, roomId, socket }) {
                         },
                         body: JSON.stringify({
                             uris: [currentSong.uri],
-                            position_ms: 0
+                            position_ms: roomPosition(currentSong)
                         })
                     });
                     
@@ -1366,6 +1374,31 @@ function WebPlayback({ accessToken, currentSong, onNextSong, roomId, socket }) {
         };
     }, [is_active, is_paused, isSeeking, playerReady]); // Remove progress from dependencies
 
+    // Report to the server whether the room's song is playing and where, on every
+    // change and every 10 seconds while it plays: the server's clock follows this
+    // player and holds the room when no report says the song is being played
+    useEffect(() => {
+        if (!socket || !currentSong?.id || !playerReady) return;
+
+        const report = async () => {
+            const state = await safeGetCurrentState();
+            if (!state || !mountedRef.current) return;
+            // Another track (or none yet) is not the room's song playing
+            if (currentSong.uri && state.track_window?.current_track?.uri !== currentSong.uri) return;
+            socket.emit('playback_state', {
+                room_id: roomId,
+                user_id: userId,
+                song_id: currentSong.id,
+                paused: state.paused,
+                position_ms: state.position
+            });
+        };
+
+        report();
+        const reportInterval = setInterval(report, 10000);
+        return () => clearInterval(reportInterval);
+    }, [socket, roomId, userId, currentSong?.id, currentSong?.uri, playerReady, is_paused, safeGetCurrentState]);
+
     // Enhanced play/pause handler with proper device initialization
     const handlePlay = useCallback(async () => {
         if (!currentSong?.uri) {
@@ -1423,7 +1456,7 @@ function WebPlayback({ accessToken, currentSong, onNextSong, roomId, socket }) {
                 },
                 body: JSON.stringify({ 
                     uris: [currentSong.uri],
-                    position_ms: 0
+                    position_ms: roomPosition(currentSong)
                 })
             });
 